@@ -1,10 +1,19 @@
 import click
+import os
+import PIL.Image
 from ocrd.decorators import ocrd_cli_options, ocrd_cli_wrap_processor
 
+from gbn.lib.backend import BACKENDS
+from gbn.lib.bench import autotune as autotune_model, compare_models
+from gbn.lib.dl import Model
+from gbn.lib.profile import ExecutionProfile
+from gbn.lib.quantize import PRECISIONS, quantize as quantize_model, quantized_path
+from gbn.lib.util import pil_to_cv2_rgb
 from gbn.sbb.predict import OcrdGbnSbbPredict
 from gbn.sbb.binarize import OcrdGbnSbbBinarize
 from gbn.sbb.crop import OcrdGbnSbbCrop
 from gbn.sbb.segment import OcrdGbnSbbSegment
+from gbn.sbb.crop_binarize_segment import OcrdGbnSbbCropBinarizeSegment
 
 @click.command()
 @ocrd_cli_options
@@ -25,3 +34,128 @@ def ocrd_gbn_sbb_crop(*args, **kwargs):
 @ocrd_cli_options
 def ocrd_gbn_sbb_segment(*args, **kwargs):
     return ocrd_cli_wrap_processor(OcrdGbnSbbSegment, *args, **kwargs)
+
+@click.command()
+@ocrd_cli_options
+def ocrd_gbn_sbb_crop_binarize_segment(*args, **kwargs):
+    return ocrd_cli_wrap_processor(OcrdGbnSbbCropBinarizeSegment, *args, **kwargs)
+
+@click.group()
+def gbn_model():
+    '''
+    Tools for the models used by the ocrd-gbn processors.
+    '''
+
+    pass
+
+@gbn_model.command()
+@click.option('-s', '--shaping', type=click.Choice(["resize", "split"]), default="split", show_default=True, help="Shaping algorithm")
+@click.option('-b', '--backend', type=click.Choice(sorted(BACKENDS.keys())), default="tflite", show_default=True, help="Inference backend to be compared against Keras")
+@click.option('--batch-size', type=int, default=16, show_default=True, help="Maximum number of model inputs per forward pass")
+@click.option('-r', '--repeat', type=int, default=3, show_default=True, help="Number of timed runs over the images")
+@click.argument('model_path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('images', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+def compare(shaping, backend, batch_size, repeat, model_path, images):
+    '''
+    Checks an inference backend for equivalence against Keras on the given images and reports its speedup.
+    '''
+
+    images = [pil_to_cv2_rgb(PIL.Image.open(path))[0] for path in images]
+
+    reference = Model(model_path, shaping, batch_size=batch_size, backend="keras")
+    candidate = Model(model_path, shaping, batch_size=batch_size, backend=backend)
+
+    difference, reference_time, candidate_time = compare_models(reference, candidate, images, repeat)
+
+    click.echo("keras: %.3f s/image" % reference_time)
+    click.echo("%s: %.3f s/image (speedup: %.2fx)" % (backend, candidate_time, reference_time / candidate_time))
+    click.echo("Pixel disagreement: %.6f%%" % (100 * difference))
+
+@gbn_model.command()
+@click.option('-s', '--shaping', type=click.Choice(["resize", "split"]), default="split", show_default=True, help="Shaping algorithm")
+@click.option('-b', '--backend', type=click.Choice(sorted(BACKENDS.keys())), default="keras", show_default=True, help="Inference backend")
+@click.option('-t', '--threads', default="1,2,4", show_default=True, help="Comma-separated numbers of intra-op and inter-op threads to be tried (0 for automatic)")
+@click.option('--batch-sizes', default="1,4,16", show_default=True, help="Comma-separated batch sizes to be tried")
+@click.option('-r', '--repeat', type=int, default=1, show_default=True, help="Number of timed runs over the images")
+@click.option('--dry-run', is_flag=True, help="Only report the timings, without caching the best profile")
+@click.argument('model_path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('images', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+def autotune(shaping, backend, threads, batch_sizes, repeat, dry_run, model_path, images):
+    '''
+    Times the model on the given sample images with several thread and batch size settings and caches the fastest
+    as the execution profile used by the processors for that model.
+    '''
+
+    threads = [int(value) for value in threads.split(",")]
+    batch_sizes = [int(value) for value in batch_sizes.split(",")]
+
+    images = [pil_to_cv2_rgb(PIL.Image.open(path))[0] for path in images]
+
+    timings = autotune_model(model_path, shaping, backend, images, threads, batch_sizes, repeat)
+
+    click.echo("intra_op_threads\tinter_op_threads\tbatch_size\ts/image")
+    for profile, elapsed in timings:
+        click.echo("%d\t%d\t%d\t%.3f" % (profile.intra_op_threads, profile.inter_op_threads, profile.batch_size, elapsed))
+
+    best, _ = timings[0]
+
+    if not dry_run:
+        path = ExecutionProfile.cache_path(model_path, shaping, backend)
+        best.save(path)
+
+        click.echo("Saved %s to %s" % (best, path))
+
+@gbn_model.command()
+@click.option('-p', '--precision', type=click.Choice(PRECISIONS[1:]), default="float16", show_default=True, help="Precision of the converted model")
+@click.option('-s', '--shaping', type=click.Choice(["resize", "split"]), default="split", show_default=True, help="Shaping algorithm (for taking calibration inputs from the images)")
+@click.option('-o', '--output', type=click.Path(dir_okay=False), default=None, help="Path of the converted model (defaults to MODEL.PRECISION.tflite next to the model, as expected by the processors)")
+@click.argument('model_path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('images', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+def quantize(precision, shaping, output, model_path, images):
+    '''
+    Converts a Keras model to a reduced-precision TFLite model. Quantizing to int8 requires sample images for
+    calibration.
+    '''
+
+    images = [pil_to_cv2_rgb(PIL.Image.open(path))[0] for path in images]
+
+    model = Model(model_path, shaping, backend="keras")
+
+    content = quantize_model(model, precision, images)
+
+    if output is None:
+        output = quantized_path(model_path, precision)
+
+    with open(output, 'wb') as fp:
+        fp.write(content)
+
+    click.echo("Saved %s model (%d bytes) to %s" % (precision, len(content), output))
+
+@gbn_model.command()
+@click.option('-p', '--precision', type=click.Choice(PRECISIONS[1:]), default="float16", show_default=True, help="Precision of the converted model (see quantize)")
+@click.option('-s', '--shaping', type=click.Choice(["resize", "split"]), default="split", show_default=True, help="Shaping algorithm")
+@click.option('--batch-size', type=int, default=16, show_default=True, help="Maximum number of model inputs per forward pass")
+@click.option('-r', '--repeat', type=int, default=3, show_default=True, help="Number of timed runs over the images")
+@click.argument('model_path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('images', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+def evaluate(precision, shaping, batch_size, repeat, model_path, images):
+    '''
+    Reports the pixel disagreement between the masks of a reduced-precision model and of the float32 Keras model on a
+    set of reference images, along with the throughput gain.
+    '''
+
+    quantized_model_path = quantized_path(model_path, precision)
+
+    if not os.path.exists(quantized_model_path):
+        raise click.ClickException("No %s model at %s (see gbn-model quantize)" % (precision, quantized_model_path))
+
+    images = [pil_to_cv2_rgb(PIL.Image.open(path))[0] for path in images]
+
+    reference = Model(model_path, shaping, batch_size=batch_size, backend="keras")
+    candidate = Model(quantized_model_path, shaping, batch_size=batch_size, backend="tflite")
+
+    difference, reference_time, candidate_time = compare_models(reference, candidate, images, repeat)
+
+    click.echo("float32: %.2f images/s" % (1 / reference_time))
+    click.echo("%s: %.2f images/s (throughput gain: %.2fx)" % (precision, 1 / candidate_time, reference_time / candidate_time))
+    click.echo("Pixel disagreement: %.6f%%" % (100 * difference))
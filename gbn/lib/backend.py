@@ -0,0 +1,278 @@
+import os
+import numpy as np
+import tensorflow as tf
+import keras.models
+
+class KerasBackend:
+    '''
+    Inference backend running a Keras model (default).
+    '''
+
+    name = "keras"
+
+    def __init__(self, model_path, cfg=None):
+        '''
+        Constructs a KerasBackend object by loading the Keras model from the given path into a graph of its own, run by
+        a tensorflow session with the given configuration (defaults to allowing GPU growth), so that the configuration
+        applies even if other models were loaded before.
+        '''
+
+        if cfg is None:
+            cfg = tf.ConfigProto()
+            cfg.gpu_options.allow_growth = True
+
+        self.graph = tf.Graph()
+        self.session = tf.Session(graph=self.graph, config=cfg)
+
+        # Load Keras model (into the graph and session of this backend):
+        with self.graph.as_default(), self.session.as_default():
+            self.model = keras.models.load_model(model_path, compile=False)
+
+        self.input_shape = self.model.input_shape
+        self.output_shape = self.model.output_shape
+
+    @property
+    def weights_size(self):
+        '''
+        Estimated memory (in bytes) taken by the weights of the model (float32).
+        '''
+
+        return self.model.count_params() * 4
+
+    def predict(self, batch, batch_size):
+        '''
+        Performs a prediction on a batch of model input tensors, at most batch size tensors per forward pass.
+        '''
+
+        with self.graph.as_default(), self.session.as_default():
+            return self.model.predict(batch, batch_size=batch_size)
+
+class FrozenGraphBackend:
+    '''
+    Inference-only backend running a frozen tensorflow graph converted from a Keras model, without the Keras stack.
+    '''
+
+    name = "frozen"
+
+    def __init__(self, model_path, cfg=None):
+        '''
+        Constructs a FrozenGraphBackend object by loading the Keras model from the given path and freezing its graph.
+        The frozen graph runs in its own session with the given configuration.
+        '''
+
+        # Load Keras model:
+        keras_backend = KerasBackend(model_path, cfg)
+        model = keras_backend.model
+        session = keras_backend.session
+
+        # Convert variables of the graph of the model to constants, keeping only what is needed for inference:
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            session,
+            session.graph.as_graph_def(),
+            [output.op.name for output in model.outputs]
+        )
+        graph_def = tf.graph_util.remove_training_nodes(graph_def)
+
+        self.graph_def = graph_def.SerializeToString()
+
+        self.input_name = model.inputs[0].name
+        self.output_name = model.outputs[0].name
+
+        self.input_shape = model.input_shape
+        self.output_shape = model.output_shape
+
+        # Release the Keras model (and the copy of the weights held by its session), now that the graph is frozen:
+        session.close()
+
+        self.init_session(cfg)
+
+    def init_session(self, cfg=None):
+        '''
+        Imports the frozen graph into a new graph and initiates a tensorflow session on it.
+        '''
+
+        if cfg is None:
+            cfg = tf.ConfigProto()
+            cfg.gpu_options.allow_growth = True
+
+        graph_def = tf.GraphDef()
+        graph_def.ParseFromString(self.graph_def)
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+
+        self.session = tf.Session(graph=self.graph, config=cfg)
+
+        self.input = self.graph.get_tensor_by_name(self.input_name)
+        self.output = self.graph.get_tensor_by_name(self.output_name)
+
+    @property
+    def weights_size(self):
+        '''
+        Estimated memory (in bytes) taken by the weights of the model (size of the frozen graph).
+        '''
+
+        return len(self.graph_def)
+
+    def predict(self, batch, batch_size):
+        '''
+        Performs a prediction on a batch of model input tensors, at most batch size tensors per forward pass.
+        '''
+
+        return np.concatenate([
+            self.session.run(self.output, feed_dict={self.input: batch[idx:idx+batch_size]})
+            for idx in range(0, len(batch), batch_size)
+        ])
+
+class TFLiteBackend:
+    '''
+    Inference-only backend running a TFLite model, either converted from a Keras model or loaded from a .tflite file.
+    '''
+
+    name = "tflite"
+
+    def __init__(self, model_path, cfg=None):
+        '''
+        Constructs a TFLiteBackend object from the given path of a Keras model (converted on load) or a TFLite model.
+        The interpreter uses the intra-op parallelism of the given tensorflow session configuration, if any.
+        '''
+
+        if model_path.endswith(".tflite"):
+            with open(model_path, 'rb') as fp:
+                self.content = fp.read()
+        else:
+            self.content = tf.lite.TFLiteConverter.from_keras_model_file(model_path).convert()
+
+        self.init_interpreter(cfg.intra_op_parallelism_threads or None if cfg is not None else None)
+
+        # Shapes of the model with undefined batch size:
+        self.input_shape = (None,) + tuple(self.input_details['shape'][1:])
+        self.output_shape = (None,) + tuple(self.output_details['shape'][1:])
+
+    def init_interpreter(self, threads=None):
+        '''
+        Initiates a TFLite interpreter for the model, using the given number of threads if supported.
+        '''
+
+        try:
+            self.interpreter = tf.lite.Interpreter(model_content=self.content, num_threads=threads)
+        except TypeError:
+            # Interpreter does not support setting the number of threads:
+            self.interpreter = tf.lite.Interpreter(model_content=self.content)
+
+        self.interpreter.allocate_tensors()
+
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+
+        # Batch size the tensors are currently allocated for:
+        self.allocated_batch_size = self.input_details['shape'][0]
+
+    @property
+    def weights_size(self):
+        '''
+        Estimated memory (in bytes) taken by the weights of the model (size of the TFLite model).
+        '''
+
+        return len(self.content)
+
+    def allocate(self, batch_size):
+        '''
+        Resizes the input tensor of the interpreter to the given batch size.
+        '''
+
+        if batch_size != self.allocated_batch_size:
+            self.interpreter.resize_tensor_input(
+                self.input_details['index'],
+                np.array((batch_size,) + tuple(self.input_details['shape'][1:]), dtype=np.int32)
+            )
+            self.interpreter.allocate_tensors()
+
+            self.allocated_batch_size = batch_size
+
+    def predict(self, batch, batch_size):
+        '''
+        Performs a prediction on a batch of model input tensors, at most batch size tensors per invocation.
+        '''
+
+        predictions = []
+        for idx in range(0, len(batch), batch_size):
+            chunk = batch[idx:idx+batch_size]
+
+            self.allocate(len(chunk))
+
+            self.interpreter.set_tensor(self.input_details['index'], chunk.astype(self.input_details['dtype']))
+            self.interpreter.invoke()
+
+            predictions.append(self.interpreter.get_tensor(self.output_details['index']))
+
+        return np.concatenate(predictions)
+
+class DeferredBackend:
+    '''
+    Inference backend whose model is only loaded on first use. Processes which fork workers must not load their models
+    themselves: tensorflow sessions rely on process-wide thread pools whose threads do not exist in forked processes, so
+    any session used after a fork may block forever. Such processes defer the loading to their workers.
+    '''
+
+    def __init__(self, name, model_path, cfg=None):
+        '''
+        Constructs a DeferredBackend object given the name of the inference backend loading the model (see BACKENDS),
+        the path of the model and the tensorflow session configuration used by default.
+        '''
+
+        self.name = name
+        self.model_path = model_path
+        self.cfg = cfg
+
+        # Backend running the model, once loaded:
+        self.loaded = None
+
+    def load(self, cfg=None):
+        '''
+        Loads the model (unless already loaded) with the given tensorflow session configuration (defaults to the one
+        given on construction). Returns the backend running it.
+        '''
+
+        if self.loaded is None:
+            self.loaded = BACKENDS[self.name](self.model_path, cfg if cfg is not None else self.cfg)
+
+        return self.loaded
+
+    @property
+    def is_loaded(self):
+        return self.loaded is not None
+
+    @property
+    def input_shape(self):
+        return self.load().input_shape
+
+    @property
+    def output_shape(self):
+        return self.load().output_shape
+
+    @property
+    def weights_size(self):
+        '''
+        Estimated memory (in bytes) taken by the weights of the model (size of the model file, until loaded).
+        '''
+
+        if self.loaded is None:
+            return os.path.getsize(self.model_path)
+
+        return self.loaded.weights_size
+
+    def predict(self, batch, batch_size):
+        '''
+        Performs a prediction on a batch of model input tensors, loading the model first if needed.
+        '''
+
+        return self.load().predict(batch, batch_size)
+
+# Available inference backends by name:
+BACKENDS = {
+    "keras": KerasBackend,
+    "frozen": FrozenGraphBackend,
+    "tflite": TFLiteBackend
+}
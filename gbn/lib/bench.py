@@ -0,0 +1,331 @@
+import io
+import time
+import tracemalloc
+import numpy as np
+import cv2
+
+from multiprocessing import get_context
+
+from gbn.lib.dl import Model
+from gbn.lib.profile import ExecutionProfile
+from gbn.lib.struct import BoundingBox, BoxIndex
+from gbn.lib.util import bits_to_pil_bilevel, cv2_to_pil_gray, pil_to_cv2, pil_to_cv2_rgb
+
+def time_predictions(model, images, repeat=1):
+    '''
+    Predicts the given cv2 images with a Model object, returning the predictions and the average time (in seconds)
+    taken per image. A first (untimed) run warms the model up.
+    '''
+
+    # Warm up (and keep predictions of) the model:
+    predictions = [model.predict(image) for image in images]
+
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        for image in images:
+            model.predict(image)
+
+    elapsed = (time.perf_counter() - start) / (repeat * len(images))
+
+    return predictions, elapsed
+
+def disagreement(predictions, references):
+    '''
+    Gets the fraction of pixels whose labels differ between two sequences of Prediction objects.
+    '''
+
+    differing = sum(np.count_nonzero(prediction.img != reference.img) for prediction, reference in zip(predictions, references))
+    total = sum(reference.img.size for reference in references)
+
+    return differing / total
+
+def compare_models(reference, candidate, images, repeat=1):
+    '''
+    Times two Model objects on the given cv2 images, returning the fraction of pixels whose labels differ between
+    their predictions and the average times (in seconds) taken per image by the reference and by the candidate.
+    '''
+
+    reference_predictions, reference_time = time_predictions(reference, images, repeat)
+    candidate_predictions, candidate_time = time_predictions(candidate, images, repeat)
+
+    return disagreement(candidate_predictions, reference_predictions), reference_time, candidate_time
+
+def _time_batch_sizes(model_path, shaping, backend, images, profile, batch_sizes, repeat):
+    # Load model in this (fresh) process, whose thread pools are sized by the profile:
+    model = Model(model_path, shaping, backend=backend, profile=profile)
+
+    timings = []
+
+    for batch_size in batch_sizes:
+        model.batch_size = batch_size
+
+        _, elapsed = time_predictions(model, images, repeat)
+
+        timings.append((batch_size, elapsed))
+
+    return timings
+
+def autotune(model_path, shaping, backend, images, threads, batch_sizes, repeat=1):
+    '''
+    Times a model (given its path, shaping algorithm and inference backend) on the given cv2 images for every
+    combination of intra-op threads, inter-op threads and batch size, returning the timings as (ExecutionProfile,
+    seconds per image) pairs sorted from fastest to slowest. Each thread setting is timed in a fresh process loading the
+    model, since tensorflow sizes its process-wide thread pools only once.
+    '''
+
+    timings = []
+
+    # Pool replacing its (spawned, not forked) process after each thread setting:
+    with get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        for intra_op_threads in threads:
+            for inter_op_threads in threads:
+                profile = ExecutionProfile(intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+
+                for batch_size, elapsed in pool.apply(
+                    _time_batch_sizes,
+                    (model_path, shaping, backend, images, profile, batch_sizes, repeat)
+                ):
+                    timings.append((
+                        ExecutionProfile(
+                            intra_op_threads=intra_op_threads,
+                            inter_op_threads=inter_op_threads,
+                            batch_size=batch_size
+                        ),
+                        elapsed
+                    ))
+
+    return sorted(timings, key=lambda timing: timing[1])
+
+def split_allocations(model, page_sizes, budgets, seed=0):
+    '''
+    Predicts random pages of the given sizes (height, width) through the split algorithm of a Model object under each
+    of the given memory budgets (in bytes, None for unbounded), returning a dict mapping each pair of page size and
+    budget to the peak of bytes allocated (as traced by tracemalloc, including Numpy arrays but neither the inference
+    engine nor canvases mapped to disk) and the time (in seconds) taken by the prediction.
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    memory_budget = model.memory_budget
+
+    results = {}
+
+    try:
+        for page_size in page_sizes:
+            # Generate page beforehand (not part of the prediction):
+            image = rng.randint(0, 256, tuple(page_size) + (model.input_shape[3],)).astype(np.uint8)
+
+            for budget in budgets:
+                model.memory_budget = budget
+
+                # Start from empty buffers (reused buffers would not count towards the peak):
+                model.input_buffer = None
+
+                tracemalloc.start()
+                start = time.perf_counter()
+
+                prediction = model.predict_split(image)
+
+                elapsed = time.perf_counter() - start
+                allocated = tracemalloc.get_traced_memory()[1]
+
+                tracemalloc.stop()
+
+                del prediction
+
+                results[(tuple(page_size), budget)] = (allocated, elapsed)
+    finally:
+        model.memory_budget = memory_budget
+
+    return results
+
+def _legacy_predict_resize(model, image):
+    # Resize algorithm as formerly implemented: normalize the full-resolution image to float64, resize it, then reduce
+    # the classes of the prediction through a stacked array and argmax:
+    image_shape = image.shape
+
+    image = image / 255.0
+    image = cv2.resize(image, (model.input_shape[2], model.input_shape[1]), interpolation=cv2.INTER_NEAREST)
+
+    prediction = model.backend.predict(image.reshape(model.input_shape), 1)
+    prediction = prediction.reshape(model.output_shape[1:])
+
+    if prediction.shape[2] > 2:
+        bg = np.add(prediction[:, :, 0], np.sum(prediction[:, :, 2:], axis=2))
+        prediction = np.stack((bg, prediction[:, :, 1]), axis=2)
+
+    prediction = np.argmax(prediction, axis=2).astype(np.uint8)
+    prediction = prediction * 255
+
+    return cv2.resize(prediction, (image_shape[1], image_shape[0]), interpolation=cv2.INTER_NEAREST)
+
+def resize_allocations(model, page_sizes, seed=0):
+    '''
+    Predicts random pages of the given sizes (height, width) through the resize algorithm of a Model object as formerly
+    implemented (float64 normalization of the full-resolution page and argmax over stacked classes, legacy) and as
+    currently implemented (uint8 resizing, float32 normalization and in-place class reduction), returning the average
+    peak of bytes allocated (as traced by tracemalloc, including Numpy and OpenCV arrays but not the inference engine)
+    and the average time (in seconds) taken per page by each. Raises AssertionError if the predictions differ.
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    # Generate pages beforehand (not part of the predictions):
+    images = [
+        rng.randint(0, 256, tuple(page_size) + (model.input_shape[3],)).astype(np.uint8)
+        for page_size in page_sizes
+    ]
+
+    def measure(predict):
+        predictions = []
+        allocated = 0
+        elapsed = 0.0
+
+        for image in images:
+            # Start from empty buffers (reused buffers would not count towards the peak):
+            model.input_buffer = None
+
+            tracemalloc.start()
+            start = time.perf_counter()
+
+            prediction = predict(image)
+
+            elapsed += time.perf_counter() - start
+            allocated += tracemalloc.get_traced_memory()[1]
+
+            tracemalloc.stop()
+
+            predictions.append(prediction)
+
+        return predictions, allocated / len(images), elapsed / len(images)
+
+    legacy_predictions, legacy_allocated, legacy_time = measure(lambda image: _legacy_predict_resize(model, image))
+    predictions, allocated, elapsed = measure(lambda image: model.predict_resize(image).img)
+
+    for prediction, reference in zip(predictions, legacy_predictions):
+        assert np.array_equal(prediction, reference)
+
+    return legacy_allocated, allocated, legacy_time, elapsed
+
+def time_box_index(count=5000, queries=1000, page_size=(7000, 5000), seed=0):
+    '''
+    Times a BoxIndex object on a page of given size (height, width) with the given number of random boxes shaped like
+    connected components, queried with the given number of random boxes shaped like regions. Returns the times (in
+    seconds) taken to build the index, to get the intersecting boxes of all queries one by one and at once (pairs),
+    and to get them by comparing all boxes (vectorized). Raises AssertionError if the results differ.
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    height, width = page_size
+
+    def random_boxes(count, min_size, max_size):
+        sizes = rng.randint(min_size, max_size, (count, 2))
+        return np.concatenate([rng.randint(0, [width, height], (count, 2)) % ([width, height] - sizes), sizes], axis=1)
+
+    bboxes = random_boxes(count, 5, 60)
+    targets = random_boxes(queries, 50, 1500)
+
+    start = time.perf_counter()
+    index = BoxIndex(bboxes)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = [index.intersecting(BoundingBox(target)) for target in targets]
+    query_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pairs = index.pairs(targets)
+    pairs_time = time.perf_counter() - start
+
+    x0, y0 = bboxes[:, 0], bboxes[:, 1]
+    x1, y1 = x0 + bboxes[:, 2], y0 + bboxes[:, 3]
+
+    start = time.perf_counter()
+    references = [
+        np.flatnonzero((x0 < tx0 + tw) & (tx0 < x1) & (y0 < ty0 + th) & (ty0 < y1))
+        for tx0, ty0, tw, th in targets
+    ]
+    brute_time = time.perf_counter() - start
+
+    for result, reference in zip(results, references):
+        assert np.array_equal(result, reference)
+
+    assert np.array_equal(pairs[0], np.repeat(np.arange(queries), [len(reference) for reference in references]))
+    assert np.array_equal(pairs[1][np.lexsort(pairs[::-1])], np.concatenate(references))
+
+    return build_time, query_time, pairs_time, brute_time
+
+def conversion_allocations(images, channels=3):
+    '''
+    Converts the given PIL images to cv2 images through pil_to_cv2_rgb (legacy) and through pil_to_cv2 for a model with
+    the given number of input channels, returning the average peak of bytes allocated (as traced by tracemalloc,
+    including Numpy and OpenCV arrays) and the average time (in seconds) taken per image by each conversion.
+    '''
+
+    def measure(convert):
+        allocated = 0
+        elapsed = 0.0
+
+        for image in images:
+            # Decode image beforehand (not part of the conversion):
+            image.load()
+
+            tracemalloc.start()
+            start = time.perf_counter()
+
+            converted, _ = convert(image)
+
+            elapsed += time.perf_counter() - start
+            allocated += tracemalloc.get_traced_memory()[1]
+
+            tracemalloc.stop()
+
+            del converted
+
+        return allocated / len(images), elapsed / len(images)
+
+    legacy_allocated, legacy_time = measure(pil_to_cv2_rgb)
+    allocated, elapsed = measure(lambda image: pil_to_cv2(image, channels))
+
+    return legacy_allocated, allocated, legacy_time, elapsed
+
+def binary_encodings(predictions, repeat=1):
+    '''
+    Converts and encodes the given Prediction objects as binarized images in each output format of the binarization
+    ('png' for 8-bit grayscale PNG, 'png-bilevel' for 1-bit PNG and 'tiff-g4' for 1-bit TIFF with CCITT Group 4
+    compression), returning the average file size (in bytes) and time (in seconds) taken per image by each format.
+    '''
+
+    formats = {
+        'png': (lambda prediction: cv2_to_pil_gray(prediction.to_binary_image()), {'format': 'PNG'}),
+        'png-bilevel': (
+            lambda prediction: bits_to_pil_bilevel(prediction.packed_bits(), prediction.shape),
+            {'format': 'PNG'}
+        ),
+        'tiff-g4': (
+            lambda prediction: bits_to_pil_bilevel(prediction.packed_bits(), prediction.shape),
+            {'format': 'TIFF', 'compression': 'group4'}
+        )
+    }
+
+    results = {}
+
+    for name, (convert, options) in formats.items():
+        size = 0
+
+        start = time.perf_counter()
+
+        for _ in range(repeat):
+            for prediction in predictions:
+                content = io.BytesIO()
+                convert(prediction).save(content, **options)
+
+                size += len(content.getvalue())
+
+        elapsed = time.perf_counter() - start
+
+        results[name] = (size / (repeat * len(predictions)), elapsed / (repeat * len(predictions)))
+
+    return results
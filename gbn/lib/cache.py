@@ -0,0 +1,154 @@
+import hashlib
+import io
+import os
+import numpy as np
+
+from collections import OrderedDict
+
+from gbn.lib.dl import Prediction
+
+class PredictionCache:
+    '''
+    Persistent content-addressed cache of predictions. Predictions are keyed by a hash of the input image pixels, the
+    model file fingerprint, the shaping algorithm and the inference backend, stored as compressed packed bits and
+    evicted least recently used first once exceeding the size limit.
+    '''
+
+    def __init__(self, cache_dir, max_size=None):
+        '''
+        Constructs a PredictionCache object given the directory of the cached predictions and the maximum size (in
+        bytes) they may take (None for unbounded).
+        '''
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Sizes of the cached predictions by path, from least to most recently used:
+        self.entries = OrderedDict()
+        self.size = 0
+
+        # Index predictions already in the cache (e.g. of a previous run), by modification time:
+        paths = []
+        for root, _, files in os.walk(cache_dir):
+            paths += [os.path.join(root, name) for name in files if name.endswith(".npz")]
+
+        for path, stat in sorted(((path, os.stat(path)) for path in paths), key=lambda item: item[1].st_mtime_ns):
+            self.entries[path] = stat.st_size
+            self.size += stat.st_size
+
+        # Statistics:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __str__(self):
+        total = self.hits + self.misses
+
+        return "{} hit(s), {} miss(es) ({:.1%} hit rate), {} eviction(s), {} prediction(s) in {:.1f} MiB".format(
+            self.hits,
+            self.misses,
+            self.hits / total if total else 0.0,
+            self.evictions,
+            len(self.entries),
+            self.size / (1024 * 1024)
+        )
+
+    @staticmethod
+    def key(model, image):
+        '''
+        Gets the key of the prediction of a cv2 image by a Model object.
+        '''
+
+        stat = os.stat(model.model_path)
+
+        digest = hashlib.blake2b(digest_size=20)
+
+        # Model file (resolved path and fingerprint), shaping algorithm and inference backend:
+        digest.update("{}:{}:{}:{}:{}".format(
+            os.path.realpath(model.model_path),
+            stat.st_size,
+            stat.st_mtime_ns,
+            model.shaping,
+            model.backend.name
+        ).encode('utf-8'))
+
+        # Input pixels, along with their shape and type:
+        digest.update("{}:{}".format(image.shape, image.dtype).encode('utf-8'))
+        digest.update(np.ascontiguousarray(image).data)
+
+        return digest.hexdigest()
+
+    def path(self, key):
+        # Spread predictions over subdirectories by the first byte of their key:
+        return os.path.join(self.cache_dir, key[:2], key + ".npz")
+
+    def get(self, key):
+        '''
+        Gets the cached Prediction object (packed) of given key, or None if there is none.
+        '''
+
+        path = self.path(key)
+
+        try:
+            with np.load(path) as data:
+                shape = tuple(data['shape'])
+                bits = data['bits']
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            # Missing (e.g. evicted by another process) or unreadable prediction:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        # Mark prediction as most recently used (also for future runs):
+        os.utime(path)
+        if path in self.entries:
+            self.entries.move_to_end(path)
+
+        return Prediction.from_bits(bits, shape)
+
+    def put(self, key, prediction):
+        '''
+        Caches a Prediction object under the given key.
+        '''
+
+        path = self.path(key)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Compress packed bits of prediction:
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, shape=np.array(prediction.shape), bits=prediction.packed_bits())
+
+        # Write to a temporary file first, so readers never see a partial prediction:
+        with open(path + ".tmp", 'wb') as fp:
+            fp.write(buffer.getvalue())
+
+        os.replace(path + ".tmp", path)
+
+        self.size += len(buffer.getvalue()) - self.entries.pop(path, 0)
+        self.entries[path] = len(buffer.getvalue())
+
+        self.evict()
+
+    def evict(self):
+        '''
+        Evicts least recently used predictions until the size limit is respected.
+        '''
+
+        if self.max_size is None:
+            return
+
+        while self.size > self.max_size and self.entries:
+            path, size = self.entries.popitem(last=False)
+            self.size -= size
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Already evicted by another process:
+                pass
+
+            self.evictions += 1
@@ -1,109 +1,210 @@
 import math
+import os
+import tempfile
+import time
 import numpy as np
 import cv2
-import tensorflow as tf
-import keras.models
 
-from gbn.lib.struct import Contour, Polygon
+from collections import OrderedDict
+
+from gbn.lib.backend import BACKENDS, DeferredBackend
+from gbn.lib.profile import ExecutionProfile
+from gbn.lib.struct import Contour, ContourSet, Polygon, ProjectionProfiler
 
 class Model:
     '''
     Abstraction layer for a binary deep learning Keras model.
     '''
 
-    def __init__(self, model_path, shaping):
+    def __init__(self, model_path, shaping, batch_size=1, memory_budget=None, backend="keras", profile=None):
         '''
-        Constructs a Model object from a model path and its shaping algorithm.
+        Constructs a Model object from a model path and its shaping algorithm. The batch size limits how many inputs
+        (e.g. patches) are fed to the model in a single forward pass. The memory budget (in bytes) bounds the working
+        memory of the split algorithm, regardless of the image size (None for unbounded). The backend is either the
+        name of the inference engine running the model (see gbn.lib.backend.BACKENDS), loading it, or an already loaded
+        backend object (e.g. shared through a ModelRegistry). The execution profile, if any, sets the threads of the
+        inference engine (only when loading it) and of OpenCV.
         '''
 
         self.model_path = model_path
         self.shaping = shaping
+        self.batch_size = max(1, int(batch_size))
+        self.memory_budget = memory_budget
+
+        # Reusable buffer for model input tensors:
+        self.input_buffer = None
 
-        # Get default tensorflow session:
-        self.session = tf.get_default_session()
+        if profile is not None:
+            # Apply process-wide settings (OpenCV threads):
+            profile.apply()
 
-        # If none, initiate a new session:
-        if self.session is None:
-            self.init_session()
+        if isinstance(backend, str):
+            # Load model through the selected inference backend:
+            if backend not in BACKENDS:
+                raise ValueError("Invalid inference backend: {}".format(backend))
 
-        # Load Keras model:
-        self.model = keras.models.load_model(model_path, compile=False)
+            self.backend = BACKENDS[backend](model_path, profile.to_config() if profile is not None else None)
+        else:
+            # Use already loaded model:
+            self.backend = backend
 
-        # Get input and output shapes of model, replacing None by 1:
-        self.input_shape = (1, self.model.input_shape[1], self.model.input_shape[2], self.model.input_shape[3])
-        self.output_shape = (1, self.model.output_shape[1], self.model.output_shape[2], self.model.output_shape[3])
+        # Input and output shapes of model (got on first use, not to load deferred models early):
+        self._input_shape = None
+        self._output_shape = None
 
-        # Set Model.predict method to selected algorithm:
+        # Set Model.predict_shaped method to selected algorithm:
         if shaping == "resize":
-            self.predict = self.predict_resize
+            self.predict_shaped = self.predict_resize
         elif shaping == "split":
-            self.predict = self.predict_split
+            self.predict_shaped = self.predict_split
         else:
             raise ValueError("Invalid shaping algorithm: {}".format(shaping))
 
-    def init_session(self):
+        # Persistent cache of predictions (see gbn.lib.cache.PredictionCache), if any:
+        self.cache = None
+
+    @property
+    def input_shape(self):
+        '''
+        Input shape of the model, replacing None (batch size) by 1.
+        '''
+
+        if self._input_shape is None:
+            self._input_shape = (1,) + tuple(self.backend.input_shape[1:])
+
+        return self._input_shape
+
+    @property
+    def output_shape(self):
         '''
-        Initiates a tensorflow session allowing GPU growth.
+        Output shape of the model, replacing None (batch size) by 1.
         '''
 
-        cfg = tf.ConfigProto()
-        cfg.gpu_options.allow_growth = True
+        if self._output_shape is None:
+            self._output_shape = (1,) + tuple(self.backend.output_shape[1:])
 
-        self.session = tf.InteractiveSession()
+        return self._output_shape
 
-    def perform_prediction(self, image):
+    @property
+    def weights_size(self):
         '''
-        Performs a prediction given an image whose shape matches the model input.
+        Estimated memory (in bytes) taken by the weights of the model.
         '''
 
-        # Reshape image to model input shape (tensor):
-        image = image.reshape(self.input_shape)
+        return self.backend.weights_size
+
+    def predict(self, image):
+        '''
+        Performs a prediction on the given image through the selected shaping algorithm, unless it is cached.
+        '''
+
+        if self.cache is None:
+            return self.predict_shaped(image)
+
+        key = self.cache.key(self, image)
+
+        # Get cached prediction, if any:
+        prediction = self.cache.get(key)
+        if prediction is not None:
+            return prediction
+
+        prediction = self.predict_shaped(image)
+
+        self.cache.put(key, prediction)
+
+        return prediction
+
+    def perform_prediction(self, batch):
+        '''
+        Performs a prediction given a batch of images whose shapes match the model input. Returns a batch of cv2
+        grayscale images where foreground is 255 (white) and background 0 (black).
+        '''
+
+        # Reshape batch to model input shape (tensor):
+        batch = batch.reshape((-1,) + self.input_shape[1:])
 
         # Perform prediction:
-        prediction = self.model.predict(image)
+        prediction = self.backend.predict(batch, self.batch_size)
 
-        # Reshape prediction to image-like representation:
-        prediction = prediction.reshape(self.output_shape[1:])
+        # Reshape prediction to batch of image-like representations:
+        prediction = prediction.reshape((-1,) + self.output_shape[1:])
 
-        # If classification is not binary:
-        if prediction.shape[2] > 2:
-            # Get classes 0 (background) and 1 (interest/foreground):
-            bg = prediction[:, :, 0]
-            fg = prediction[:, :, 1]
+        # Get likeliness of classes 0 (background) and 1 (interest/foreground):
+        bg = prediction[:, :, :, 0]
+        fg = prediction[:, :, :, 1]
 
+        # If classification is not binary:
+        if prediction.shape[3] > 2:
             # Group all other classes:
-            other = np.sum(prediction[:, :, 2:], axis=2)
+            other = np.sum(prediction[:, :, :, 2:], axis=3)
 
-            # Since all other classes are ignored, consider them background:
-            bg = np.add(bg, other)
+            # Since all other classes are ignored, consider them background (accumulating in place):
+            bg = np.add(bg, other, out=other)
 
-            # Reshape prediction as binary:
-            prediction = np.stack((bg, fg), axis=2)
+        # Get labels of most likely class (ties resolve to background) as an uint8 view of the comparison:
+        prediction = np.greater(fg, bg).view(np.uint8)
 
-        # Get labels by converting from likeliness of each class to label of most likely class:
-        prediction = np.argmax(prediction, axis=2).astype(np.uint8)
-
-        # Map pixels from [0, 1] (binary) to [0, 255] (grayscale):
-        prediction = prediction * 255
+        # Map pixels from [0, 1] (binary) to [0, 255] (grayscale) in place:
+        prediction *= 255
 
         return prediction
 
-    def predict_resize(self, image):
+    def fit_channels(self, image):
         '''
-        Performs a prediction on the given image by resizing it to the model input shape.
+        Views an image (2D grayscale or with channels) as having either a single channel, to be expanded while
+        normalizing, or as many channels as the model input. Only color images fed to a grayscale model are converted.
         '''
 
-        # Get original image shape:
-        image_shape = image.shape
+        if image.ndim == 2:
+            return image[:, :, np.newaxis]
 
-        # Map pixels from [0, 255] (grayscale) to [0, 1] (binary):
-        image = image / 255.0
+        if image.shape[2] in (1, self.input_shape[3]):
+            return image
 
-        # Resize image to input shape:
-        image = cv2.resize(image, (self.input_shape[2], self.input_shape[1]), interpolation=cv2.INTER_NEAREST)
+        if self.input_shape[3] == 1:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)[:, :, np.newaxis]
 
-        # Perform prediction:
-        prediction = self.perform_prediction(image)
+        raise ValueError("Image with {} channels does not fit the model input shape {}".format(
+            image.shape[2],
+            self.input_shape
+        ))
+
+    def resize_input(self, image):
+        '''
+        Resizes an image (still uint8) to the height and width of the model input shape, with its channels fitted to
+        the model (see fit_channels).
+        '''
+
+        image = self.fit_channels(image)
+
+        # Resize channels of views with reversed channels (e.g. BGR views of RGB images) in their stored order:
+        reverse = image.shape[2] > 1 and image.strides[2] < 0
+
+        resized = cv2.resize(
+            image[:, :, ::-1] if reverse else image,
+            (self.input_shape[2], self.input_shape[1]),
+            interpolation=cv2.INTER_NEAREST
+        ).reshape(self.input_shape[1], self.input_shape[2], image.shape[2])
+
+        return resized[:, :, ::-1] if reverse else resized
+
+    def predict_inputs(self, images):
+        '''
+        Performs a prediction on a sequence of uint8 images whose shapes match the model input, all in a single batch.
+        '''
+
+        # Map pixels from [0, 255] (grayscale) to [0, 1] (binary) directly into the input buffer (expanding single
+        # channels and reordering reversed ones on the way):
+        tensor = self.get_input_buffer(len(images))
+        for idx, image in enumerate(images):
+            np.divide(image, 255.0, out=tensor[idx], casting='unsafe')
+
+        return self.perform_prediction(tensor)
+
+    def restore_shape(self, prediction, image_shape):
+        '''
+        Resizes a prediction of a resized image back to the original image shape, wrapping it in a Prediction object.
+        '''
 
         # Resize prediction to original image shape:
         prediction = cv2.resize(prediction, (image_shape[1], image_shape[0]), interpolation=cv2.INTER_NEAREST)
@@ -113,13 +214,60 @@ class Model:
 
         return prediction
 
-    def predict_split(self, image):
+    def predict_resize(self, image):
         '''
-        Performs a prediction on the given image by splitting it into patches whose shape matches the model input.
+        Performs a prediction on the given image by resizing it to the model input shape.
+        '''
+
+        # Resize image (still uint8) to input shape:
+        resized = self.resize_input(image)
+
+        # Perform prediction on a batch of a single image:
+        prediction = self.predict_inputs([resized])[0]
+
+        return self.restore_shape(prediction, image.shape)
+
+    def get_input_buffer(self, size):
+        '''
+        Gets a (reusable) float32 buffer for a batch of given size of model input tensors.
         '''
 
-        # Get original image shape:
-        image_shape = image.shape
+        # (Re)allocate buffer if there is none or if it is too small:
+        if self.input_buffer is None or self.input_buffer.shape[0] < size:
+            self.input_buffer = np.empty((size,) + self.input_shape[1:], dtype=np.float32)
+
+        return self.input_buffer[:size]
+
+    def plan_split(self, pixels):
+        '''
+        Plans the split algorithm for images of given total number of pixels within the memory budget. Returns the
+        number of patches fed to the model per forward pass and whether the canvases of predictions must be mapped to
+        disk.
+        '''
+
+        if self.memory_budget is None:
+            return self.batch_size, False
+
+        # Bytes of canvases of predictions (uint8):
+        canvas_bytes = pixels
+
+        # Map canvas to disk if it would take more than half the budget:
+        use_memmap = canvas_bytes > self.memory_budget // 2
+
+        # Remaining budget for the patches:
+        budget = self.memory_budget - (0 if use_memmap else canvas_bytes)
+
+        # Bytes per patch: uint8 patch, float32 input tensor, float32 output tensor and uint8 prediction:
+        patch_pixels = self.input_shape[1] * self.input_shape[2]
+        patch_bytes = patch_pixels * (self.input_shape[3] * 5 + self.output_shape[3] * 4 + 1)
+
+        return max(1, min(self.batch_size, budget // patch_bytes)), use_memmap
+
+    def split_layout(self, image_shape):
+        '''
+        Gets the layout of the patches an image of given shape is split into: padding before the image (top and left)
+        and number of patches per dimension (vertical and horizontal).
+        '''
 
         # Patch shape is equal to the height and width of model input:
         patch_shape = (self.input_shape[1], self.input_shape[2])
@@ -132,93 +280,640 @@ class Model:
 
         # Split padding equally around the image:
         padding_top = math.floor(padding[0] / 2)
-        padding_bottom = math.ceil(padding[0]/ 2)
         padding_left = math.floor(padding[1] / 2)
-        padding_right = math.ceil(padding[1] / 2)
-
-        # Apply padding:
-        image = cv2.copyMakeBorder(
-            image,
-            padding_top,
-            padding_bottom,
-            padding_left,
-            padding_right,
-            cv2.BORDER_CONSTANT,
-            (255, 255, 255)
-        )
-
-        # Map pixels from [0, 255] (grayscale) to [0, 1] (binary):
-        image = image / 255.0
 
         # Get number of patches per dimension:
-        nyf = int(image.shape[0] / patch_shape[0])
-        nxf = int(image.shape[1] / patch_shape[1])
+        nyf = int((image_shape[0] + padding[0]) / patch_shape[0])
+        nxf = int((image_shape[1] + padding[1]) / patch_shape[1])
 
-        # Blank (black) image to write the patch predictions to:
-        canvas = np.zeros(image.shape[:-1], dtype=np.uint8)
+        return padding_top, padding_left, nyf, nxf
 
-        for i in range(nxf):
-            for j in range(nyf):
-                # Get vertical coordinates of current patch:
-                yd = j * patch_shape[0]
-                yu = yd + patch_shape[0]
+    def new_canvas(self, shape, use_memmap):
+        '''
+        Allocates a blank (black) image of given shape to write patch predictions to, mapped to disk if requested.
+        '''
+
+        if use_memmap:
+            return np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode='w+', shape=shape)
+
+        return np.zeros(shape, dtype=np.uint8)
+
+    def patch_window(self, y, x, shape):
+        '''
+        Gets the overlap of a patch placed at the given position (of its top left corner, possibly outside) with an
+        image of given shape, as slices of the patch and slices of the image.
+        '''
+
+        y0, x0 = max(y, 0), max(x, 0)
+        y1, x1 = min(y + self.input_shape[1], shape[0]), min(x + self.input_shape[2], shape[1])
+
+        return (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x)), (slice(y0, y1), slice(x0, x1))
+
+    def predict_patches(self, images, canvases, patches_per_batch):
+        '''
+        Performs predictions on the patches of a sequence of images (with channels fitted to the model), at most patches
+        per batch at a time, writing them to the canvases of the images (without padding). Only the patches of the
+        current forward pass are copied from the images and normalized, so the working memory is bounded by the patches
+        per batch, regardless of the image sizes.
+        '''
+
+        patch_shape = (self.input_shape[1], self.input_shape[2])
+
+        # Positions of the patches of all images on the images (row-major order of patches of each image):
+        positions = [
+            (idx, row * patch_shape[0] - padding_top, column * patch_shape[1] - padding_left)
+            for idx, (padding_top, padding_left, nyf, nxf) in enumerate(
+                self.split_layout(image.shape) for image in images
+            )
+            for row in range(nyf)
+            for column in range(nxf)
+        ]
+
+        # Buffer of uint8 patches of a forward pass:
+        patches = np.empty((min(patches_per_batch, len(positions)),) + self.input_shape[1:], dtype=np.uint8)
+
+        for start in range(0, len(positions), patches_per_batch):
+            batch = positions[start:start+patches_per_batch]
+
+            # Copy patches from source images, padding them (padding is black, as the former cv2.copyMakeBorder call
+            # effectively padded) and expanding or reordering their channels on the way:
+            for patch, (idx, y, x) in zip(patches, batch):
+                patch_slices, image_slices = self.patch_window(y, x, images[idx].shape)
+
+                patch.fill(0)
+                patch[patch_slices] = images[idx][image_slices]
+
+            # Map pixels from [0, 255] (grayscale) to [0, 1] (binary) directly into the input buffer:
+            tensor = self.get_input_buffer(len(batch))
+            np.divide(patches[:len(batch)], 255.0, out=tensor, casting='unsafe')
+
+            predictions = self.perform_prediction(tensor)
+
+            # Write patch predictions to canvases, removing padding (offset by one pixel):
+            for prediction, (idx, y, x) in zip(predictions, batch):
+                patch_slices, canvas_slices = self.patch_window(y - 1, x - 1, canvases[idx].shape)
+
+                canvases[idx][canvas_slices] = prediction[patch_slices]
+
+    def predict_many(self, images):
+        '''
+        Performs predictions on a sequence of (e.g. segment) images, gathering their model inputs (resized images or
+        patches) into as few forward passes as the batch size (and the memory budget, for patches) allows. Returns a
+        list of Prediction objects.
+        '''
+
+        predictions = [None] * len(images)
+
+        # Get cached predictions, if any:
+        keys = [None] * len(images)
+        if self.cache is not None:
+            for idx, image in enumerate(images):
+                keys[idx] = self.cache.key(self, image)
+
+                predictions[idx] = self.cache.get(keys[idx])
+
+        pending = [idx for idx, prediction in enumerate(predictions) if prediction is None]
+
+        if self.shaping == "resize":
+            # Resize images (still uint8) to input shape:
+            inputs = [self.resize_input(images[idx]) for idx in pending]
+
+            # Perform prediction on the resized images, at most batch size at a time:
+            outputs = [
+                prediction
+                for start in range(0, len(inputs), self.batch_size)
+                for prediction in self.predict_inputs(inputs[start:start+self.batch_size])
+            ]
+
+            for idx, output in zip(pending, outputs):
+                predictions[idx] = self.restore_shape(output, images[idx].shape)
+        else:
+            # View images with channels fitting the model:
+            inputs = [self.fit_channels(images[idx]) for idx in pending]
 
-                # Get horizontal coordinates of current patch:
-                xd = i * patch_shape[1]
-                xu = xd + patch_shape[1]
+            # Get number of patches per forward pass and whether canvases must be mapped to disk (for all images):
+            patches_per_batch, use_memmap = self.plan_split(sum(image.shape[0] * image.shape[1] for image in inputs))
 
-                # Get patch:
-                patch = image[yd:yu, xd:xu]
+            canvases = [self.new_canvas(image.shape[:2], use_memmap) for image in inputs]
 
-                # Perform prediction:
-                prediction = self.perform_prediction(patch)
+            # Perform prediction on the patches of all images, at most patches per batch at a time:
+            self.predict_patches(inputs, canvases, patches_per_batch)
 
-                # Add patch to canvas:
-                canvas[yd:yd+patch_shape[0], xd:xd+patch_shape[1]] = prediction
+            for idx, canvas in zip(pending, canvases):
+                predictions[idx] = Prediction(canvas)
 
-        # Remove padding from canvas of predictions:
-        prediction = canvas[padding_top+1:padding_top+1+image_shape[0], padding_left+1:padding_left+1+image_shape[1]]
+        # Cache new predictions:
+        if self.cache is not None:
+            for idx in pending:
+                self.cache.put(keys[idx], predictions[idx])
+
+        return predictions
+
+    def predict_split(self, image):
+        '''
+        Performs a prediction on the given image by splitting it into patches whose shape matches the model input.
+        Patches are streamed from the source image, so only a bounded number of them is normalized at any time.
+        '''
+
+        # View image with channels fitting the model:
+        image = self.fit_channels(image)
+
+        # Get number of patches per forward pass and whether canvas must be mapped to disk:
+        patches_per_batch, use_memmap = self.plan_split(image.shape[0] * image.shape[1])
+
+        # Blank (black) image to write the patch predictions to (without padding):
+        canvas = self.new_canvas(image.shape[:2], use_memmap)
+
+        self.predict_patches([image], [canvas], patches_per_batch)
 
         # Wrap prediction in a Prediction object:
-        prediction = Prediction(prediction)
+        prediction = Prediction(canvas)
 
         return prediction
 
 class Prediction:
     '''
-    Wrapper of cv2 image predicted by a binary model.
+    Wrapper of cv2 image predicted by a binary model. The image may be held as is or packed into bits (8 pixels per
+    byte along each row), taking an eighth of the memory. It may also be paired with a mask, outside of which pixels
+    are considered background (e.g. a crop by a polygon viewing the image it was cropped from).
     '''
 
-    def __init__(self, img):
+    def __init__(self, img, mask=None):
+        '''
+        Constructs a Prediction object from a cv2 binary image where foreground is 255 (white) and background 0 (black)
+        and, optionally, a mask (bool array with the shape of the image).
+        '''
+
+        self._img = img
+        self.mask = mask
+
+        # Packed bits of image (if packed) and shape of image:
+        self.bits = None
+        self.shape = img.shape[:2] if img is not None else None
+
+    @classmethod
+    def from_bits(cls, bits, shape):
+        '''
+        Constructs a Prediction object from the packed bits of a binary image (see packed_bits) and its shape.
+        '''
+
+        prediction = cls(None)
+        prediction.bits = bits
+        prediction.shape = tuple(shape)
+
+        return prediction
+
+    @property
+    def view(self):
+        '''
+        cv2 binary image of prediction (0 bg / 255 fg), without applying the mask. If packed, the image is unpacked on
+        each access (and not kept).
+        '''
+
+        if self._img is not None:
+            return self._img
+
+        return self.unpack(self.bits)
+
+    @property
+    def img(self):
+        '''
+        cv2 binary image of prediction (0 bg / 255 fg). If there is a mask, it is applied to a new image on each access
+        (see ContourSet.from_image for finding contours of a masked image without it).
+        '''
+
+        if self.mask is None:
+            return self.view
+
+        image = self.view
+
+        return cv2.bitwise_and(image, image, mask=self.mask.view(np.uint8))
+
+    @property
+    def is_packed(self):
+        return self._img is None
+
+    @property
+    def nbytes(self):
         '''
-        Constructs a Prediction object from a cv2 binary image where foreground is 255 (white) and background 0 (black).
+        Memory (in bytes) taken by the backing store of the prediction.
         '''
 
-        self.img = img
+        return self.bits.nbytes if self.is_packed else self._img.nbytes
+
+    def packed_bits(self):
+        '''
+        Gets the bits of the prediction image packed along each row (foreground is 1), without packing the prediction.
+        '''
+
+        if self.is_packed and self.mask is None:
+            return self.bits
+
+        return np.packbits(self.img, axis=1)
+
+    def pack(self):
+        '''
+        Replaces the backing store of the prediction by its packed bits. Returns the Prediction object itself.
+        '''
+
+        if not self.is_packed:
+            self.bits = self.packed_bits()
+            self._img = None
+            self.mask = None
+
+        return self
+
+    def unpack(self, bits):
+        '''
+        Unpacks (rows of) packed bits of the prediction into a new cv2 binary image (0 bg / 255 fg).
+        '''
+
+        image = np.unpackbits(bits, axis=1, count=self.shape[1])
+
+        # Map pixels from [0, 1] (binary) to [0, 255] (grayscale) in place:
+        image *= 255
+
+        return image
 
     def crop(self, polygon):
         '''
-        Crops the prediction image given a Polygon object.
+        Crops the prediction image given a Polygon object, without modifying it. The cropped prediction views the
+        bounding rectangle of the polygon (unpacking only its rows if packed), paired with the mask of the polygon.
         '''
 
-        # Crop the bounding rectangle of the polygon:
-        cropped = self.img[polygon.bbox.y0:polygon.bbox.y1, polygon.bbox.x0:polygon.bbox.x1]
+        if self.is_packed:
+            # Unpack only the rows of the bounding rectangle of the polygon, then crop its columns:
+            cropped = self.unpack(self.bits[polygon.bbox.y0:polygon.bbox.y1])[:, polygon.bbox.x0:polygon.bbox.x1]
+        else:
+            # Crop the bounding rectangle of the polygon:
+            cropped = self._img[polygon.bbox.y0:polygon.bbox.y1, polygon.bbox.x0:polygon.bbox.x1]
 
-        # Mask polygon by setting everything outside to background:
-        cropped[polygon.to_mask() == False] = 0
+        mask = polygon.to_mask()
 
-        return Prediction(cropped)
+        if self.mask is not None:
+            # Combine with mask of this prediction:
+            mask = np.logical_and(
+                mask,
+                self.mask[polygon.bbox.y0:polygon.bbox.y1, polygon.bbox.x0:polygon.bbox.x1]
+            )
+
+        return Prediction(cropped, mask)
+
+    def split_oversized(self, factor=1.5, ratio=0.5):
+        '''
+        Splits shapes (e.g. merged lines) whose height exceeds the given factor of the median height of all shapes,
+        by cutting them at the valleys of their horizontal projection profiles lower than the given ratio of their
+        maximum. Returns a new Prediction object.
+        '''
+
+        image = self.img.copy()
+
+        # Get top-level shapes with valid polygons:
+        contours = ContourSet.from_image(image, hierarchy=False).min_points(3)
+
+        if not len(contours):
+            return Prediction(image)
+
+        median = np.median(contours.bboxes[:, 3])
+
+        # Get oversized shapes:
+        oversized = np.flatnonzero(contours.bboxes[:, 3] > factor * median)
+
+        if not len(oversized):
+            return Prediction(image)
+
+        # Split bounding boxes of oversized shapes into parts at least half the median height:
+        splits = ProjectionProfiler(image).split(
+            contours.bboxes[oversized],
+            1,
+            sigma=max(1.0, median / 16),
+            ratio=ratio,
+            min_size=max(1, int(median / 2))
+        )
+
+        # Label connected shapes (as delimited by their contours), so that only the pixels of each oversized shape are
+        # cut, not the ones of other shapes within its bounding box:
+        _, labels = cv2.connectedComponents(image, connectivity=8)
+
+        # Cut shapes along the top row of each part but the first:
+        for idx, parts in zip(oversized, splits):
+            # Label of shape (of the first point of its contour):
+            x, y = contours.contours[idx][0, 0]
+            label = labels[y, x]
+
+            for part in parts[1:]:
+                row = image[part.y0, part.x0:part.x1]
+                row[labels[part.y0, part.x0:part.x1] == label] = 0
+
+        return Prediction(image)
 
     def to_binary_image(self):
         '''
-        Converts prediction image (0 bg / 255 fg) to a document binary image (0 fg / 255 bg).
+        Converts prediction image (0 bg / 255 fg) to a document binary image (0 fg / 255 bg), allocating only the
+        resulting image.
         '''
 
-        # Convert to mask:
-        mask = (self.img / 255).astype(np.bool_)
+        if self.mask is not None:
+            # Let pixels outside of mask be white (background) and invert the ones inside:
+            image = np.full(self.shape, 255, dtype=np.uint8)
+            np.subtract(255, self.view, out=image, where=self.mask)
 
-        # Let background be white and foreground black:
-        image = np.ones_like(self.img) * 255
-        image[mask == True] = 0
+            return image
 
-        return image
+        if self.is_packed:
+            # Unpack inverted bits (foreground becomes 0 and background 1), then map background to 255 in place:
+            return self.unpack(np.invert(self.bits))
+
+        # Let background be white and foreground black (255 - 255 = 0 and 255 - 0 = 255):
+        return np.subtract(255, self._img, dtype=np.uint8)
+
+class BatchPredictor:
+    '''
+    Batching layer on top of a Model object. Collects images (e.g. of several pages, regions or lines) into buckets of
+    same-shape model inputs and predicts each bucket in a single forward pass, routing each prediction back through a
+    callback.
+    '''
+
+    def __init__(self, model, max_size=None, max_latency=None):
+        '''
+        Constructs a BatchPredictor object given a Model object, the maximum number of images per bucket (defaults to
+        the batch size of the model) and the maximum time (in seconds) an image may wait in a bucket (None for
+        unbounded). The latency bound is checked on each submission and poll (see Pipeline.run for polling while
+        waiting for the next image).
+        '''
+
+        self.model = model
+        self.max_size = max(1, int(max_size or model.batch_size))
+        self.max_latency = max_latency
+
+        # Buckets of pending work items (resized image, original shape, callback, cache key and cached prediction) keyed
+        # by input shape:
+        self.buckets = OrderedDict()
+
+        # Time each bucket received its oldest pending work item:
+        self.since = {}
+
+    def submit(self, image, callback):
+        '''
+        Submits an image for prediction. The callback is called with the Prediction object of the image once its
+        bucket is flushed. Callbacks are called in submission order.
+        '''
+
+        # The split algorithm already batches the patches of an image, so predict it right away:
+        if self.model.shaping != "resize":
+            self.flush()
+            callback(self.model.predict(image))
+            return
+
+        cache = self.model.cache
+        cache_key = None
+
+        if cache is not None:
+            cache_key = cache.key(self.model, image)
+
+            # Get cached prediction, if any:
+            prediction = cache.get(cache_key)
+            if prediction is not None:
+                if not self.buckets:
+                    # Route cached prediction back right away:
+                    callback(prediction)
+                else:
+                    # Route cached prediction back along with the pending work items submitted before it:
+                    self.buckets[next(reversed(self.buckets))].append((None, image.shape, callback, None, prediction))
+
+                    # Flush buckets whose latency bound passed:
+                    self.poll()
+
+                return
+
+        # Resize image (still uint8) to input shape:
+        resized = self.model.resize_input(image)
+
+        # Add work item to the bucket of its shape:
+        key = resized.shape
+        if key not in self.buckets:
+            self.buckets[key] = []
+            self.since[key] = time.monotonic()
+        self.buckets[key].append((resized, image.shape, callback, cache_key, None))
+
+        # Flush bucket if full (of images to be predicted):
+        if sum(resized is not None for resized, _, _, _, _ in self.buckets[key]) >= self.max_size:
+            self.flush_bucket(key)
+
+        # Flush buckets whose latency bound passed:
+        self.poll()
+
+    def poll(self):
+        '''
+        Flushes the buckets whose oldest work item waited longer than the latency bound. Returns the time (in seconds)
+        until the next bucket reaches the bound, or None if there is no pending bucket (or no bound).
+        '''
+
+        if self.max_latency is None:
+            return None
+
+        now = time.monotonic()
+        for key in [key for key, since in self.since.items() if now - since >= self.max_latency]:
+            self.flush_bucket(key)
+
+        if not self.since:
+            return None
+
+        return max(0.0, min(self.since.values()) + self.max_latency - time.monotonic())
+
+    def flush_bucket(self, key):
+        '''
+        Predicts all pending work items of a bucket in a single batch and calls their callbacks in submission order
+        (along with the ones of cached predictions queued in the bucket).
+        '''
+
+        items = self.buckets.pop(key)
+        del self.since[key]
+
+        # Perform prediction on the whole bucket (but cached predictions):
+        predictions = iter(self.model.predict_inputs([
+            resized for resized, _, _, _, _ in items if resized is not None
+        ]))
+
+        for resized, image_shape, callback, cache_key, cached in items:
+            if resized is None:
+                callback(cached)
+                continue
+
+            prediction = self.model.restore_shape(next(predictions), image_shape)
+
+            if cache_key is not None:
+                self.model.cache.put(cache_key, prediction)
+
+            callback(prediction)
+
+    def flush(self):
+        '''
+        Flushes all buckets, oldest first.
+        '''
+
+        for key in list(self.buckets.keys()):
+            self.flush_bucket(key)
+
+class ModelRegistry:
+    '''
+    Process-wide registry of loaded models (inference backends), shared by the lightweight Model objects handed out to
+    their users (each with its own shaping algorithm, batch size and memory budget) and evicting the least recently
+    used ones when exceeding the count or memory limits.
+    '''
+
+    def __init__(self, max_models=4, max_memory=None):
+        '''
+        Constructs a ModelRegistry object given the maximum number of models held and the maximum memory (in bytes)
+        taken by their weights (None for unbounded).
+        '''
+
+        self.max_models = max_models
+        self.max_memory = max_memory
+
+        # Loaded models (inference backends), from least to most recently used:
+        self.backends = OrderedDict()
+
+        # Statistics:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_environment(cls):
+        '''
+        Constructs a ModelRegistry object whose limits are read from the environment: GBN_MODEL_CACHE_SIZE (maximum
+        number of models, 4 by default) and GBN_MODEL_CACHE_MEMORY (maximum memory in MiB, unbounded by default), where
+        0 stands for unbounded.
+        '''
+
+        return cls(
+            max_models=int(os.environ.get('GBN_MODEL_CACHE_SIZE', 4)) or None,
+            # Convert from MiB to bytes:
+            max_memory=int(os.environ.get('GBN_MODEL_CACHE_MEMORY', 0)) * 1024 * 1024 or None
+        )
+
+    @staticmethod
+    def fingerprint(model_path):
+        '''
+        Gets the fingerprint (size and modification time) of a model file.
+        '''
+
+        stat = os.stat(model_path)
+
+        return (stat.st_size, stat.st_mtime_ns)
+
+    @property
+    def memory(self):
+        '''
+        Estimated memory (in bytes) taken by the weights of all loaded models.
+        '''
+
+        return sum(backend.weights_size for backend in self.backends.values())
+
+    @property
+    def has_loaded_models(self):
+        '''
+        Whether any model of the registry was loaded by this process, whose tensorflow sessions would then not survive
+        forking it.
+        '''
+
+        return any(
+            not isinstance(backend, DeferredBackend) or backend.is_loaded
+            for backend in self.backends.values()
+        )
+
+    def load(self, model_path, backend="keras", cfg=None, defer=False):
+        '''
+        Gets the inference backend running the model of given path, loading it (with the given tensorflow session
+        configuration) only if there is no such loaded model in the registry. If deferred, the model is only loaded on
+        first use (see gbn.lib.backend.DeferredBackend and load_deferred).
+        '''
+
+        if backend not in BACKENDS:
+            raise ValueError("Invalid inference backend: {}".format(backend))
+
+        # Resolve path to model:
+        model_path = os.path.realpath(model_path)
+
+        # Key model by its resolved path (which differs for each precision), file fingerprint, backend, session
+        # configuration (e.g. threads) and deferral, so that models loaded with other settings are not handed out (nor
+        # models already loaded by this process to processes about to fork workers):
+        key = (
+            model_path,
+            self.fingerprint(model_path),
+            backend,
+            cfg.SerializeToString(deterministic=True) if cfg is not None else None,
+            defer
+        )
+
+        if key in self.backends:
+            # Mark model as most recently used:
+            self.backends.move_to_end(key)
+            self.hits += 1
+        else:
+            # Load model (or defer its loading):
+            if defer:
+                self.backends[key] = DeferredBackend(backend, model_path, cfg)
+            else:
+                self.backends[key] = BACKENDS[backend](model_path, cfg)
+
+            self.misses += 1
+
+            self.evict()
+
+        return self.backends[key]
+
+    def get(self, model_path, shaping, backend="keras", profile=None, defer=False, **kwargs):
+        '''
+        Gets a Model object given its path, shaping algorithm, inference backend, execution profile and further keyword
+        arguments of the Model constructor, running the model loaded (or to be loaded) by the registry (see load).
+        '''
+
+        loaded = self.load(model_path, backend, profile.to_config() if profile is not None else None, defer)
+
+        return Model(os.path.realpath(model_path), shaping, backend=loaded, profile=profile, **kwargs)
+
+    def evict(self):
+        '''
+        Evicts least recently used models until the limits are respected (the most recently used model is never
+        evicted). Model objects still running an evicted model keep it loaded until they are released.
+        '''
+
+        while len(self.backends) > 1 and (
+            (self.max_models is not None and len(self.backends) > self.max_models) or
+            (self.max_memory is not None and self.memory > self.max_memory)
+        ):
+            self.backends.popitem(last=False)
+            self.evictions += 1
+
+    def load_deferred(self, intra_op_threads=0, inter_op_threads=0):
+        '''
+        Loads all models whose loading was deferred in tensorflow sessions with the given parallelism (0 for
+        tensorflow's default). Meant to be called in forked processes, whose parent deferred the loading of its models
+        so that it never started tensorflow.
+        '''
+
+        cfg = ExecutionProfile(intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads).to_config()
+
+        for backend in self.backends.values():
+            if isinstance(backend, DeferredBackend):
+                backend.load(cfg)
+
+    def clear(self):
+        '''
+        Evicts all models.
+        '''
+
+        self.evictions += len(self.backends)
+        self.backends.clear()
+
+    def __str__(self):
+        return "{} model(s) loaded, {} load(s) avoided, {} eviction(s)".format(
+            len(self.backends),
+            self.hits,
+            self.evictions
+        )
+
+# Default process-wide registry (limits read from the environment):
+model_registry = ModelRegistry.from_environment()
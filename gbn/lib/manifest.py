@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+
+class Manifest:
+    '''
+    Checkpoint manifest of the pages processed into an output file group. Records, for each page, a key hashing all
+    inputs its outputs depend on (input files, parameters and models) and the files written for it, so that an
+    interrupted or repeated run can skip the pages whose outputs are up to date.
+    '''
+
+    def __init__(self, path):
+        '''
+        Constructs a Manifest object given the path of its (JSON) file, loading the pages already recorded in it.
+        '''
+
+        self.path = path
+
+        try:
+            with open(path, 'r') as fp:
+                self.entries = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            # No (or unreadable) manifest, nothing is up to date:
+            self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(values=(), paths=()):
+        '''
+        Gets the key of a page from a sequence of strings and the contents of a sequence of files (missing files are
+        hashed by their paths).
+        '''
+
+        digest = hashlib.blake2b(digest_size=20)
+
+        for value in values:
+            digest.update(value.encode('utf-8'))
+            digest.update(b'\0')
+
+        for path in paths:
+            try:
+                with open(path, 'rb') as fp:
+                    # Hash file in chunks (page images may be large):
+                    for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+                        digest.update(chunk)
+            except OSError:
+                digest.update(path.encode('utf-8'))
+
+            digest.update(b'\0')
+
+        return digest.hexdigest()
+
+    def get(self, page_id, key, directory):
+        '''
+        Gets the files recorded for a page if its key matches the given one and all of them still exist (with their
+        recorded sizes) relative to the given directory, or None otherwise.
+        '''
+
+        entry = self.entries.get(page_id)
+
+        if entry is None or entry['key'] != key:
+            return None
+
+        for file in entry['files']:
+            try:
+                if os.path.getsize(os.path.join(directory, file['local_filename'])) != file['size']:
+                    return None
+            except OSError:
+                return None
+
+        return entry['files']
+
+    def record(self, page_id, key, files):
+        '''
+        Records the key of a page and the files written for it (dicts of METS attributes, local file name and size),
+        saving the manifest right away.
+        '''
+
+        self.entries[page_id] = {'key': key, 'files': files}
+
+        self.save()
+
+    def save(self):
+        '''
+        Saves the manifest atomically, so that it is never left partially written (e.g. when interrupted).
+        '''
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        with open(self.path + ".tmp", 'w') as fp:
+            json.dump(self.entries, fp, indent=1, sort_keys=True)
+
+            # Ensure content is on disk before replacing the previous manifest:
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,125 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+class Pipeline:
+    '''
+    Staged producer/consumer pipeline. Items are loaded by a pool of threads ahead of their processing, processed in
+    order by the calling thread and their results written in order by a background thread, through bounded queues.
+    '''
+
+    # Marks the end of the results to be written:
+    _end = object()
+
+    def __init__(self, load, process, write, workers=1, depth=0):
+        '''
+        Constructs a Pipeline object given its stages and the number of loading threads. The load stage maps an item to
+        a context, the process stage receives a context and a function for emitting results (not necessarily right
+        away) and the write stage receives each emitted result. The depth is the maximum number of items loaded ahead
+        and of results waiting to be written (0 for running all stages sequentially in the calling thread).
+        '''
+
+        self.load = load
+        self.process = process
+        self.write = write
+        self.workers = max(1, workers)
+        self.depth = max(0, depth)
+
+    def run(self, items, finish=None, poll=None):
+        '''
+        Runs the given items through the pipeline. The finish function, if any, is called (in the calling thread) after
+        the last item has been processed, e.g. for emitting any held back results. The poll function, if any, is called
+        (in the calling thread) while waiting for the next item to be loaded, e.g. for emitting results held back for
+        too long, and returns the time (in seconds) until it is due again or None for not calling it until the next
+        item. When running sequentially, it is only called before loading each item.
+        '''
+
+        if self.depth == 0:
+            for item in items:
+                if poll is not None:
+                    poll()
+
+                self.process(self.load(item), self.write)
+
+            if finish is not None:
+                finish()
+
+            return
+
+        # Bounded queue of results to be written:
+        results = queue.Queue(maxsize=self.depth)
+
+        # Errors raised by the write stage:
+        errors = []
+
+        def drain():
+            while True:
+                result = results.get()
+
+                if result is self._end:
+                    break
+
+                # Discard remaining results after an error:
+                if errors:
+                    continue
+
+                try:
+                    self.write(result)
+                except BaseException as error:
+                    errors.append(error)
+
+        def emit(result):
+            # Fail early if the write stage failed:
+            if errors:
+                raise errors[0]
+
+            results.put(result)
+
+        writer = threading.Thread(target=drain, name="PipelineWriter", daemon=True)
+        writer.start()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="PipelineLoader") as executor:
+                items = iter(items)
+                pending = deque()
+
+                def prefetch():
+                    # Keep up to depth items being loaded ahead:
+                    while len(pending) < self.depth:
+                        try:
+                            pending.append(executor.submit(self.load, next(items)))
+                        except StopIteration:
+                            break
+
+                try:
+                    prefetch()
+
+                    while pending:
+                        future = pending.popleft()
+
+                        # Keep polling while the next item is being loaded, as long as polls are due:
+                        timeout = poll() if poll is not None else None
+                        while timeout is not None and not future.done():
+                            wait([future], timeout=timeout)
+                            timeout = poll()
+
+                        context = future.result()
+
+                        prefetch()
+
+                        self.process(context, emit)
+
+                    if finish is not None:
+                        finish()
+                finally:
+                    # Do not load any further items after an error:
+                    for future in pending:
+                        future.cancel()
+        finally:
+            # Wait for the remaining results to be written:
+            results.put(self._end)
+            writer.join()
+
+        if errors:
+            raise errors[0]
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import tensorflow as tf
+
+from gbn.lib.util import set_opencv_threads
+
+class ExecutionProfile:
+    '''
+    Threading and batching settings for running a model on the CPU. Settings equal to 0 are left to the libraries
+    (tensorflow and OpenCV) or to the caller (batch size).
+    '''
+
+    def __init__(self, intra_op_threads=0, inter_op_threads=0, opencv_threads=0, batch_size=0):
+        '''
+        Constructs an ExecutionProfile object given the number of threads of tensorflow (intra-op and inter-op
+        parallelism) and OpenCV, and the number of model inputs per forward pass.
+        '''
+
+        self.intra_op_threads = int(intra_op_threads)
+        self.inter_op_threads = int(inter_op_threads)
+        self.opencv_threads = int(opencv_threads)
+        self.batch_size = int(batch_size)
+
+    def to_dict(self):
+        return {
+            'intra_op_threads': self.intra_op_threads,
+            'inter_op_threads': self.inter_op_threads,
+            'opencv_threads': self.opencv_threads,
+            'batch_size': self.batch_size
+        }
+
+    def __eq__(self, other):
+        return isinstance(other, ExecutionProfile) and self.to_dict() == other.to_dict()
+
+    def __hash__(self):
+        return hash(tuple(sorted(self.to_dict().items())))
+
+    def __repr__(self):
+        return "ExecutionProfile({})".format(", ".join("{}={}".format(*item) for item in self.to_dict().items()))
+
+    def merge(self, fallback):
+        '''
+        Gets a new ExecutionProfile object whose unset (0) settings are taken from the given fallback profile.
+        '''
+
+        if fallback is None:
+            return self
+
+        return ExecutionProfile(**{
+            name: value or getattr(fallback, name) for name, value in self.to_dict().items()
+        })
+
+    def to_config(self):
+        '''
+        Converts profile to a tensorflow session configuration (allowing GPU growth). Sessions with set threads get
+        thread pools of their own, since the process-wide pools are sized once, by the first session of the process.
+        '''
+
+        cfg = tf.ConfigProto(
+            intra_op_parallelism_threads=self.intra_op_threads,
+            inter_op_parallelism_threads=self.inter_op_threads,
+            use_per_session_threads=bool(self.intra_op_threads or self.inter_op_threads)
+        )
+        cfg.gpu_options.allow_growth = True
+
+        return cfg
+
+    def apply(self):
+        '''
+        Applies the process-wide settings of the profile (OpenCV threads).
+        '''
+
+        if self.opencv_threads:
+            set_opencv_threads(self.opencv_threads)
+
+    @staticmethod
+    def cache_path(model_path, shaping, backend):
+        '''
+        Gets the path of the cached profile of a model file (given its shaping algorithm and inference backend).
+        '''
+
+        # Cache directory following the XDG base directory specification:
+        cache_dir = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), ".cache"),
+            "ocrd-gbn",
+            "profiles"
+        )
+
+        # Key profile by resolved path and fingerprint (size and modification time) of the model file:
+        model_path = os.path.realpath(model_path)
+        stat = os.stat(model_path)
+        key = "{}:{}:{}:{}:{}".format(model_path, stat.st_size, stat.st_mtime_ns, shaping, backend)
+
+        return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + ".json")
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Loads a profile from a JSON file, returning None if there is none.
+        '''
+
+        try:
+            with open(path, 'r') as fp:
+                return cls(**json.load(fp))
+        except FileNotFoundError:
+            return None
+
+    def save(self, path):
+        '''
+        Saves the profile to a JSON file.
+        '''
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first, so readers never see a partial profile:
+        with open(path + ".tmp", 'w') as fp:
+            json.dump(self.to_dict(), fp, indent=2)
+
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,72 @@
+import os
+import numpy as np
+import tensorflow as tf
+
+# Available precisions of models (float32 is the precision of the original Keras models):
+PRECISIONS = ("float32", "float16", "dynamic", "int8")
+
+def quantized_path(model_path, precision):
+    '''
+    Gets the path of the reduced-precision (TFLite) artifact of a Keras model, next to the model file.
+    '''
+
+    return "{}.{}.tflite".format(os.path.splitext(model_path)[0], precision)
+
+def calibration_inputs(model, images, max_inputs=256):
+    '''
+    Gets up to the given number of model input tensors (float32) from a sequence of cv2 images, the way a Model object
+    feeds them to its model (resized images or patches).
+    '''
+
+    inputs = []
+
+    for image in images:
+        # View image with channels fitting the model:
+        image = model.fit_channels(image)
+
+        if model.shaping == "resize":
+            patches = [model.resize_input(image)]
+        else:
+            # Patches of the image not overlapping each other (remaining borders are ignored):
+            height, width = model.input_shape[1], model.input_shape[2]
+            patches = [
+                image[y:y+height, x:x+width]
+                for y in range(0, image.shape[0] - height + 1, height)
+                for x in range(0, image.shape[1] - width + 1, width)
+            ]
+
+        for patch in patches:
+            if len(inputs) == max_inputs:
+                return inputs
+
+            inputs.append((np.broadcast_to(patch, model.input_shape[1:]) / 255.0).astype(np.float32).reshape(model.input_shape))
+
+    return inputs
+
+def quantize(model, precision, images=()):
+    '''
+    Converts the Keras model of a Model object to a TFLite model of given precision, returning its content. Weights
+    are stored as float16 (float16), weights are quantized to int8 while activations stay float (dynamic) or both
+    weights and activations are quantized to int8, calibrated on model inputs taken from the given cv2 images (int8).
+    '''
+
+    if precision not in PRECISIONS:
+        raise ValueError("Invalid precision: {}".format(precision))
+
+    converter = tf.lite.TFLiteConverter.from_keras_model_file(model.model_path)
+
+    if precision == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif precision == "dynamic":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif precision == "int8":
+        inputs = calibration_inputs(model, images)
+
+        if not inputs:
+            raise ValueError("Quantizing to int8 requires images for calibrating the activations")
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([tensor] for tensor in inputs)
+
+    return converter.convert()
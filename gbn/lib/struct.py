@@ -54,19 +54,22 @@ class Polygon:
     Represents a polygon.
     '''
 
-    def __init__(self, points):
+    def __init__(self, points, bbox=None):
         '''
-        Constructs a Polygon object from a list of points.
+        Constructs a Polygon object from a list of points and, optionally, its already known bounding box.
         '''
 
         self.points = points
 
-        # Extract bounding box of polygon:
-        self.bbox = BoundingBox.from_polygon(self)
+        # Extract bounding box of polygon (if not given):
+        self.bbox = bbox if bbox is not None else BoundingBox.from_polygon(self)
 
         # Map points to origin (x0 == 0, y0 == 0):
         self.mapped_points = np.stack((self.points[:, 0] - self.bbox.x0, self.points[:, 1] - self.bbox.y0), axis=1)
 
+        # Mask of polygon (drawn on first use):
+        self.mask = None
+
     def is_valid(self):
         '''
         Checks the validity of the polygon.
@@ -76,19 +79,22 @@ class Polygon:
 
     def to_mask(self):
         '''
-        Converts polygon to mask.
+        Converts polygon to mask (bool array with the shape of its bounding box). The mask is drawn once and shared by
+        all callers, so it is read-only.
         '''
 
-        # Create a background canvas with the shape of the polygon's bounding box:
-        canvas = np.zeros((self.bbox.height, self.bbox.width), dtype=np.uint8)
+        if self.mask is None:
+            # Create a background canvas with the shape of the polygon's bounding box:
+            canvas = np.zeros((self.bbox.height, self.bbox.width), dtype=np.uint8)
 
-        # Draw polygon on background canvas:
-        mask = cv2.fillPoly(canvas, np.int32([self.mapped_points]), 1)
+            # Draw polygon on background canvas:
+            cv2.fillPoly(canvas, np.int32([self.mapped_points]), 1)
 
-        # Convert array to boolean:
-        mask = mask.astype(np.bool_)
+            # View array (of zeros and ones) as boolean:
+            self.mask = canvas.view(np.bool_)
+            self.mask.flags.writeable = False
 
-        return mask
+        return self.mask
 
 class Contour:
     '''
@@ -113,11 +119,16 @@ class Contour:
         self.polygon = Polygon(self.contour.reshape(self.contour.shape[0], self.contour.shape[2]))
 
     @classmethod
-    def from_image(self, image):
+    def from_image(self, image, mask=None):
         '''
-        Retrieves the image contours and wraps them in Contour objects.
+        Retrieves the image contours and wraps them in Contour objects. If a mask (bool array with the shape of the
+        image) is given, pixels outside of it are considered background, without modifying the image.
         '''
 
+        if mask is not None:
+            # Get masked image into a new array (viewing mask as uint8 for OpenCV):
+            image = cv2.bitwise_and(image, image, mask=mask.view(np.uint8))
+
         # Get contours and their respective hierarchy information:
         contours, hierarchy = cv2.findContours(image, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
 
@@ -141,6 +152,521 @@ class Contour:
 
         return self.parent != -1
 
+class ContourSet:
+    '''
+    Set of cv2 contours of an image whose hierarchy, areas and bounding boxes are held in arrays, so that they can be
+    filtered without wrapping each contour in an object. Polygons are only built for the contours actually used.
+    '''
+
+    def __init__(self, contours, hierarchy=None):
+        '''
+        Constructs a ContourSet object from a sequence of cv2 contours and their hierarchy (array of shape (N, 4), as
+        returned by cv2.findContours without the redundant axis 0). Without hierarchy, all contours are top-level.
+        '''
+
+        self.contours = list(contours)
+
+        if hierarchy is None:
+            # Top-level contours only (no next, previous, first child nor parent):
+            hierarchy = np.full((len(self.contours), 4), -1, dtype=np.int32)
+
+        self.hierarchy = hierarchy
+
+        # Number of points of each contour:
+        self.lengths = np.array([len(cnt) for cnt in self.contours], dtype=np.intp)
+
+        if self.contours:
+            # All points of all contours, contour after contour:
+            points = np.concatenate(self.contours).reshape(-1, 2).astype(np.int64)
+            x = points[:, 0]
+            y = points[:, 1]
+
+            # Index of the first point of each contour:
+            starts = np.concatenate(([0], np.cumsum(self.lengths)[:-1]))
+
+            # Index of the point following each point along its (closed) contour:
+            following = np.arange(1, len(points) + 1)
+            following[starts + self.lengths - 1] = starts
+
+            # Areas through the shoelace formula (as cv2.contourArea):
+            cross = x * y[following] - x[following] * y
+            self.areas = np.abs(np.add.reduceat(cross, starts)) / 2.0
+
+            # Bounding boxes (x, y, width, height, as cv2.boundingRect):
+            x0 = np.minimum.reduceat(x, starts)
+            y0 = np.minimum.reduceat(y, starts)
+            self.bboxes = np.stack((
+                x0,
+                y0,
+                np.maximum.reduceat(x, starts) - x0 + 1,
+                np.maximum.reduceat(y, starts) - y0 + 1
+            ), axis=1)
+        else:
+            self.areas = np.zeros(0)
+            self.bboxes = np.zeros((0, 4), dtype=np.int64)
+
+        # Polygons built so far, by index of their contour:
+        self.polygons = {}
+
+    @classmethod
+    def from_image(cls, image, mask=None, hierarchy=True):
+        '''
+        Retrieves the image contours into a ContourSet object. Without hierarchy, only the top-level contours are
+        retrieved (cv2.RETR_EXTERNAL), which is faster than retrieving all of them and then filtering the top-level
+        ones. If a mask (bool array with the shape of the image) is given, pixels outside of it are considered
+        background, without modifying the image.
+        '''
+
+        if mask is not None:
+            # Get masked image into a new array (viewing mask as uint8 for OpenCV):
+            image = cv2.bitwise_and(image, image, mask=mask.view(np.uint8))
+
+        # Get contours and, if needed, their respective hierarchy information:
+        contours, tree = cv2.findContours(
+            image,
+            cv2.RETR_TREE if hierarchy else cv2.RETR_EXTERNAL,
+            cv2.CHAIN_APPROX_SIMPLE
+        )
+
+        if hierarchy and contours:
+            # Remove redundant axis 0:
+            return cls(contours, tree.reshape(tree.shape[1], tree.shape[2]))
+
+        return cls(contours)
+
+    def __len__(self):
+        return len(self.contours)
+
+    def subset(self, indices):
+        '''
+        Gets a new ContourSet object with the contours of given indices (in that order). Hierarchy links keep referring
+        to the contours of the image.
+        '''
+
+        subset = ContourSet.__new__(ContourSet)
+
+        subset.contours = [self.contours[idx] for idx in indices]
+        subset.hierarchy = self.hierarchy[indices]
+        subset.lengths = self.lengths[indices]
+        subset.areas = self.areas[indices]
+        subset.bboxes = self.bboxes[indices]
+
+        # Keep polygons already built:
+        subset.polygons = {
+            new_idx: self.polygons[idx] for new_idx, idx in enumerate(indices) if idx in self.polygons
+        }
+
+        return subset
+
+    def top_level(self):
+        '''
+        Filters out child contours.
+        '''
+
+        return self.subset(np.flatnonzero(self.hierarchy[:, 3] == -1))
+
+    def min_points(self, count=3):
+        '''
+        Filters out contours with less than the given number of points (by default, the ones without a valid polygon).
+        '''
+
+        return self.subset(np.flatnonzero(self.lengths >= count))
+
+    def min_area(self, area):
+        '''
+        Filters out contours whose area is less than the given one.
+        '''
+
+        return self.subset(np.flatnonzero(self.areas >= area))
+
+    def top_k(self, k):
+        '''
+        Keeps the k contours with largest area, from largest to smallest (ties are resolved to the last contour, as
+        when taking the last ones after a stable ascending sort).
+        '''
+
+        # Stable sort by descending area, with ties in reverse order:
+        order = np.argsort(-self.areas[::-1], kind='stable')[:k]
+
+        return self.subset(len(self) - 1 - order)
+
+    def translate(self, x, y):
+        '''
+        Gets a new ContourSet object with all contours translated by the given offset.
+        '''
+
+        offset = np.array([[[x, y]]], dtype=np.int32)
+
+        translated = self.subset(np.arange(len(self)))
+        translated.contours = [cnt + offset for cnt in self.contours]
+        translated.bboxes = self.bboxes + np.array([x, y, 0, 0])
+        translated.polygons = {}
+
+        return translated
+
+    def simplify(self, method, tolerance=1.0):
+        '''
+        Gets a new ContourSet object with all contours simplified by the given method: Douglas-Peucker with the given
+        tolerance in pixels ('dp'), convex hull ('hull'), minimum-area rectangle (clipped to the bounding box of the
+        contour, 'rect') or none ('none'). Contours may end up with less than 3 points (see min_points).
+        '''
+
+        if method == "none":
+            return self
+        elif method == "dp":
+            contours = [cv2.approxPolyDP(cnt, tolerance, True) for cnt in self.contours]
+        elif method == "hull":
+            contours = [cv2.convexHull(cnt) for cnt in self.contours]
+        elif method == "rect":
+            # Corners of the rectangles of all contours, clipped to their bounding boxes:
+            corners = np.array([cv2.boxPoints(cv2.minAreaRect(cnt)) for cnt in self.contours]).reshape(-1, 4, 2)
+            corners = np.clip(
+                np.rint(corners),
+                self.bboxes[:, None, :2],
+                self.bboxes[:, None, :2] + self.bboxes[:, None, 2:] - 1
+            ).astype(np.int32)
+
+            contours = list(corners.reshape(-1, 4, 1, 2))
+        else:
+            raise ValueError("Invalid simplification method: {}".format(method))
+
+        return ContourSet(contours, self.hierarchy)
+
+    @classmethod
+    def concatenate(cls, contour_sets):
+        '''
+        Gets a new ContourSet object with the contours of a sequence of ContourSet objects, one after the other.
+        '''
+
+        contour_sets = list(contour_sets)
+
+        return cls(
+            [cnt for contour_set in contour_sets for cnt in contour_set.contours],
+            np.concatenate([contour_set.hierarchy for contour_set in contour_sets]) if contour_sets else None
+        )
+
+    def points(self):
+        '''
+        Gets the points of all contours, contour after contour, in an array of shape (N, 2).
+        '''
+
+        if not self.contours:
+            return np.zeros((0, 2), dtype=np.int32)
+
+        return np.concatenate(self.contours).reshape(-1, 2)
+
+    def polygon(self, idx):
+        '''
+        Gets the Polygon object of the contour of given index (built on first use).
+        '''
+
+        if idx not in self.polygons:
+            cnt = self.contours[idx]
+
+            # Remove redundant axis 1 and wrap contour in Polygon object:
+            self.polygons[idx] = Polygon(
+                cnt.reshape(cnt.shape[0], cnt.shape[2]),
+                bbox=BoundingBox(self.bboxes[idx].tolist())
+            )
+
+        return self.polygons[idx]
+
+    def __iter__(self):
+        '''
+        Iterates over the Polygon objects of the contours.
+        '''
+
+        for idx in range(len(self)):
+            yield self.polygon(idx)
+
+class RegionLabelMap:
+    '''
+    Label map of region polygons rasterized on an image, for assigning the shapes of another image (e.g. lines) to
+    the regions in a single pass over its pixels.
+    '''
+
+    def __init__(self, polygons, shape):
+        '''
+        Constructs a RegionLabelMap object from a sequence of Polygon objects and the shape of the image. Pixels of
+        region i are labeled i + 1 (where regions overlap, the last one wins) and pixels outside all regions 0.
+        '''
+
+        self.polygons = list(polygons)
+
+        self.labels = np.zeros(shape[:2], dtype=np.int32)
+        for idx, polygon in enumerate(self.polygons):
+            cv2.fillPoly(self.labels, np.int32([polygon.points]), idx + 1)
+
+    def assign(self, image, relative=True):
+        '''
+        Assigns the connected components of an image to the regions they overlap the most. Returns a ContourSet
+        object per region with the top-level contours of its components, relative to the bounding box of the region
+        (if relative) or to the image.
+        '''
+
+        regions = len(self.polygons)
+
+        if not regions:
+            return []
+
+        # Label connected components of image (as the top-level contours, 8-connected):
+        components, labels = cv2.connectedComponents(image, connectivity=8, ltype=cv2.CV_32S)
+
+        # Count overlapping pixels of each component (rows) with each region (columns, 0 for no region):
+        overlap = (labels > 0) & (self.labels > 0)
+        counts = np.bincount(
+            labels[overlap].astype(np.int64) * (regions + 1) + self.labels[overlap],
+            minlength=components * (regions + 1)
+        ).reshape(components, regions + 1)
+
+        # Get region of most overlap of each component (0 for none):
+        assignment = np.argmax(counts[:, 1:], axis=1) + 1
+        assignment[counts[:, 1:].max(axis=1) == 0] = 0
+
+        # Find top-level contours of image (all at once):
+        contours = ContourSet.from_image(image, hierarchy=False)
+
+        # Get region of each contour from the component of its first point:
+        if len(contours):
+            first = np.array([cnt[0, 0] for cnt in contours.contours])
+            contour_regions = assignment[labels[first[:, 1], first[:, 0]]]
+        else:
+            contour_regions = np.zeros(0, dtype=np.intp)
+
+        assigned = [contours.subset(np.flatnonzero(contour_regions == idx + 1)) for idx in range(regions)]
+
+        if relative:
+            assigned = [
+                contours.translate(-polygon.bbox.x0, -polygon.bbox.y0)
+                for contours, polygon in zip(assigned, self.polygons)
+            ]
+
+        return assigned
+
+class BoxIndex:
+    '''
+    Spatial index (uniform grid) over bounding boxes (e.g. of the contours of a page), answering overlap, containment
+    and nearest neighbour queries without comparing every pair of boxes.
+    '''
+
+    def __init__(self, bboxes, cell_size=None):
+        '''
+        Constructs a BoxIndex object by bulk loading an array of shape (N, 4) of bounding boxes (x, y, width, height, as
+        ContourSet.bboxes) into a grid of square cells of given size (by default, twice the median box side).
+        '''
+
+        self.bboxes = np.asarray(bboxes, dtype=np.int64).reshape(-1, 4)
+
+        # Boundaries of boxes ([x0, x1[ and [y0, y1[, as BoundingBox):
+        self.x0 = self.bboxes[:, 0]
+        self.y0 = self.bboxes[:, 1]
+        self.x1 = self.x0 + self.bboxes[:, 2]
+        self.y1 = self.y0 + self.bboxes[:, 3]
+
+        if cell_size is None:
+            cell_size = 2 * np.median(self.bboxes[:, 2:]) if len(self.bboxes) else 1
+
+        self.cell_size = max(1, int(cell_size))
+
+        # Origin and number of columns and rows of the grid:
+        if len(self.bboxes):
+            self.origin = (int(self.x0.min()), int(self.y0.min()))
+            self.columns = int((self.x1.max() - self.origin[0]) // self.cell_size + 1)
+            self.rows = int((self.y1.max() - self.origin[1]) // self.cell_size + 1)
+        else:
+            self.origin = (0, 0)
+            self.columns = self.rows = 1
+
+        # Range of cells covered by each box (inclusive):
+        self.cx0, self.cy0, cx1, cy1 = self.cells(self.x0, self.y0, self.x1, self.y1)
+
+        # Enumerate the cells covered by all boxes at once:
+        boxes, cells = self.cover(self.cx0, self.cy0, cx1, cy1)
+
+        # Group boxes by cell, row-major (boxes of cell i are entries[starts[i]:starts[i + 1]]):
+        order = np.argsort(cells, kind='stable')
+        self.entries = boxes[order]
+        self.starts = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=self.rows * self.columns))])
+
+        # Offsets of the cell of each entry from the first cell of its box (for reporting each box once):
+        cells = cells[order]
+        self.entry_dx = cells % self.columns - self.cx0[self.entries]
+        self.entry_dy = cells // self.columns - self.cy0[self.entries]
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def cells(self, x0, y0, x1, y1):
+        '''
+        Gets the range of cells (first and last column and row) covered by the given boundaries, clipped to the grid.
+        '''
+
+        return (
+            np.clip((x0 - self.origin[0]) // self.cell_size, 0, self.columns - 1),
+            np.clip((y0 - self.origin[1]) // self.cell_size, 0, self.rows - 1),
+            np.clip((np.maximum(x1, x0 + 1) - 1 - self.origin[0]) // self.cell_size, 0, self.columns - 1),
+            np.clip((np.maximum(y1, y0 + 1) - 1 - self.origin[1]) // self.cell_size, 0, self.rows - 1)
+        )
+
+    def cover(self, cx0, cy0, cx1, cy1):
+        '''
+        Enumerates the cells covered by ranges of cells, returning the index of the range and the cell (row-major) of
+        each covered cell.
+        '''
+
+        widths = cx1 - cx0 + 1
+        counts = widths * (cy1 - cy0 + 1)
+        owners = np.repeat(np.arange(len(counts)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        return owners, (cy0[owners] + offsets // widths[owners]) * self.columns + cx0[owners] + offsets % widths[owners]
+
+    def candidates(self, x0, y0, x1, y1):
+        '''
+        Gets the indices of the boxes sharing a cell with the given boundaries (each once).
+        '''
+
+        # Range of covered cells (as cells, with scalar arithmetic):
+        cx0 = min(max((x0 - self.origin[0]) // self.cell_size, 0), self.columns - 1)
+        cy0 = min(max((y0 - self.origin[1]) // self.cell_size, 0), self.rows - 1)
+        cx1 = min(max((max(x1, x0 + 1) - 1 - self.origin[0]) // self.cell_size, 0), self.columns - 1)
+        cy1 = min(max((max(y1, y0 + 1) - 1 - self.origin[1]) // self.cell_size, 0), self.rows - 1)
+
+        # Entries of the covered cells are contiguous within each row of the grid:
+        starts = self.starts
+        ranges = [
+            (starts[row + cx0], starts[row + cx1 + 1])
+            for row in range(cy0 * self.columns, cy1 * self.columns + 1, self.columns)
+        ]
+
+        if len(ranges) == 1:
+            lo, hi = ranges[0]
+            boxes, dx, dy = self.entries[lo:hi], self.entry_dx[lo:hi], self.entry_dy[lo:hi]
+
+            # Boxes occupy a single cell at most once:
+            if cx0 == cx1:
+                return boxes
+        else:
+            boxes = np.concatenate([self.entries[lo:hi] for lo, hi in ranges])
+            dx = np.concatenate([self.entry_dx[lo:hi] for lo, hi in ranges])
+            dy = np.concatenate([self.entry_dy[lo:hi] for lo, hi in ranges])
+
+        # Keep each box only in the first covered cell it occupies (its first cell or the first row/column covered):
+        first = (
+            ((dx == 0) | (self.cx0[boxes] + dx == cx0)) &
+            ((dy == 0) | (self.cy0[boxes] + dy == cy0))
+        )
+
+        return boxes[first]
+
+    def pairs(self, bboxes):
+        '''
+        Gets the pairs of intersecting boxes between an array of shape (M, 4) of bounding boxes (as ContourSet.bboxes,
+        e.g. of regions) and the indexed ones (e.g. of lines) at once, as arrays of indices into both (grouped by the
+        given boxes).
+        '''
+
+        bboxes = np.asarray(bboxes, dtype=np.int64).reshape(-1, 4)
+
+        x0, y0 = bboxes[:, 0], bboxes[:, 1]
+        x1, y1 = x0 + bboxes[:, 2], y0 + bboxes[:, 3]
+
+        # Enumerate the cells covered by all given boxes:
+        cx0, cy0, cx1, cy1 = self.cells(x0, y0, x1, y1)
+        queries, cells = self.cover(cx0, cy0, cx1, cy1)
+
+        # Enumerate the entries of these cells:
+        lo = self.starts[cells]
+        counts = self.starts[cells + 1] - lo
+        positions = np.arange(counts.sum()) + np.repeat(lo - (np.cumsum(counts) - counts), counts)
+        queries = np.repeat(queries, counts)
+        boxes = self.entries[positions]
+
+        # Keep each pair only in the first cell both boxes cover:
+        dx, dy = self.entry_dx[positions], self.entry_dy[positions]
+        first = (
+            ((dx == 0) | (self.cx0[boxes] + dx == cx0[queries])) &
+            ((dy == 0) | (self.cy0[boxes] + dy == cy0[queries]))
+        )
+        queries, boxes = queries[first], boxes[first]
+
+        # Keep intersecting pairs:
+        intersecting = (
+            (self.x0[boxes] < x1[queries]) & (x0[queries] < self.x1[boxes]) &
+            (self.y0[boxes] < y1[queries]) & (y0[queries] < self.y1[boxes])
+        )
+        return queries[intersecting], boxes[intersecting]
+
+    def intersecting(self, bbox):
+        '''
+        Gets the indices of the boxes intersecting the given BoundingBox object (e.g. lines intersecting a region).
+        '''
+
+        idx = self.candidates(bbox.x0, bbox.y0, bbox.x1, bbox.y1)
+
+        return np.sort(idx[
+            (self.x0[idx] < bbox.x1) & (bbox.x0 < self.x1[idx]) &
+            (self.y0[idx] < bbox.y1) & (bbox.y0 < self.y1[idx])
+        ])
+
+    def within(self, bbox):
+        '''
+        Gets the indices of the boxes lying entirely inside the given BoundingBox object.
+        '''
+
+        idx = self.candidates(bbox.x0, bbox.y0, bbox.x1, bbox.y1)
+
+        return np.sort(idx[
+            (self.x0[idx] >= bbox.x0) & (self.x1[idx] <= bbox.x1) &
+            (self.y0[idx] >= bbox.y0) & (self.y1[idx] <= bbox.y1)
+        ])
+
+    def outside(self, bbox):
+        '''
+        Gets the indices of the boxes not intersecting the given BoundingBox object (e.g. regions outside the Border).
+        '''
+
+        outside = np.ones(len(self.bboxes), dtype=np.bool_)
+        outside[self.intersecting(bbox)] = False
+
+        return np.flatnonzero(outside)
+
+    def distances(self, idx, x, y):
+        '''
+        Gets the distances from a point to the boxes of given indices (0 for boxes containing it).
+        '''
+
+        dx = np.maximum(np.maximum(self.x0[idx] - x, x - (self.x1[idx] - 1)), 0)
+        dy = np.maximum(np.maximum(self.y0[idx] - y, y - (self.y1[idx] - 1)), 0)
+
+        return np.hypot(dx, dy)
+
+    def nearest(self, x, y, k=1):
+        '''
+        Gets the indices of the k boxes nearest to a point, from nearest to farthest.
+        '''
+
+        k = min(k, len(self.bboxes))
+
+        if not k:
+            return np.zeros(0, dtype=np.intp)
+
+        radius = self.cell_size
+
+        while True:
+            # Get boxes around the point:
+            idx = self.candidates(x - radius, y - radius, x + radius + 1, y + radius + 1)
+
+            if len(idx) >= k:
+                distances = self.distances(idx, x, y)
+                order = np.argsort(distances, kind='stable')[:k]
+
+                # Any box at most as far as the k-th nearest candidate shares a cell with the searched square:
+                if distances[order[-1]] <= radius or len(idx) == len(self.bboxes):
+                    return idx[order]
+
+            radius *= 2
+
 class Projection:
     '''
     Represents a projection of the foreground pixels of an image (for projection profiling).
@@ -153,19 +679,19 @@ class Projection:
         self.signal = signal
 
     @classmethod
-    def from_image(image, axis, sigma=3):
+    def from_image(cls, image, axis, sigma=3):
         '''
         Constructs a projection object from the signal obtained by projecting the given image along given axis and 
         smoothing it through an 1D Gaussian filter with given sigma.
         '''
 
         # Count the foreground pixels along axis:
-        signal = (image / 255).astype(np.int).sum(axis=axis)
+        signal = np.count_nonzero(image, axis=axis).astype(np.float64)
 
         # Smooth the resulting signal:
         signal = gaussian_filter1d(signal, sigma)
 
-        return Projection(signal)
+        return cls(signal)
 
     def find_valleys(self):
         '''
@@ -177,21 +703,127 @@ class Projection:
 
         return self.valleys
 
+    def find_cuts(self, ratio=0.5, min_size=1):
+        '''
+        Retrieves the valleys of the projection curve deep enough for splitting it: lower than the given ratio of its
+        maximum and leaving at least min_size points between consecutive cuts and the ends of the curve.
+        '''
+
+        valleys = self.find_valleys()
+
+        # Keep deep valleys far enough from the ends:
+        valleys = valleys[
+            (self.signal[valleys] < ratio * self.signal.max()) &
+            (valleys >= min_size) &
+            (valleys <= len(self.signal) - min_size)
+        ]
+
+        # Keep valleys far enough from the previously kept one (from the deepest first):
+        cuts = []
+        for valley in valleys[np.argsort(self.signal[valleys], kind='stable')]:
+            if all(abs(valley - cut) >= min_size for cut in cuts):
+                cuts.append(valley)
+
+        return np.sort(np.array(cuts, dtype=np.intp))
+
     def split_continuous_intervals(self):
         '''
-        Splits projection into its continuous parts.
+        Splits projection into its continuous (non-zero) parts. Returns a list of intervals (start, end) representing
+        the intervals [start, end[ of the projection (see BoundingBox.split).
         '''
 
         # Get indices of non-zero points of the projection:
-        nonzero = np.nonzero(self.signal)
+        nonzero = np.flatnonzero(self.signal)
 
         # Split consecutive indices (continuous regions) - Based on https://stackoverflow.com/a/7353335:
-        consecutive = np.split(nonzero, np.where(np.diff(nonzero > 1)[0] + 1))
+        consecutive = np.split(nonzero, np.flatnonzero(np.diff(nonzero) > 1) + 1)
 
         intervals = []
         for grp in consecutive:
             if len(grp) >= 2:
-                # Extract the start and end point of each consecutive interval:
-                intervals.append((grp[0], grp[-1]))
+                # Extract the start and (exclusive) end point of each consecutive interval:
+                intervals.append((grp[0], grp[-1] + 1))
 
         return intervals
+
+class ProjectionProfiler:
+    '''
+    Computes the projection profiles of many bounding boxes of an image at once, from a single integral image.
+    '''
+
+    def __init__(self, image):
+        '''
+        Constructs a ProjectionProfiler object from a cv2 binary image (foreground is non-zero).
+        '''
+
+        # Integral image of foreground pixels (one more row and column than the image):
+        self.integral = cv2.integral(np.greater(image, 0).view(np.uint8), sdepth=cv2.CV_32S)
+
+    def profiles(self, bboxes, axis, sigma=0):
+        '''
+        Gets the Projection objects of the given bounding boxes (array of shape (N, 4) of x, y, width, height) along the
+        given axis (as in BoundingBox.split: foreground pixels per row for the y-axis (1), per column for the x-axis
+        (0)), smoothed through an 1D Gaussian filter with given sigma (0 for none).
+        '''
+
+        bboxes = np.asarray(bboxes, dtype=np.intp).reshape(-1, 4)
+        x0, y0, width, height = bboxes.T
+
+        if axis:
+            # Rows of each box, their range of columns and the number of rows:
+            starts, first, last, lengths = y0, x0, x0 + width, height
+        else:
+            # Columns of each box, their range of rows and the number of columns:
+            starts, first, last, lengths = x0, y0, y0 + height, width
+
+        # Positions of all profiles along axis, box after box:
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        positions = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+        # Range of each position across axis:
+        first = np.repeat(first, lengths)
+        last = np.repeat(last, lengths)
+
+        # Count foreground pixels of each position inside its box through the integral image:
+        if axis:
+            integral = self.integral
+        else:
+            integral = self.integral.T
+
+        signal = (
+            integral[positions + 1, last] - integral[positions, last] -
+            integral[positions + 1, first] + integral[positions, first]
+        ).astype(np.float64)
+
+        projections = []
+        for segment in np.split(signal, np.cumsum(lengths)[:-1]):
+            if sigma:
+                # Smooth the signal of box:
+                segment = gaussian_filter1d(segment, sigma)
+
+            projections.append(Projection(segment))
+
+        return projections
+
+    def split(self, bboxes, axis, sigma=0, ratio=0.5, min_size=1):
+        '''
+        Splits the given bounding boxes (array of shape (N, 4) of x, y, width, height) along the given axis at the
+        valleys of their projection profiles (see Projection.find_cuts). Returns a list of BoundingBox objects per
+        box (a single one if it is not split).
+        '''
+
+        splits = []
+
+        for bbox, projection in zip(np.asarray(bboxes).reshape(-1, 4).tolist(), self.profiles(bboxes, axis, sigma)):
+            bbox = BoundingBox(bbox)
+
+            # Get start of box along axis:
+            start = bbox.y0 if axis else bbox.x0
+
+            # Get intervals between cuts (in image coordinates):
+            bounds = [0] + projection.find_cuts(ratio, min_size).tolist() + [len(projection.signal)]
+            intervals = [(start + lower, start + upper) for lower, upper in zip(bounds[:-1], bounds[1:])]
+
+            splits.append(bbox.split(intervals, axis))
+
+        return splits
@@ -26,6 +26,32 @@ def pil_to_cv2_rgb(image, bg_color=255):
 
     return image, alpha
 
+def pil_to_cv2(image, channels=3, bg_color=255):
+    '''
+    Converts PIL image to cv2 (OpenCV) image (Numpy array) for a model with given number of input channels, avoiding
+    copies: grayscale images stay single-channel (2D) and color images are viewed as BGR, both over the pixels of the
+    PIL image (read-only). Model objects expand and swap channels while normalizing their inputs.
+    '''
+    # Remove alpha channel from image, if there is one:
+    if image.mode in ('LA', 'RGBA', 'PA'):
+        alpha = image.getchannel('A')
+
+        # Paste image on a canvas of background color (grayscale if possible):
+        mode = 'L' if image.mode == 'LA' or channels == 1 else 'RGB'
+        canvas = PIL.Image.new(mode, image.size, bg_color if mode == 'L' else (bg_color,) * 3)
+        canvas.paste(image.convert(mode + 'A'), mask=alpha)
+
+        image = canvas
+    else:
+        alpha = None
+
+    if channels == 1 or image.mode in ('1', 'L'):
+        # View grayscale pixels as a Numpy array (single channel):
+        return np.asarray(image if image.mode == 'L' else image.convert('L')), alpha
+
+    # View RGB pixels as a Numpy array, then as BGR (for OpenCV) by reversing the channel axis:
+    return np.asarray(image if image.mode == 'RGB' else image.convert('RGB'))[:, :, ::-1], alpha
+
 def cv2_to_pil_rgb(image, alpha=None):
     '''
     Converts cv2 (OpenCV) BGR image to PIL RGB image
@@ -39,6 +65,14 @@ def cv2_to_pil_rgb(image, alpha=None):
 
     return image
 
+def bits_to_pil_bilevel(bits, shape):
+    '''
+    Converts packed bits of a binary prediction (foreground is 1, each row packed as by np.packbits along axis 1) to PIL
+    bilevel image (mode '1', foreground black and background white), without unpacking them
+    '''
+    # PIL stores bilevel images as rows of packed bits too, where 0 is black (inverted raw mode):
+    return PIL.Image.frombytes('1', (shape[1], shape[0]), np.ascontiguousarray(bits).tobytes(), 'raw', '1;I')
+
 def pil_to_cv2_gray(image, bg_color=255):
     '''
     Converts PIL grayscale image to cv2 (OpenCV) grayscale image (Numpy array)
@@ -75,3 +109,29 @@ def cv2_to_pil_gray(image, alpha=None):
         image.putalpha(alpha)
 
     return image
+
+def points_strings(points, lengths):
+    '''
+    Converts the points of several polygons (array of shape (N, 2), polygon after polygon, with given numbers of points
+    each) to PAGE points strings, formatting all of them at once
+    '''
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    lengths = np.asarray(lengths, dtype=np.int64)
+
+    # Format all points into a single string (each followed by a space):
+    text = ("%i,%i " * len(points)) % tuple(points.ravel().tolist())
+
+    # Count characters of each formatted point (digits, signs, comma and space):
+    digits = np.floor(np.log10(np.maximum(np.abs(points), 1))).astype(np.int64) + 1 + (points < 0)
+    ends = np.concatenate(([0], np.cumsum(digits.sum(axis=1) + 2)))
+
+    # Character span of each polygon (without its trailing space):
+    bounds = ends[np.concatenate(([0], np.cumsum(lengths)))].tolist()
+
+    return [text[start:end-1] for start, end in zip(bounds[:-1], bounds[1:])]
+
+def set_opencv_threads(threads):
+    '''
+    Sets the number of threads used by cv2 (OpenCV) functions
+    '''
+    cv2.setNumThreads(threads)
@@ -1,6 +1,6 @@
 from gbn.lib.dl import Model, Prediction
 from gbn.lib.struct import Contour, Polygon
-from gbn.lib.util import pil_to_cv2_rgb, cv2_to_pil_gray
+from gbn.lib.util import bits_to_pil_bilevel, pil_to_cv2_rgb, cv2_to_pil_gray
 from gbn.tool import OCRD_TOOL
 from gbn.sbb.predict import OcrdGbnSbbPredict
 
@@ -9,6 +9,8 @@ from ocrd_models.ocrd_page import to_xml
 from ocrd_models.ocrd_page_generateds import AlternativeImageType, BorderType, CoordsType, LabelsType, LabelType, MetadataItemType, TextLineType, TextRegionType
 from ocrd_utils import concat_padded, coordinates_for_segment, getLogger, MIMETYPE_PAGE, points_from_polygon
 
+from functools import partial
+from io import BytesIO
 from os.path import realpath, join
 
 class OcrdGbnSbbBinarize(OcrdGbnSbbPredict):
@@ -17,156 +19,127 @@ class OcrdGbnSbbBinarize(OcrdGbnSbbPredict):
 
     fallback_image_filegrp = "OCR-D-IMG-BIN"
 
+    @property
+    def page_feature_filter(self):
+        # Avoid binarized page images when binarizing the whole page:
+        return "binarized" if self.page_level else ""
+
+    def _binary_image(self, prediction, alpha):
+        if self.parameter['output_format'] == "png" or alpha:
+            # Convert to cv2 binary image then to PIL (grayscale, also when there is an alpha channel):
+            return cv2_to_pil_gray(prediction.to_binary_image(), alpha=alpha)
+
+        # Convert packed bits of prediction to PIL bilevel image:
+        return bits_to_pil_bilevel(prediction.packed_bits(), prediction.shape)
+
+    def _save_image(self, ctx, image, file_id):
+        if self.parameter['output_format'] != "tiff-g4" or image.mode != '1':
+            return super(OcrdGbnSbbBinarize, self)._save_image(ctx, image, file_id)
+
+        # Encode bilevel image as TIFF with CCITT Group 4 compression:
+        content = BytesIO()
+        image.save(content, format='TIFF', compression='group4')
+
+        file_path = join(self.image_grp, file_id + ".tif")
+
+        with self.workspace_lock:
+            self.workspace.add_file(
+                ID=file_id,
+                file_grp=self.image_grp,
+                pageId=ctx.page_id,
+                mimetype="image/tiff",
+                local_filename=file_path,
+                content=content.getvalue()
+            )
+
+        return file_path
+
     def process(self):
         # Ensure path to model is absolute:
         self.parameter['model'] = realpath(self.parameter['model'])
 
-        # Construct Model object:
-        model = Model(self.parameter['model'], self.parameter['shaping'])
+        # Get Model object:
+        self.model = self.get_model(self.parameter['model'], self.parameter['shaping'])
 
-        for (self.page_num, self.input_file) in enumerate(self.input_files):
-            self.log.info("Processing input file: %i / %s", self.page_num, self.input_file)
+        # Batch page predictions of several pages together:
+        self.batch_predictor = self.get_batch_predictor(self.model)
 
-            # Create a new PAGE file from the input file:
-            page_id = self.input_file.pageId or self.input_file.ID
-            pcgts = page_from_file(self.workspace.download_file(self.input_file))
-            page = pcgts.get_Page()
+        # Predict pages waiting longer than the latency bound while loading the next pages, and remaining pages at the
+        # end:
+        self.process_pages(self._binarize_page, finish=self.batch_predictor.flush, poll=self.batch_predictor.poll)
 
-            if self.parameter['operation_level'] == "page":
-                # Get image from PAGE:
-                page_image, page_xywh, _ = self.workspace.image_from_page(
-                    page,
-                    page_id,
-                    feature_filter="binarized"
-                )
+    def _binarize_whole_page(self, ctx, emit, page_prediction):
+        # Convert to PIL binary image:
+        page_prediction = self._binary_image(page_prediction, ctx.alpha)
+
+        self._add_AlternativeImage(
+            ctx,
+            ctx.page,
+            page_prediction,
+            ctx.page_xywh,
+            "",
+            "binarized"
+        )
+
+        emit(ctx)
+
+    def _binarize_page(self, ctx, emit):
+        page = ctx.page
 
-                # Convert PIL to cv2 (RGB):
-                page_image, alpha = pil_to_cv2_rgb(page_image)
+        if self.parameter['operation_level'] == "page":
+            # Get prediction for segment (page is finished once its batch is predicted):
+            self.batch_predictor.submit(ctx.page_image_cv2, partial(self._binarize_whole_page, ctx, emit))
 
-                # Get prediction for segment:
-                page_prediction = model.predict(page_image)
+            # Release full resolution image:
+            ctx.page_image_cv2 = None
 
-                # Convert to cv2 binary image then to PIL:
-                page_prediction = cv2_to_pil_gray(page_prediction.to_binary_image(), alpha=alpha)
+            return
+
+        if self.parameter['operation_level'] == "region":
+            regions = page.get_TextRegion()
+
+            # Get images (avoiding binarized ones) and predictions of all TextRegions:
+            region_predictions = self._predict_segments(ctx, regions, feature_filter="binarized")
+
+            for region_idx, region in enumerate(regions):
+                region_id = "_region%04d" % region_idx
+
+                _, region_xywh, alpha, region_prediction = region_predictions[region_idx]
+
+                # Convert to PIL binary image:
+                region_prediction = self._binary_image(region_prediction, alpha)
 
                 self._add_AlternativeImage(
-                    page_id,
-                    page,
-                    page_prediction,
-                    page_xywh,
-                    "",
+                    ctx,
+                    region,
+                    region_prediction,
+                    region_xywh,
+                    region_id,
                     "binarized"
                 )
 
-            elif self.parameter['operation_level'] == "region":
-                # Get image from PAGE:
-                page_image, page_xywh, _ = self.workspace.image_from_page(
-                    page,
-                    page_id
-                )
+        elif self.parameter['operation_level'] == "line":
+            # Get TextLines of all TextRegions along with their IDs:
+            lines = [
+                (line, "_region%04d" % region_idx + "_region%04d" % line_idx)
+                for region_idx, region in enumerate(page.get_TextRegion())
+                for line_idx, line in enumerate(region.get_TextLine())
+            ]
 
-                regions = page.get_TextRegion()
-
-                for region_idx, region in enumerate(regions):
-                    region_id = "_region%04d" % region_idx
-
-                    # Get image from TextRegion:
-                    region_image, region_xywh = self.workspace.image_from_segment(
-                        region,
-                        page_image,
-                        page_xywh,
-                        feature_filter="binarized"
-                    )
-
-                    # Convert PIL to cv2 (RGB):
-                    region_image, alpha = pil_to_cv2_rgb(region_image)
-
-                    # Get prediction for segment:
-                    region_prediction = model.predict(region_image)
-
-                    # Convert to cv2 binary image then to PIL:
-                    region_prediction = cv2_to_pil_gray(region_prediction.to_binary_image(), alpha=alpha)
-
-                    self._add_AlternativeImage(
-                        page_id,
-                        region,
-                        region_prediction,
-                        region_xywh,
-                        region_id,
-                        "binarized"
-                    )
-
-            elif self.parameter['operation_level'] == "line":
-                # Get image from PAGE:
-                page_image, page_xywh, _ = self.workspace.image_from_page(
-                    page,
-                    page_id
-                )
+            # Get images (avoiding binarized ones) and predictions of all TextLines:
+            line_predictions = self._predict_segments(ctx, [line for line, _ in lines], feature_filter="binarized")
 
-                regions = page.get_TextRegion()
-
-                for region_idx, region in enumerate(regions):
-                    region_id = "_region%04d" % region_idx
-
-                    lines = region.get_TextLine()
-
-                    for line_idx, line in enumerate(lines):
-                        line_id = "_region%04d" % line_idx
-
-                        # Get image from TextLine:
-                        line_image, line_xywh = self.workspace.image_from_segment(
-                            line,
-                            page_image,
-                            page_xywh,
-                            feature_filter="binarized"
-                        )
-
-                        # Convert PIL to cv2 (RGB):
-                        line_image, alpha = pil_to_cv2_rgb(line_image)
-
-                        # Get prediction for segment:
-                        line_prediction = model.predict(line_image)
-
-                        # Convert to cv2 binary image then to PIL:
-                        line_prediction = cv2_to_pil_gray(line_prediction.to_binary_image(), alpha=alpha)
-
-                        self._add_AlternativeImage(
-                            page_id,
-                            line,
-                            line_prediction,
-                            line_xywh,
-                            region_id+line_id,
-                            "binarized"
-                        )
-
-            # Add metadata about this operation:
-            metadata = pcgts.get_Metadata()
-            metadata.add_MetadataItem(
-                MetadataItemType(
-                    type_="processingStep",
-                    name=self.ocrd_tool['steps'][0],
-                    value=self.tool,
-                    Labels=[
-                        LabelsType(
-                            externalModel="ocrd-tool",
-                            externalId="parameters",
-                            Label=[
-                                LabelType(
-                                    type_=name,
-                                    value=self.parameter[name]
-                                ) for name in self.parameter.keys()
-                            ]
-                        )
-                    ]
+            for (line, line_id), (_, line_xywh, alpha, line_prediction) in zip(lines, line_predictions):
+                # Convert to PIL binary image:
+                line_prediction = self._binary_image(line_prediction, alpha)
+
+                self._add_AlternativeImage(
+                    ctx,
+                    line,
+                    line_prediction,
+                    line_xywh,
+                    line_id,
+                    "binarized"
                 )
-            )
 
-            # Save XML PAGE:
-            self.workspace.add_file(
-                 ID=self.page_file_id,
-                 file_grp=self.page_grp,
-                 pageId=page_id,
-                 mimetype=MIMETYPE_PAGE,
-                 local_filename=join(self.output_file_grp, self.page_file_id)+".xml",
-                 content=to_xml(pcgts)
-            )
+        emit(ctx)
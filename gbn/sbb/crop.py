@@ -9,87 +9,104 @@ from ocrd_models.ocrd_page import to_xml
 from ocrd_models.ocrd_page_generateds import AlternativeImageType, BorderType, CoordsType, LabelsType, LabelType, MetadataItemType, TextLineType, TextRegionType
 from ocrd_utils import concat_padded, coordinates_for_segment, getLogger, MIMETYPE_PAGE, points_from_polygon
 
+from functools import partial
 from os.path import realpath, join
 
+import numpy as np
+import PIL.Image
+
 class OcrdGbnSbbCrop(OcrdGbnSbbPredict):
     tool = "ocrd-gbn-sbb-crop"
     log = getLogger("processor.OcrdGbnSbbCrop")
 
     fallback_image_filegrp = "OCR-D-IMG-CROP"
 
+    @property
+    def page_feature_filter(self):
+        # Avoid binarized and cropped page images:
+        return "binarized,cropped"
+
     def process(self):
         # Ensure path to model is absolute:
         self.parameter['model'] = realpath(self.parameter['model'])
 
-        # Construct Model object:
-        model = Model(self.parameter['model'], self.parameter['shaping'])
-
-        for (self.page_num, self.input_file) in enumerate(self.input_files):
-            self.log.info("Processing input file: %i / %s", self.page_num, self.input_file)
-
-            # Create a new PAGE file from the input file:
-            page_id = self.input_file.pageId or self.input_file.ID
-            pcgts = page_from_file(self.workspace.download_file(self.input_file))
-            page = pcgts.get_Page()
-
-            # Get image from PAGE:
-            page_image, page_xywh, _ = self.workspace.image_from_page(
-                page,
-                page_id,
-                feature_filter="binarized,cropped"
-            )
-
-            # Convert PIL to cv2 (RGB):
-            page_image, _ = pil_to_cv2_rgb(page_image)
-
-            # Get prediction for segment:
-            page_prediction = model.predict(page_image)
-
-            # Find contours of prediction:
-            contours = Contour.from_image(page_prediction.img)
-
-            # Filter out child contours:
-            contours = list(filter(lambda cnt: not cnt.is_child(), contours))
-
-            # Filter out invalid polygons:
-            contours = list(filter(lambda cnt: cnt.polygon.is_valid(), contours))
-
-            # Sort contours by area:
-            contours = sorted(contours, key=lambda cnt: cnt.area)
-
-            # Get polygon of largest contour:
-            border_polygon = contours[-1].polygon
-
-            self._set_Border(page, page_image, page_xywh, border_polygon.points)
-
-            # Add metadata about this operation:
-            metadata = pcgts.get_Metadata()
-            metadata.add_MetadataItem(
-                MetadataItemType(
-                    type_="processingStep",
-                    name=self.ocrd_tool['steps'][0],
-                    value=self.tool,
-                    Labels=[
-                        LabelsType(
-                            externalModel="ocrd-tool",
-                            externalId="parameters",
-                            Label=[
-                                LabelType(
-                                    type_=name,
-                                    value=self.parameter[name]
-                                ) for name in self.parameter.keys()
-                            ]
-                        )
-                    ]
-                )
-            )
-
-            # Save XML PAGE:
-            self.workspace.add_file(
-                 ID=self.page_file_id,
-                 file_grp=self.page_grp,
-                 pageId=page_id,
-                 mimetype=MIMETYPE_PAGE,
-                 local_filename=join(self.output_file_grp, self.page_file_id)+".xml",
-                 content=to_xml(pcgts)
-            )
+        # Get Model object:
+        self.model = self.get_model(self.parameter['model'], self.parameter['shaping'])
+
+        # Batch predictions of several pages together:
+        self.batch_predictor = self.get_batch_predictor(self.model)
+
+        # Predict pages waiting longer than the latency bound while loading the next pages, and remaining pages at the
+        # end:
+        self.process_pages(self._predict_page, finish=self.batch_predictor.flush, poll=self.batch_predictor.poll)
+
+    def _get_page_image(self, ctx):
+        page_image, page_xywh = super(OcrdGbnSbbCrop, self)._get_page_image(ctx)
+
+        # Models resizing their input only need the page at about their input resolution:
+        if not self.parameter['reduced_decoding'] or self.model.shaping != "resize":
+            return page_image, page_xywh
+
+        # Only pages whose image is their original image file (neither cropped nor rotated) can be decoded again:
+        if (
+            page_xywh['features'] or
+            page_xywh['angle'] or
+            ctx.page.get_Border() is not None or
+            not getattr(page_image, 'filename', None)
+        ):
+            return page_image, page_xywh
+
+        # Open the image file again (the workspace caches its image object), closing it once decoded:
+        with PIL.Image.open(join(self.workspace.directory, page_image.filename)) as image:
+            full_size = image.size
+
+            # Request a decoding at reduced scale, not smaller than the model input (e.g. JPEG DCT scaling):
+            input_size = (self.model.input_shape[2], self.model.input_shape[1])
+            image.draft(None, input_size)
+
+            if image.size != full_size:
+                # Decode at reduced scale:
+                reduced = image.copy()
+            else:
+                # Decode at full resolution, then reduce by an integer factor:
+                factor = min(full_size[0] // input_size[0], full_size[1] // input_size[1])
+                if factor < 2:
+                    return page_image, page_xywh
+
+                # Convert modes which cannot be reduced by averaging (e.g. bilevel, palette or 16-bit) as they would be
+                # converted for the model anyway (see pil_to_cv2):
+                if image.mode not in ("L", "LA", "RGB", "RGBA"):
+                    if "A" in image.mode.upper() or "transparency" in image.info:
+                        image = image.convert("RGBA")
+                    elif len(image.getbands()) == 1 and image.mode != "P":
+                        image = image.convert("L")
+                    else:
+                        image = image.convert("RGB")
+
+                reduced = image.reduce(factor)
+
+        self.log.debug("Decoded page %s at %ix%i instead of %ix%i", ctx.page_id, *reduced.size, *full_size)
+
+        ctx.page_scale = (full_size[0] / reduced.size[0], full_size[1] / reduced.size[1])
+
+        return reduced, page_xywh
+
+    def _predict_page(self, ctx, emit):
+        # Get prediction for segment (page is finished once its batch is predicted):
+        self.batch_predictor.submit(ctx.page_image_cv2, partial(self._crop_page, ctx, emit))
+
+        # Release full resolution image:
+        ctx.page_image_cv2 = None
+
+    def _crop_page(self, ctx, emit, page_prediction):
+        # Get polygon of largest contour of prediction:
+        border_polygon = self._get_border_polygon(ctx, page_prediction)
+        border_points = border_polygon.points
+
+        if ctx.page_scale is not None:
+            # Map polygon back to the full resolution page image:
+            border_points = np.rint(border_points * ctx.page_scale).astype(np.int32)
+
+        self._set_Border(ctx.page, ctx.page_image, ctx.page_xywh, border_points)
+
+        emit(ctx)
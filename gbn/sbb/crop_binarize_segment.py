@@ -0,0 +1,83 @@
+from gbn.lib.util import pil_to_cv2, cv2_to_pil_gray
+from gbn.sbb.segment import OcrdGbnSbbSegment
+
+from ocrd_utils import getLogger
+
+from os.path import realpath
+
+class OcrdGbnSbbCropBinarizeSegment(OcrdGbnSbbSegment):
+    tool = "ocrd-gbn-sbb-crop-binarize-segment"
+    log = getLogger("processor.OcrdGbnSbbCropBinarizeSegment")
+
+    fallback_image_filegrp = "OCR-D-IMG-BIN"
+
+    @property
+    def page_feature_filter(self):
+        # Avoid binarized and cropped page images:
+        return "binarized,cropped"
+
+    def process(self):
+        # Ensure paths to models are absolute:
+        for name in ('crop_model', 'binarize_model', 'region_model', 'line_model'):
+            self.parameter[name] = realpath(self.parameter[name])
+
+        # Get Model objects of each stage:
+        self.crop_model = self.get_model(self.parameter['crop_model'], self.parameter['crop_shaping'])
+        self.binarize_model = self.get_model(self.parameter['binarize_model'], self.parameter['binarize_shaping'])
+        self.region_model = self.get_model(self.parameter['region_model'], self.parameter['region_shaping'])
+        self.line_model = self.get_model(self.parameter['line_model'], self.parameter['line_shaping'])
+
+        # Batch TextRegion predictions of several pages together (see OcrdGbnSbbSegment._segment_page):
+        self.region_predictor = self.get_batch_predictor(self.region_model)
+
+        self.process_pages(
+            self._crop_binarize_segment_page,
+            finish=self.region_predictor.flush,
+            poll=self.region_predictor.poll
+        )
+
+    def _crop_binarize_segment_page(self, ctx, emit):
+        # Get prediction of page surface:
+        page_prediction = self.crop_model.predict(ctx.page_image_cv2)
+
+        # Release full resolution image:
+        ctx.page_image_cv2 = None
+
+        # Get polygon of largest contour of prediction:
+        border_polygon = self._get_border_polygon(ctx, page_prediction)
+
+        self._set_Border(ctx.page, ctx.page_image, ctx.page_xywh, border_polygon.points)
+
+        with self.workspace_lock:
+            # Get image cropped by the Border from PAGE (source image is cached by the workspace):
+            page_image, page_xywh, _ = self.workspace.image_from_page(
+                ctx.page,
+                ctx.page_id,
+                feature_filter="binarized"
+            )
+
+        # Convert PIL to cv2 (with as many channels as needed):
+        page_image_cv2, alpha = pil_to_cv2(page_image, self.binarize_model.input_shape[3])
+
+        # Get prediction of foreground pixels of the cropped image:
+        page_prediction = self.binarize_model.predict(page_image_cv2)
+
+        # Convert to cv2 binary image then to PIL:
+        page_image = cv2_to_pil_gray(page_prediction.to_binary_image(), alpha=alpha)
+
+        if self.parameter['save_images']:
+            self._add_AlternativeImage(
+                ctx,
+                ctx.page,
+                page_image,
+                page_xywh,
+                "",
+                "binarized"
+            )
+
+        # Segment the binarized image (as if read back from its AlternativeImage):
+        ctx.page_image = page_image
+        ctx.page_xywh = dict(page_xywh, features=(page_xywh['features'] + "," if page_xywh['features'] else "") + "binarized")
+        ctx.page_image_cv2, ctx.alpha = pil_to_cv2(page_image, self.input_channels)
+
+        self._segment_page(ctx, emit)
@@ -1,15 +1,74 @@
-from gbn.lib.dl import Model, Prediction
-from gbn.lib.struct import Contour, Polygon
-from gbn.lib.util import pil_to_cv2_rgb, cv2_to_pil_gray
+from gbn.lib.cache import PredictionCache
+from gbn.lib.dl import BatchPredictor, Model, Prediction, model_registry
+from gbn.lib.manifest import Manifest
+from gbn.lib.pipeline import Pipeline
+from gbn.lib.profile import ExecutionProfile
+from gbn.lib.quantize import quantized_path
+from gbn.lib.struct import ContourSet, Polygon
+from gbn.lib.util import pil_to_cv2, cv2_to_pil_gray, points_strings, set_opencv_threads
 from gbn.tool import OCRD_TOOL
 
 from ocrd import Processor
 from ocrd_modelfactory import page_from_file
 from ocrd_models.ocrd_page import to_xml
-from ocrd_models.ocrd_page_generateds import AlternativeImageType, BorderType, CoordsType, LabelsType, LabelType, MetadataItemType, TextLineType, TextRegionType
-from ocrd_utils import concat_padded, coordinates_for_segment, getLogger, MIMETYPE_PAGE, points_from_polygon
+from ocrd_models.ocrd_page_generateds import parseString, AlternativeImageType, BorderType, CoordsType, LabelsType, LabelType, MetadataItemType, TextLineType, TextRegionType
+from ocrd_utils import concat_padded, coordinates_for_segment, getLogger, MIMETYPE_PAGE
 
-from os.path import realpath, join
+from functools import partial
+from multiprocessing import cpu_count, get_context
+from os.path import exists, getsize, realpath, join
+from threading import RLock
+
+import json
+import mimetypes
+import time
+
+# Batch size used when neither given nor autotuned:
+DEFAULT_BATCH_SIZE = 16
+
+class PageContext:
+    '''
+    State of an input file (page) going through the processing stages.
+    '''
+
+    def __init__(self, page_num, input_file):
+        self.page_num = page_num
+        self.input_file = input_file
+
+        self.page_id = input_file.pageId or input_file.ID
+
+        # PAGE-XML of the page:
+        self.pcgts = None
+        self.page = None
+
+        # Image of the page (PIL and cv2) and its coordinates:
+        self.page_image = None
+        self.page_image_cv2 = None
+        self.page_xywh = None
+        self.alpha = None
+
+        # Factors (x, y) mapping page image coordinates to full resolution, if decoded at a reduced resolution:
+        self.page_scale = None
+
+        # AlternativeImages to be saved (segment, image, coordinates, file ID suffix and comments):
+        self.images = []
+
+        # Points of the polygons added before and after simplification:
+        self.contour_points = 0
+        self.polygon_points = 0
+
+# Processor whose pages are being processed by forked workers:
+_job_processor = None
+
+def _init_job(threads):
+    # Avoid oversubscription of cores by the workers:
+    set_opencv_threads(threads)
+
+    # Load the models deferred by the parent in sessions of this worker:
+    model_registry.load_deferred(intra_op_threads=threads, inter_op_threads=1)
+
+def _run_job(position):
+    return _job_processor._process_page_job(position)
 
 class OcrdGbnSbbPredict(Processor):
     tool = "ocrd-gbn-sbb-predict"
@@ -22,6 +81,22 @@ class OcrdGbnSbbPredict(Processor):
         kwargs['version'] = OCRD_TOOL['version']
         super(OcrdGbnSbbPredict, self).__init__(*args, **kwargs)
 
+        # Serializes workspace (METS) accesses of the pipeline stages:
+        self.workspace_lock = RLock()
+
+        # Persistent cache of predictions (created along with the first model):
+        self.prediction_cache = None
+
+        # Models used by the processor:
+        self.models = []
+
+        # Fingerprints of the models (for the keys of the pages in the manifest):
+        self.model_fingerprints = []
+
+        # Manifest of pages already processed (incremental mode only) and keys of the pages to be processed:
+        self.manifest = None
+        self.page_keys = {}
+
         if hasattr(self, "output_file_grp"):
             try:
                 # If image file group specified:
@@ -36,39 +111,533 @@ class OcrdGbnSbbPredict(Processor):
                     self.fallback_image_filegrp
                 )
 
-    def file_id(self, file_grp):
-        file_id = self.input_file.ID.replace(self.input_file_grp, file_grp)
+    def file_id(self, ctx, file_grp):
+        file_id = ctx.input_file.ID.replace(self.input_file_grp, file_grp)
 
-        if file_id == self.input_file.ID:
-            file_id = concat_padded(file_grp, self.page_num)
+        if file_id == ctx.input_file.ID:
+            file_id = concat_padded(file_grp, ctx.page_num)
 
         return file_id
 
+    def page_file_id(self, ctx):
+        return self.file_id(ctx, self.page_grp)
+
+    def image_file_id(self, ctx):
+        return self.file_id(ctx, self.image_grp)
+
+    @property
+    def input_channels(self):
+        # Most input channels of the models (page images are converted for all of them at once):
+        return max([1] + [model.input_shape[3] for model in self.models])
+
+    @property
+    def memory_budget(self):
+        # Convert from MiB to bytes (0 for unbounded):
+        return self.parameter['memory_budget'] * 1024 * 1024 or None
+
     @property
-    def page_file_id(self):
-        return self.file_id(self.page_grp)
+    def page_feature_filter(self):
+        # Features of page images to be avoided:
+        return ""
 
     @property
-    def image_file_id(self):
-        return self.file_id(self.image_grp)
-
-    def _add_AlternativeImage(self, page_id, segment, segment_image, segment_xywh, segment_id, comments):
-        # Save image:
-        file_path = self.workspace.save_image_file(
-            segment_image,
-            self.image_file_id+segment_id,
-            page_id=page_id,
-            file_grp=self.image_grp
+    def page_level(self):
+        # Whether the whole page image is predicted:
+        return self.parameter.get('operation_level', "page") == "page"
+
+    def resolve_model(self, model_path):
+        precision = self.parameter['precision']
+
+        # Original (float32) Keras model run by the selected backend:
+        if precision == "float32":
+            return model_path, self.parameter['backend']
+
+        # Reduced-precision model (converted by gbn-model quantize) run by TFLite:
+        path = quantized_path(model_path, precision)
+
+        if not exists(path):
+            raise FileNotFoundError("No {} model at {} (see gbn-model quantize)".format(precision, path))
+
+        return path, "tflite"
+
+    def get_profile(self, model_path, shaping, backend):
+        # Execution profile given by parameters (0 for unset):
+        profile = ExecutionProfile(
+            intra_op_threads=self.parameter['intra_op_threads'],
+            inter_op_threads=self.parameter['inter_op_threads'],
+            opencv_threads=self.parameter['opencv_threads'],
+            batch_size=self.parameter['batch_size']
+        )
+
+        # Take unset settings from the profile cached by the autotuner (gbn-model autotune), if any:
+        profile = profile.merge(
+            ExecutionProfile.load(ExecutionProfile.cache_path(model_path, shaping, backend))
         )
 
-        # Add metadata about saved image:
-        segment.add_AlternativeImage(
-            AlternativeImageType(
-                filename=file_path,
-                comments=comments if not segment_xywh['features'] else segment_xywh['features'] + "," + comments
+        self.log.info("Execution profile: %s", profile)
+
+        return profile
+
+    def get_prediction_cache(self):
+        # Predictions are not cached unless a cache directory is given:
+        if not self.parameter['cache_dir']:
+            return None
+
+        if self.prediction_cache is None:
+            self.prediction_cache = PredictionCache(
+                self.parameter['cache_dir'],
+                # Convert from MiB to bytes (0 for unbounded):
+                max_size=self.parameter['cache_size'] * 1024 * 1024 or None
             )
+
+        return self.prediction_cache
+
+    def get_model(self, model_path, shaping):
+        model_path, backend = self.resolve_model(model_path)
+
+        profile = self.get_profile(model_path, shaping, backend)
+
+        # Get Model object running a model shared through the registry (loading it if needed, unless forked workers
+        # load it, see _process_pages_parallel):
+        model = model_registry.get(
+            model_path,
+            shaping,
+            batch_size=profile.batch_size or DEFAULT_BATCH_SIZE,
+            memory_budget=self.memory_budget,
+            backend=backend,
+            profile=profile,
+            defer=self.parameter['jobs'] > 1
         )
 
+        model.cache = self.get_prediction_cache()
+
+        self.models.append(model)
+
+        self.model_fingerprints.append("{}:{}:{}:{}".format(
+            model_path,
+            *model_registry.fingerprint(model_path),
+            shaping
+        ))
+
+        self.log.info("Model registry: %s", model_registry)
+
+        return model
+
+    def get_batch_predictor(self, model):
+        # Batch predictions of several pages together (only for models resizing their input, see BatchPredictor):
+        return BatchPredictor(
+            model,
+            max_size=self.parameter['page_batch_size'],
+            max_latency=self.parameter['batch_latency'] or None
+        )
+
+    def process_pages(self, process_page, finish=None, poll=None):
+        # Numbered input files to be processed:
+        items = list(enumerate(self.input_files))
+
+        if self.parameter['incremental']:
+            # Skip pages whose outputs are up to date:
+            items = self._skip_current_pages(items)
+
+        parallel = self.parameter['jobs'] > 1
+
+        if parallel and model_registry.has_loaded_models:
+            # Tensorflow sessions of this process (e.g. of models loaded by a previous run) would not survive a fork:
+            self.log.warning("Models already loaded by this process, processing input files in the main process")
+            parallel = False
+
+        if parallel:
+            # Process pages in forked workers:
+            self._process_pages_parallel(items, process_page, finish)
+        else:
+            # Run input files through load, process and save stages (pipelined if enabled):
+            pipeline = Pipeline(
+                self._load_page,
+                process_page,
+                self._save_page,
+                workers=self.parameter['pipeline_workers'],
+                depth=self.parameter['pipeline_depth']
+            )
+
+            pipeline.run(items, finish=finish, poll=poll)
+
+            # Statistics of the prediction cache (workers keep their own):
+            if self.prediction_cache is not None:
+                self.log.info("Prediction cache: %s", self.prediction_cache)
+
+    def _process_pages_parallel(self, items, process_page, finish):
+        global _job_processor
+
+        if not items:
+            return
+
+        jobs = min(self.parameter['jobs'], len(items))
+
+        # Split the cores among the workers:
+        threads = max(1, cpu_count() // jobs)
+
+        # Schedule largest pages first (reducing tail latency), by position in the items:
+        schedule = sorted(
+            range(len(items)),
+            key=lambda position: self._page_size(items[position][1]),
+            reverse=True
+        )
+
+        # The models were not loaded by this process (see get_model), since tensorflow sessions cannot be used after a
+        # fork: each worker loads them on start.
+
+        # Make this processor available to the workers:
+        self.job_items = items
+        self.job_process_page = process_page
+        self.job_finish = finish
+        _job_processor = self
+
+        self.log.info("Processing %i input files with %i workers of %i threads", len(items), jobs, threads)
+
+        try:
+            with get_context("fork").Pool(jobs, initializer=_init_job, initargs=(threads,)) as pool:
+                # Processed pages waiting for preceding pages to be saved (by position in the items):
+                processed = {}
+                next_position = 0
+
+                for position, (_, content, images, points) in pool.imap_unordered(_run_job, schedule):
+                    processed[position] = (content, images, points)
+
+                    # Save pages (METS and PAGE writes) in this process and in input order:
+                    while next_position in processed:
+                        self._save_page(self._import_page(*items[next_position], *processed.pop(next_position)))
+
+                        next_position += 1
+        finally:
+            _job_processor = None
+
+    def _process_page_job(self, position):
+        emitted = []
+
+        # Load and process page, emitting its results right away:
+        ctx = self._load_page(self.job_items[position])
+        self.job_process_page(ctx, emitted.append)
+
+        if self.job_finish is not None:
+            self.job_finish()
+
+        return position, self._export_page(emitted[0])
+
+    # Parameters only affecting how (fast) pages are processed, not the outputs (not part of the page keys):
+    unkeyed_parameters = {
+        'jobs',
+        'pipeline_depth',
+        'pipeline_workers',
+        'cache_dir',
+        'cache_size',
+        'incremental',
+        'batch_size',
+        'memory_budget',
+        'batch_segments',
+        'page_batch_size',
+        'batch_latency',
+        'intra_op_threads',
+        'inter_op_threads',
+        'opencv_threads'
+    }
+
+    def _page_key(self, input_file):
+        page_file = self.workspace.download_file(input_file)
+        page = page_from_file(page_file).get_Page()
+
+        # Image files of page (original image and page-level AlternativeImages):
+        image_files = [page.get_imageFilename()] + [image.get_filename() for image in page.get_AlternativeImage()]
+
+        # Parameters affecting the outputs:
+        parameters = {
+            name: value
+            for name, value in self.parameter.items()
+            if name not in self.unkeyed_parameters
+        }
+
+        # Hash input PAGE and image files, tool, parameters and models:
+        return Manifest.key(
+            values=[
+                self.tool,
+                OCRD_TOOL['version'],
+                json.dumps(parameters, sort_keys=True),
+                self.page_grp,
+                self.image_grp
+            ] + self.model_fingerprints,
+            paths=[join(self.workspace.directory, path) for path in [page_file.local_filename] + image_files]
+        )
+
+    def _skip_current_pages(self, items):
+        self.manifest = Manifest(join(self.workspace.directory, self.page_grp, ".gbn-manifest.json"))
+
+        pending = []
+
+        for page_num, input_file in items:
+            page_id = input_file.pageId or input_file.ID
+
+            self.page_keys[page_num] = self._page_key(input_file)
+
+            files = self.manifest.get(page_id, self.page_keys[page_num], self.workspace.directory)
+
+            if files is None:
+                pending.append((page_num, input_file))
+                continue
+
+            self.log.info("Skipping input file with up to date outputs: %i / %s", page_num, input_file)
+
+            # Register outputs (e.g. of an interrupted run whose METS was not saved) unless already registered:
+            for file in files:
+                if not list(self.workspace.mets.find_files(ID=file['ID'])):
+                    self.workspace.add_file(
+                        ID=file['ID'],
+                        file_grp=file['file_grp'],
+                        pageId=page_id,
+                        mimetype=file['mimetype'],
+                        local_filename=file['local_filename']
+                    )
+
+        self.log.info("%i of %i input files to be processed", len(pending), len(items))
+
+        return pending
+
+    def _page_size(self, input_file):
+        # Get pixel count of page image:
+        page = page_from_file(self.workspace.download_file(input_file)).get_Page()
+
+        return page.get_imageWidth() * page.get_imageHeight()
+
+    def _export_page(self, ctx):
+        # Reference segments of images to be saved by their IDs (None for the page):
+        images = [
+            (
+                None if segment is ctx.page else segment.id,
+                segment_image,
+                {'features': segment_xywh['features']},
+                segment_id,
+                comments
+            ) for segment, segment_image, segment_xywh, segment_id, comments in ctx.images
+        ]
+
+        return ctx.page_num, to_xml(ctx.pcgts), images, (ctx.contour_points, ctx.polygon_points)
+
+    def _import_page(self, page_num, input_file, content, images, points):
+        ctx = PageContext(page_num, input_file)
+        ctx.contour_points, ctx.polygon_points = points
+
+        # Parse PAGE exported by a worker:
+        ctx.pcgts = parseString(content.encode('utf-8'), silence=True)
+        ctx.page = ctx.pcgts.get_Page()
+
+        # Resolve segments of images to be saved by their IDs:
+        segments = {}
+        for region in ctx.page.get_TextRegion():
+            segments[region.id] = region
+
+            for line in region.get_TextLine():
+                segments[line.id] = line
+
+        ctx.images = [
+            (
+                ctx.page if segment_ref is None else segments[segment_ref],
+                segment_image,
+                segment_xywh,
+                segment_id,
+                comments
+            ) for segment_ref, segment_image, segment_xywh, segment_id, comments in images
+        ]
+
+        return ctx
+
+    def _load_page(self, item):
+        ctx = PageContext(*item)
+
+        self.log.info("Processing input file: %i / %s", ctx.page_num, ctx.input_file)
+
+        with self.workspace_lock:
+            # Create a new PAGE file from the input file:
+            ctx.pcgts = page_from_file(self.workspace.download_file(ctx.input_file))
+            ctx.page = ctx.pcgts.get_Page()
+
+            # Get image from PAGE:
+            ctx.page_image, ctx.page_xywh = self._get_page_image(ctx)
+
+        if self.page_level:
+            # Convert PIL to cv2 (with as many channels as needed):
+            ctx.page_image_cv2, ctx.alpha = pil_to_cv2(ctx.page_image, self.input_channels)
+
+        return ctx
+
+    def _get_page_image(self, ctx):
+        page_image, page_xywh, _ = self.workspace.image_from_page(
+            ctx.page,
+            ctx.page_id,
+            feature_filter=self.page_feature_filter
+        )
+
+        return page_image, page_xywh
+
+    def _save_image(self, ctx, image, file_id):
+        with self.workspace_lock:
+            return self.workspace.save_image_file(
+                image,
+                file_id,
+                page_id=ctx.page_id,
+                file_grp=self.image_grp
+            )
+
+    def _save_page(self, ctx):
+        # Files written for the page (for the manifest):
+        files = []
+
+        for segment, segment_image, segment_xywh, segment_id, comments in ctx.images:
+            # Save image:
+            file_path = self._save_image(ctx, segment_image, self.image_file_id(ctx)+segment_id)
+
+            files.append({
+                'ID': self.image_file_id(ctx)+segment_id,
+                'file_grp': self.image_grp,
+                'mimetype': mimetypes.guess_type(file_path)[0],
+                'local_filename': file_path
+            })
+
+            # Add metadata about saved image:
+            segment.add_AlternativeImage(
+                AlternativeImageType(
+                    filename=file_path,
+                    comments=comments if not segment_xywh['features'] else segment_xywh['features'] + "," + comments
+                )
+            )
+
+        # Add metadata about this operation:
+        metadata = ctx.pcgts.get_Metadata()
+        metadata.add_MetadataItem(
+            MetadataItemType(
+                type_="processingStep",
+                name=self.ocrd_tool['steps'][0],
+                value=self.tool,
+                Labels=[
+                    LabelsType(
+                        externalModel="ocrd-tool",
+                        externalId="parameters",
+                        Label=[
+                            LabelType(
+                                type_=name,
+                                value=self.parameter[name]
+                            ) for name in self.parameter.keys()
+                        ]
+                    )
+                ]
+            )
+        )
+
+        start = time.perf_counter()
+
+        content = to_xml(ctx.pcgts)
+
+        with self.workspace_lock:
+            # Save XML PAGE:
+            self.workspace.add_file(
+                 ID=self.page_file_id(ctx),
+                 file_grp=self.page_grp,
+                 pageId=ctx.page_id,
+                 mimetype=MIMETYPE_PAGE,
+                 local_filename=join(self.output_file_grp, self.page_file_id(ctx))+".xml",
+                 content=content
+            )
+
+        self.log.info(
+            "Saved PAGE-XML of %i bytes in %.3f s (polygons of %i points, %i before simplification)",
+            len(content.encode('utf-8')),
+            time.perf_counter() - start,
+            ctx.polygon_points,
+            ctx.contour_points
+        )
+
+        if self.manifest is not None:
+            files.append({
+                'ID': self.page_file_id(ctx),
+                'file_grp': self.page_grp,
+                'mimetype': MIMETYPE_PAGE,
+                'local_filename': join(self.output_file_grp, self.page_file_id(ctx))+".xml"
+            })
+
+            # Record sizes of written files:
+            for file in files:
+                file['size'] = getsize(join(self.workspace.directory, file['local_filename']))
+
+            # Checkpoint page (only once all of its files are written):
+            self.manifest.record(ctx.page_id, self.page_keys[ctx.page_num], files)
+
+    def _predict_segments(self, ctx, segments, feature_filter=""):
+        images = []
+
+        for segment in segments:
+            with self.workspace_lock:
+                # Get image from segment:
+                segment_image, segment_xywh = self.workspace.image_from_segment(
+                    segment,
+                    ctx.page_image,
+                    ctx.page_xywh,
+                    feature_filter=feature_filter
+                )
+
+            # Convert PIL to cv2 (with as many channels as needed):
+            segment_image_cv2, alpha = pil_to_cv2(segment_image, self.model.input_shape[3])
+
+            images.append((segment_image, segment_xywh, alpha, segment_image_cv2))
+
+        if self.parameter['batch_segments']:
+            # Get predictions for all segments in as few forward passes as possible:
+            predictions = self.model.predict_many([segment_image_cv2 for _, _, _, segment_image_cv2 in images])
+        else:
+            # Get prediction for each segment:
+            predictions = [self.model.predict(segment_image_cv2) for _, _, _, segment_image_cv2 in images]
+
+        return [
+            (segment_image, segment_xywh, alpha, prediction)
+            for (segment_image, segment_xywh, alpha, _), prediction in zip(images, predictions)
+        ]
+
+    def _add_AlternativeImage(self, ctx, segment, segment_image, segment_xywh, segment_id, comments):
+        # Defer saving image to the save stage:
+        ctx.images.append((segment, segment_image, segment_xywh, segment_id, comments))
+
+    def _simplify_contours(self, ctx, contours):
+        # Simplify polygons of contours (keeping valid ones):
+        simplified = contours.simplify(
+            self.parameter['simplify'],
+            self.parameter['simplify_tolerance']
+        ).min_points(3)
+
+        # Count points before and after simplification:
+        ctx.contour_points += int(contours.lengths.sum())
+        ctx.polygon_points += int(simplified.lengths.sum())
+
+        return simplified
+
+    def _get_border_polygon(self, ctx, page_prediction):
+        # Find top-level contours of prediction with valid polygons:
+        contours = ContourSet.from_image(page_prediction.img, hierarchy=False).min_points(3)
+
+        # Get largest contour:
+        largest = contours.top_k(1)
+
+        # Simplify its polygon, keeping it as is if the simplified polygon is not valid (e.g. of a tiny border):
+        simplified = self._simplify_contours(ctx, largest)
+        if not len(simplified):
+            simplified = largest
+
+            ctx.polygon_points += int(largest.lengths.sum())
+
+        return simplified.polygon(0)
+
+    def _points_for_segment(self, contours, parent_image, parent_xywh):
+        # Convert polygons of all contours to absolute (page) coordinates at once:
+        polygons = coordinates_for_segment(contours.points(), parent_image, parent_xywh)
+
+        # Convert to points strings:
+        return points_strings(polygons, contours.lengths)
+
     def _set_Border(self, page, page_image, page_xywh, border_polygon):
         # Convert to absolute (page) coordinates:
         border_polygon = coordinates_for_segment(border_polygon, page_image, page_xywh)
@@ -77,249 +646,164 @@ class OcrdGbnSbbPredict(Processor):
         page.set_Border(
             BorderType(
                 Coords=CoordsType(
-                    points=points_from_polygon(border_polygon)
+                    points=points_strings(border_polygon, [len(border_polygon)])[0]
                 )
             )
         )
 
-    def _add_TextRegion(self, page, page_image, page_xywh, page_id, region_polygon, region_id):
-        # Convert to absolute (page) coordinates:
-        region_polygon = coordinates_for_segment(region_polygon, page_image, page_xywh)
-
-        # Save text region:
-        page.add_TextRegion(
+    def _add_TextRegions(self, page, page_id, region_points):
+        # Create text regions:
+        regions = [
             TextRegionType(
-                id=page_id+region_id,
+                id=page_id+"_region%04d" % idx,
                 Coords=CoordsType(
-                    points=points_from_polygon(region_polygon)
+                    points=points
                 )
-            )
-        )
+            ) for idx, points in enumerate(region_points)
+        ]
 
-    def _add_TextLine(self, page_id, region, region_image, region_xywh, region_id, line_polygon, line_id):
-        # Convert to absolute (page) coordinates:
-        line_polygon = coordinates_for_segment(line_polygon, region_image, region_xywh)
+        # Save them all at once:
+        page.set_TextRegion(page.get_TextRegion() + regions)
+
+        return regions
 
-        # Save text line:
-        region.add_TextLine(
+    def _add_TextLines(self, page_id, region, region_id, line_points):
+        # Create text lines:
+        lines = [
             TextLineType(
-                id=page_id+region_id+line_id,
+                id=page_id+region_id+"_line%04d" % idx,
                 Coords=CoordsType(
-                    points=points_from_polygon(line_polygon)
+                    points=points
                 )
-            )
-        )
+            ) for idx, points in enumerate(line_points)
+        ]
+
+        # Save them all at once:
+        region.set_TextLine(region.get_TextLine() + lines)
+
+        return lines
 
     def process(self):
         # Ensure path to model is absolute:
         self.parameter['model'] = realpath(self.parameter['model'])
 
-        # Construct Model object:
-        model = Model(self.parameter['model'], self.parameter['shaping'])
-
-        for (self.page_num, self.input_file) in enumerate(self.input_files):
-            self.log.info("Processing input file: %i / %s", self.page_num, self.input_file)
-
-            # Create a new PAGE file from the input file:
-            page_id = self.input_file.pageId or self.input_file.ID
-            pcgts = page_from_file(self.workspace.download_file(self.input_file))
-            page = pcgts.get_Page()
-
-            if self.parameter['operation_level'] == "page":
-                # Get image from PAGE:
-                page_image, page_xywh, _ = self.workspace.image_from_page(
-                    page,
-                    page_id
-                )
-
-                # Convert PIL to cv2 (RGB):
-                page_image, alpha = pil_to_cv2_rgb(page_image)
+        # Get Model object:
+        self.model = self.get_model(self.parameter['model'], self.parameter['shaping'])
 
-                # Get prediction for segment:
-                page_prediction = model.predict(page_image)
+        # Batch page predictions of several pages together:
+        self.batch_predictor = self.get_batch_predictor(self.model)
 
-                if self.parameter['type'] == "AlternativeImageType":
-                    # Convert to cv2 binary image then to PIL:
-                    page_prediction = cv2_to_pil_gray(page_prediction.to_binary_image(), alpha=alpha)
+        # Predict pages waiting longer than the latency bound while loading the next pages, and remaining pages at the
+        # end:
+        self.process_pages(self._predict_page, finish=self.batch_predictor.flush, poll=self.batch_predictor.poll)
 
-                    self._add_AlternativeImage(page_id, page, page_image, page_xywh, "", "")
+    def _predict_whole_page(self, ctx, emit, page_prediction):
+        page = ctx.page
+        page_id = ctx.page_id
+        page_image = ctx.page_image
+        page_xywh = ctx.page_xywh
 
-                elif self.parameter['type'] == "BorderType":
-                    # Find contours of prediction:
-                    contours = Contour.from_image(page_prediction.img)
+        if self.parameter['type'] == "AlternativeImageType":
+            # Convert to cv2 binary image then to PIL:
+            page_prediction = cv2_to_pil_gray(page_prediction.to_binary_image(), alpha=ctx.alpha)
 
-                    # Filter out child contours:
-                    contours = list(filter(lambda cnt: not cnt.is_child(), contours))
+            self._add_AlternativeImage(ctx, page, page_prediction, page_xywh, "", "")
 
-                    # Filter out invalid polygons:
-                    contours = list(filter(lambda cnt: cnt.polygon.is_valid(), contours))
+        elif self.parameter['type'] == "BorderType":
+            # Get polygon of largest contour of prediction:
+            border_polygon = self._get_border_polygon(ctx, page_prediction)
 
-                    # Sort contours by area:
-                    contours = sorted(contours, key=lambda cnt: cnt.area)
+            self._set_Border(page, page_image, page_xywh, border_polygon.points)
 
-                    # Get polygon of largest contour:
-                    border_polygon = contours[-1].polygon
+        elif self.parameter['type'] == "TextRegionType":
+            # Find top-level contours of prediction with valid polygons:
+            contours = ContourSet.from_image(page_prediction.img, hierarchy=False).min_points(3)
 
-                    self._set_Border(page, page_image, page_xywh, border_polygon)
+            # Simplify their polygons:
+            contours = self._simplify_contours(ctx, contours)
 
-                elif self.parameter['type'] == "TextRegionType":
-                    # Find contours of prediction:
-                    contours = Contour.from_image(page_prediction.img)
+            self._add_TextRegions(page, page_id, self._points_for_segment(contours, page_image, page_xywh))
 
-                    # Filter out child contours:
-                    contours = list(filter(lambda cnt: not cnt.is_child(), contours))
+        else:
+            self.log.error(
+                "PAGE-XML does not support sub-element of type %s for element Page",
+                self.parameter['type']
+            )
 
-                    # Filter out invalid polygons:
-                    contours = list(filter(lambda cnt: cnt.polygon.is_valid(), contours))
+        emit(ctx)
 
-                    for idx, cnt in enumerate(contours):
-                        region_id = "_region%04d" % idx
+    def _predict_page(self, ctx, emit):
+        page = ctx.page
+        page_id = ctx.page_id
 
-                        self._add_TextRegion(
-                            page,
-                            page_image,
-                            page_xywh,
-                            page_id,
-                            cnt.polygon.points,
-                            region_id
-                        )
+        if self.parameter['operation_level'] == "page":
+            # Get prediction for segment (page is finished once its batch is predicted):
+            self.batch_predictor.submit(ctx.page_image_cv2, partial(self._predict_whole_page, ctx, emit))
 
-                else:
-                    self.log.error(
-                        "PAGE-XML does not support sub-element of type %s for element Page",
-                        self.parameter['type']
-                    )
+            # Release full resolution image:
+            ctx.page_image_cv2 = None
 
-            elif self.parameter['operation_level'] == "region":
-                # Get image from PAGE:
-                page_image, page_xywh, _ = self.workspace.image_from_page(
-                    page,
-                    page_id
-                )
+            return
 
-                regions = page.get_TextRegion()
+        if self.parameter['operation_level'] == "region":
+            regions = page.get_TextRegion()
 
-                for region_idx, region in enumerate(regions):
-                    region_id = "_region%04d" % region_idx
+            # Get images and predictions of all TextRegions:
+            region_predictions = self._predict_segments(ctx, regions)
 
-                    # Get image from TextRegion:
-                    region_image, region_xywh = self.workspace.image_from_segment(
-                        region,
-                        page_image,
-                        page_xywh
-                    )
+            for region_idx, region in enumerate(regions):
+                region_id = "_region%04d" % region_idx
 
-                    # Convert PIL to cv2 (RGB):
-                    region_image, alpha = pil_to_cv2_rgb(region_image)
+                region_image, region_xywh, alpha, region_prediction = region_predictions[region_idx]
 
-                    # Get prediction for segment:
-                    region_prediction = model.predict(region_image)
+                if self.parameter['type'] == "AlternativeImageType":
+                    # Convert to cv2 binary image then to PIL:
+                    region_prediction = cv2_to_pil_gray(region_prediction.to_binary_image(), alpha=alpha)
 
-                    if self.parameter['type'] == "AlternativeImageType":
-                        # Convert to cv2 binary image then to PIL:
-                        region_prediction = cv2_to_pil_gray(region_prediction.to_binary_image(), alpha=alpha)
+                    self._add_AlternativeImage(ctx, region, region_prediction, region_xywh, region_id, "")
 
-                        self._add_AlternativeImage(page_id, region, region_image, region_xywh, region_id, "")
+                elif self.parameter['type'] == "TextLineType":
+                    # Find top-level contours of prediction with valid polygons:
+                    contours = ContourSet.from_image(region_prediction.img, hierarchy=False).min_points(3)
 
-                    elif self.parameter['type'] == "TextLineType":
-                        # Find contours of prediction:
-                        contours = Contour.from_image(region_prediction.img)
+                    # Simplify their polygons:
+                    contours = self._simplify_contours(ctx, contours)
 
-                        # Filter out child contours:
-                        contours = list(filter(lambda cnt: not cnt.is_child(), contours))
+                    self._add_TextLines(
+                        page_id,
+                        region,
+                        region_id,
+                        self._points_for_segment(contours, region_image, region_xywh)
+                    )
 
-                        # Filter out invalid polygons:
-                        contours = list(filter(lambda cnt: cnt.polygon.is_valid(), contours))
+                else:
+                    self.log.error(
+                        "PAGE-XML does not support sub-element of type %s for element TextRegion",
+                        self.parameter['type']
+                    )
 
-                        for idx, cnt in enumerate(contours):
-                            line_id = "_line%04d" % idx
+        elif self.parameter['operation_level'] == "line":
+            # Get TextLines of all TextRegions along with their IDs:
+            lines = [
+                (line, "_region%04d" % region_idx + "_region%04d" % line_idx)
+                for region_idx, region in enumerate(page.get_TextRegion())
+                for line_idx, line in enumerate(region.get_TextLine())
+            ]
 
-                            self._add_TextLine(
-                                page_id,
-                                region,
-                                region_image,
-                                region_xywh,
-                                region_id,
-                                cnt.polygon.points,
-                                line_id
-                            )
+            # Get images and predictions of all TextLines:
+            line_predictions = self._predict_segments(ctx, [line for line, _ in lines])
 
-                    else:
-                        self.log.error(
-                            "PAGE-XML does not support sub-element of type %s for element TextRegion",
-                            self.parameter['type']
-                        )
+            for (line, line_id), (line_image, line_xywh, alpha, line_prediction) in zip(lines, line_predictions):
+                if self.parameter['type'] == "AlternativeImageType":
+                    # Convert to cv2 binary image then to PIL:
+                    line_prediction = cv2_to_pil_gray(line_prediction.to_binary_image(), alpha=alpha)
 
-            elif self.parameter['operation_level'] == "line":
-                # Get image from PAGE:
-                page_image, page_xywh, _ = self.workspace.image_from_page(
-                    page,
-                    page_id
-                )
+                    self._add_AlternativeImage(ctx, line, line_prediction, line_xywh, line_id, "")
 
-                regions = page.get_TextRegion()
-
-                for region_idx, region in enumerate(regions):
-                    region_id = "_region%04d" % region_idx
-
-                    lines = region.get_TextLine()
-
-                    for line_idx, line in enumerate(lines):
-                        line_id = "_region%04d" % line_idx
-
-                        # Get image from TextLine:
-                        line_image, line_xywh = self.workspace.image_from_segment(
-                            line,
-                            page_image,
-                            page_xywh
-                        )
-
-                        # Convert PIL to cv2 (RGB):
-                        line_image, alpha = pil_to_cv2_rgb(line_image)
-
-                        # Get prediction for segment:
-                        line_prediction = model.predict(line_image)
-
-                        if self.parameter['type'] == "AlternativeImageType":
-                            # Convert to cv2 binary image then to PIL:
-                            line_prediction = cv2_to_pil_gray(line_prediction.to_binary_image(), alpha=alpha)
-
-                            self._add_AlternativeImage(page_id, line, line_image, line_xywh, region_id+line_id, "")
-
-                        else:
-                            self.log.error(
-                                "PAGE-XML does not support sub-element of type %s for element TextLine",
-                                self.parameter['type']
-                            )
-
-            # Add metadata about this operation:
-            metadata = pcgts.get_Metadata()
-            metadata.add_MetadataItem(
-                MetadataItemType(
-                    type_="processingStep",
-                    name=self.ocrd_tool['steps'][0],
-                    value=self.tool,
-                    Labels=[
-                        LabelsType(
-                            externalModel="ocrd-tool",
-                            externalId="parameters",
-                            Label=[
-                                LabelType(
-                                    type_=name,
-                                    value=self.parameter[name]
-                                ) for name in self.parameter.keys()
-                            ]
-                        )
-                    ]
-                )
-            )
+                else:
+                    self.log.error(
+                        "PAGE-XML does not support sub-element of type %s for element TextLine",
+                        self.parameter['type']
+                    )
 
-            # Save XML PAGE:
-            self.workspace.add_file(
-                 ID=self.page_file_id,
-                 file_grp=self.page_grp,
-                 pageId=page_id,
-                 mimetype=MIMETYPE_PAGE,
-                 local_filename=join(self.output_file_grp, self.page_file_id)+".xml",
-                 content=to_xml(pcgts)
-            )
+        emit(ctx)
@@ -1,5 +1,5 @@
 from gbn.lib.dl import Model, Prediction
-from gbn.lib.struct import Contour, Polygon
+from gbn.lib.struct import ContourSet, Polygon, RegionLabelMap
 from gbn.lib.util import pil_to_cv2_rgb, cv2_to_pil_gray
 from gbn.tool import OCRD_TOOL
 from gbn.sbb.predict import OcrdGbnSbbPredict
@@ -7,8 +7,9 @@ from gbn.sbb.predict import OcrdGbnSbbPredict
 from ocrd_modelfactory import page_from_file
 from ocrd_models.ocrd_page import to_xml
 from ocrd_models.ocrd_page_generateds import AlternativeImageType, BorderType, CoordsType, LabelsType, LabelType, MetadataItemType, TextLineType, TextRegionType
-from ocrd_utils import concat_padded, coordinates_for_segment, getLogger, MIMETYPE_PAGE, points_from_polygon
+from ocrd_utils import concat_padded, coordinates_for_segment, coordinates_of_segment, getLogger, MIMETYPE_PAGE, points_from_polygon
 
+from functools import partial
 from os.path import realpath, join
 
 class OcrdGbnSbbSegment(OcrdGbnSbbPredict):
@@ -21,137 +22,94 @@ class OcrdGbnSbbSegment(OcrdGbnSbbPredict):
         # Ensure path to TextRegion model is absolute:
         self.parameter['region_model'] = realpath(self.parameter['region_model'])
 
-        # Construct Model object for TextRegion prediction:
-        region_model = Model(self.parameter['region_model'], self.parameter['region_shaping'])
+        # Get Model object for TextRegion prediction:
+        self.region_model = self.get_model(self.parameter['region_model'], self.parameter['region_shaping'])
 
         # Ensure path to TextLine model is absolute:
         self.parameter['line_model'] = realpath(self.parameter['line_model'])
 
-        # Construct Model object for TextLine prediction:
-        line_model = Model(self.parameter['line_model'], self.parameter['line_shaping'])
-
-        for (self.page_num, self.input_file) in enumerate(self.input_files):
-            self.log.info("Processing input file: %i / %s", self.page_num, self.input_file)
-
-            # Create a new PAGE file from the input file:
-            page_id = self.input_file.pageId or self.input_file.ID
-            pcgts = page_from_file(self.workspace.download_file(self.input_file))
-            page = pcgts.get_Page()
-
-            # Get Border from PAGE:
-            border = page.get_Border()
-
-            # Get image from PAGE:
-            page_image, page_xywh, _ = self.workspace.image_from_page(
-                page,
-                page_id
-            )
-
-            # Convert PIL to cv2 (RGB):
-            page_image_cv2, _ = pil_to_cv2_rgb(page_image)
-
-            # Get TextRegion prediction for page:
-            region_prediction = region_model.predict(page_image_cv2)
-
-            if border is not None:
-                # Get Border polygon:
-                border_polygon = Polygon(border.get_Coords().get_points())
-
-                # Get TextRegion prediction inside the Border:
-                region_prediction = region_prediction.crop(border_polygon)
-
-            # Find contours of prediction:
-            region_contours = Contour.from_image(region_prediction.img)
-
-            # Filter out child contours:
-            region_contours = list(filter(lambda cnt: not cnt.is_child(), region_contours))
-
-            # Filter out invalid polygons:
-            region_contours = list(filter(lambda cnt: cnt.polygon.is_valid(), region_contours))
-
-            # Get TextLine prediction for page:
-            line_prediction_page = line_model.predict(page_image_cv2)
-
-            # Add metadata about TextRegions:
-            for region_idx, region_cnt in enumerate(region_contours):
-                region_id = "_region%04d" % region_idx
-
-                self._add_TextRegion(
-                    page,
-                    page_image,
-                    page_xywh,
-                    page_id,
-                    region_cnt.polygon.points,
-                    region_id
-                )
-
-            # Retrieve added TextRegions:
-            regions = page.get_TextRegion()
-
-            for region_idx, (region_cnt, region) in enumerate(zip(region_contours, regions)):
-                region_id = "_region%04d" % region_idx
-
-                # Get image from TextRegion:
-                region_image, region_xywh = self.workspace.image_from_segment(
-                    region,
-                    page_image,
-                    page_xywh
-                )
-
-                # Get TextLine prediction for TextRegion:
-                line_prediction_region = line_prediction_page.crop(region_cnt.polygon)
-
-                # Find contours of prediction:
-                line_contours = Contour.from_image(line_prediction_region.img)
-
-                # Filter out child contours:
-                line_contours = list(filter(lambda cnt: not cnt.is_child(), line_contours))
-
-                # Filter out invalid polygons:
-                line_contours = list(filter(lambda cnt: cnt.polygon.is_valid(), line_contours))
-
-                # Add metadata about TextLines:
-                for line_idx, line_cnt in enumerate(line_contours):
-                    line_id = "_line%04d" % line_idx
-
-                    self._add_TextLine(
-                        page_id,
-                        region,
-                        region_image,
-                        region_xywh,
-                        region_id,
-                        line_cnt.polygon.points,
-                        line_id
-                    )
-
-            # Add metadata about this operation:
-            metadata = pcgts.get_Metadata()
-            metadata.add_MetadataItem(
-                MetadataItemType(
-                    type_="processingStep",
-                    name=self.ocrd_tool['steps'][0],
-                    value=self.tool,
-                    Labels=[
-                        LabelsType(
-                            externalModel="ocrd-tool",
-                            externalId="parameters",
-                            Label=[
-                                LabelType(
-                                    type_=name,
-                                    value=self.parameter[name]
-                                ) for name in self.parameter.keys()
-                            ]
-                        )
-                    ]
-                )
-            )
-
-            # Save XML PAGE:
-            self.workspace.add_file(
-                 ID=self.page_file_id,
-                 file_grp=self.page_grp,
-                 pageId=page_id,
-                 mimetype=MIMETYPE_PAGE,
-                 local_filename=join(self.output_file_grp, self.page_file_id)+".xml",
-                 content=to_xml(pcgts)
-            )
+        # Get Model object for TextLine prediction:
+        self.line_model = self.get_model(self.parameter['line_model'], self.parameter['line_shaping'])
+
+        # Batch TextRegion predictions of several pages together:
+        self.region_predictor = self.get_batch_predictor(self.region_model)
+
+        # Predict pages waiting longer than the latency bound while loading the next pages, and remaining pages at the
+        # end:
+        self.process_pages(self._segment_page, finish=self.region_predictor.flush, poll=self.region_predictor.poll)
+
+    def _segment_page(self, ctx, emit):
+        # Get TextRegion prediction for page (page is segmented once its batch is predicted):
+        self.region_predictor.submit(ctx.page_image_cv2, partial(self._segment_page_regions, ctx, emit))
+
+    def _segment_page_regions(self, ctx, emit, region_prediction):
+        page = ctx.page
+        page_id = ctx.page_id
+        page_image = ctx.page_image
+        page_xywh = ctx.page_xywh
+        page_image_cv2 = ctx.page_image_cv2
+
+        # Get Border from PAGE:
+        border = page.get_Border()
+
+        if border is not None:
+            # Get Border polygon (relative to page image):
+            border_polygon = Polygon(coordinates_of_segment(border, page_image, page_xywh))
+
+            # Get TextRegion prediction inside the Border:
+            region_prediction = region_prediction.crop(border_polygon)
+
+            # Offset of the cropped prediction on the page image:
+            offset = (border_polygon.bbox.x0, border_polygon.bbox.y0)
+        else:
+            offset = (0, 0)
+
+        # Find top-level contours of prediction (inside its mask, if cropped) with valid polygons, on the page image:
+        region_contours = ContourSet.from_image(
+            region_prediction.view,
+            mask=region_prediction.mask,
+            hierarchy=False
+        ).min_points(3).translate(*offset)
+
+        # Simplify their polygons:
+        region_contours = self._simplify_contours(ctx, region_contours)
+
+        # Get TextLine prediction for page:
+        line_prediction = self.line_model.predict(page_image_cv2)
+
+        if self.parameter['split_lines']:
+            # Split merged TextLines at the valleys of their projection profiles:
+            line_prediction = line_prediction.split_oversized(self.parameter['line_split_factor'])
+
+        # Rasterize TextRegion polygons into a label map:
+        region_labels = RegionLabelMap(region_contours, page_image_cv2.shape)
+
+        # Assign the TextLine contours to the TextRegions they overlap the most (on the page image):
+        line_contours_per_region = region_labels.assign(line_prediction.img, relative=False)
+
+        # Filter out invalid TextLine polygons and simplify the others:
+        line_contours_per_region = [
+            self._simplify_contours(ctx, line_contours.min_points(3)) for line_contours in line_contours_per_region
+        ]
+
+        # Convert polygons of all TextRegions and of all TextLines to absolute (page) coordinates at once:
+        region_points = self._points_for_segment(region_contours, page_image, page_xywh)
+        line_points = self._points_for_segment(
+            ContourSet.concatenate(line_contours_per_region),
+            page_image,
+            page_xywh
+        )
+
+        # Add metadata about TextRegions:
+        regions = self._add_TextRegions(page, page_id, region_points)
+
+        # Add metadata about TextLines of each TextRegion:
+        start = 0
+        for region_idx, (line_contours, region) in enumerate(zip(line_contours_per_region, regions)):
+            region_id = "_region%04d" % region_idx
+
+            self._add_TextLines(page_id, region, region_id, line_points[start:start+len(line_contours)])
+
+            start += len(line_contours)
+
+        emit(ctx)
@@ -27,6 +27,8 @@ setup(
         "ocrd-gbn-sbb-crop=gbn:ocrd_gbn_sbb_crop",
         "ocrd-gbn-sbb-binarize=gbn:ocrd_gbn_sbb_binarize",
         "ocrd-gbn-sbb-segment=gbn:ocrd_gbn_sbb_segment",
+        "ocrd-gbn-sbb-crop-binarize-segment=gbn:ocrd_gbn_sbb_crop_binarize_segment",
+        "gbn-model=gbn:gbn_model",
       ]
     },
     python_requires='>=3.6.0',
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+# Only with the tensorflow (1.x) and Keras versions the backends are written for:
+tf = pytest.importorskip("tensorflow", minversion="1.15")
+keras = pytest.importorskip("keras", minversion="2.2")
+
+from gbn.lib.backend import BACKENDS
+
+@pytest.fixture(scope="module")
+def model_path(tmp_path_factory):
+    # Small binary model (background and foreground classes per pixel):
+    model = keras.models.Sequential([
+        keras.layers.Conv2D(4, 3, padding="same", activation="relu", input_shape=(8, 6, 3)),
+        keras.layers.Conv2D(2, 3, padding="same", activation="softmax")
+    ])
+
+    path = str(tmp_path_factory.mktemp("models") / "model.h5")
+    model.save(path)
+
+    return path
+
+@pytest.mark.parametrize("name", ["frozen", "tflite"])
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_backends_match_keras(model_path, name, batch_size):
+    batch = np.random.RandomState(0).rand(5, 8, 6, 3).astype(np.float32)
+
+    expected = BACKENDS["keras"](model_path).predict(batch, 5)
+
+    backend = BACKENDS[name](model_path)
+
+    assert tuple(backend.input_shape) == (None, 8, 6, 3)
+    assert tuple(backend.output_shape) == (None, 8, 6, 2)
+    assert np.allclose(backend.predict(batch, batch_size), expected, atol=1e-5)
+
+def test_frozen_graph_backend_runs_without_keras_session(model_path):
+    backend = BACKENDS["frozen"](model_path)
+
+    # Frozen graph holds the weights as constants (no variables left to initialize):
+    assert not backend.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+    assert backend.weights_size > 0
@@ -0,0 +1,123 @@
+import os
+import types
+import numpy as np
+import pytest
+
+from gbn.lib.cache import PredictionCache
+from gbn.lib.dl import Prediction
+
+@pytest.fixture
+def model(tmp_path):
+    model_path = tmp_path / "model.h5"
+    model_path.write_bytes(b"weights")
+
+    # Model object as seen by the cache (model file, shaping algorithm and inference backend):
+    return types.SimpleNamespace(
+        model_path=str(model_path),
+        shaping="split",
+        backend=types.SimpleNamespace(name="keras")
+    )
+
+def random_prediction(shape, seed=0):
+    rng = np.random.RandomState(seed)
+
+    return Prediction((rng.rand(*shape) < 0.5).astype(np.uint8) * 255)
+
+def test_key_depends_on_pixels_and_model(model):
+    image = np.random.RandomState(0).randint(0, 256, (20, 30, 3)).astype(np.uint8)
+
+    key = PredictionCache.key(model, image)
+
+    # Same pixels (even if not contiguous) give the same key:
+    assert PredictionCache.key(model, image.copy()) == key
+    assert PredictionCache.key(model, np.asfortranarray(image)) == key
+
+    # Pixels, shape and type:
+    changed = image.copy()
+    changed[0, 0, 0] ^= 1
+
+    assert PredictionCache.key(model, changed) != key
+    assert PredictionCache.key(model, image.reshape(30, 20, 3)) != key
+    assert PredictionCache.key(model, image.astype(np.uint16)) != key
+
+    # Shaping algorithm and inference backend:
+    assert PredictionCache.key(types.SimpleNamespace(**dict(vars(model), shaping="resize")), image) != key
+    assert PredictionCache.key(
+        types.SimpleNamespace(**dict(vars(model), backend=types.SimpleNamespace(name="tflite"))),
+        image
+    ) != key
+
+    # Model file (e.g. retrained):
+    with open(model.model_path, 'ab') as fp:
+        fp.write(b"more weights")
+
+    assert PredictionCache.key(model, image) != key
+
+@pytest.mark.parametrize("shape", [(1, 1), (13, 29), (64, 48)])
+def test_round_trip(tmp_path, shape):
+    cache = PredictionCache(str(tmp_path / "cache"))
+
+    prediction = random_prediction(shape)
+
+    assert cache.get("00ff") is None
+
+    cache.put("00ff", prediction)
+
+    cached = cache.get("00ff")
+
+    # Predictions are stored as packed bits:
+    assert cached.is_packed
+    assert cached.shape == shape
+    assert np.array_equal(cached.img, prediction.img)
+
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = PredictionCache(str(tmp_path / "cache"))
+
+    for idx in range(3):
+        cache.put("%02x" % idx, random_prediction((64, 64), idx))
+
+    # Room for two predictions of about the same size:
+    cache.max_size = cache.size * 2 // 3 + 1
+
+    # Use the oldest prediction, so that the second one is the least recently used:
+    assert cache.get("00") is not None
+
+    cache.put("03", random_prediction((64, 64), 3))
+
+    assert cache.get("01") is None
+    assert cache.get("02") is None
+    assert cache.get("00") is not None
+    assert cache.get("03") is not None
+
+    assert cache.evictions == 2
+    assert cache.size <= cache.max_size
+    assert not os.path.exists(cache.path("01"))
+
+def test_persists_across_instances(tmp_path):
+    cache = PredictionCache(str(tmp_path / "cache"))
+
+    prediction = random_prediction((20, 20))
+    cache.put("ab", prediction)
+
+    # Predictions of a previous run are indexed (and count towards the size limit):
+    reopened = PredictionCache(str(tmp_path / "cache"), max_size=1)
+
+    assert reopened.size == cache.size
+    assert np.array_equal(reopened.get("ab").img, prediction.img)
+
+    reopened.evict()
+
+    assert reopened.get("ab") is None
+
+def test_unreadable_prediction_is_a_miss(tmp_path):
+    cache = PredictionCache(str(tmp_path / "cache"))
+
+    cache.put("cd", random_prediction((8, 8)))
+
+    with open(cache.path("cd"), 'wb') as fp:
+        fp.write(b"truncated")
+
+    assert cache.get("cd") is None
+    assert cache.misses == 1
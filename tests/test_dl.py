@@ -0,0 +1,555 @@
+import math
+import os
+import time
+import numpy as np
+import cv2
+import pytest
+
+from gbn.lib.backend import BACKENDS, DeferredBackend
+from gbn.lib.bench import resize_allocations
+from gbn.lib.cache import PredictionCache
+from gbn.lib.dl import BatchPredictor, Model, ModelRegistry, Prediction
+from gbn.lib.pipeline import Pipeline
+from gbn.lib.profile import ExecutionProfile
+from gbn.lib.quantize import calibration_inputs, quantize, quantized_path
+from gbn.lib.struct import Polygon
+
+class StubBackend:
+    '''
+    Deterministic Keras-like model whose file name encodes its shape as "HEIGHTxWIDTHxCHANNELSxCLASSES". Each output pixel
+    only depends on its input pixel and position (through elementwise operations), so the prediction of an input never
+    depends on the batch it is part of.
+    '''
+
+    name = "stub"
+
+    # Number of models loaded:
+    loads = 0
+
+    def __init__(self, model_path, cfg=None):
+        height, width, channels, classes = (int(value) for value in os.path.basename(model_path).split("x"))
+
+        StubBackend.loads += 1
+
+        # Session configuration loaded with:
+        self.cfg = cfg
+
+        self.input_shape = (None, height, width, channels)
+        self.output_shape = (None, height, width, classes)
+
+        rng = np.random.RandomState(0)
+        self.weights = rng.uniform(-1, 1, (channels, classes)).astype(np.float32)
+        self.positional = rng.uniform(-1, 1, (height, width, classes)).astype(np.float32)
+
+        self.weights_size = self.weights.nbytes + self.positional.nbytes
+
+        # Number of inputs of each forward pass:
+        self.calls = []
+
+    def predict(self, batch, batch_size):
+        self.calls.append(len(batch))
+
+        batch = np.asarray(batch, dtype=np.float32)
+
+        # Weighted channels plus a position-dependent term:
+        logits = self.positional * batch[..., :1] * batch[..., :1]
+        for channel in range(batch.shape[3]):
+            logits = logits + batch[..., channel:channel+1] * self.weights[channel]
+
+        return logits
+
+@pytest.fixture(autouse=True)
+def stub_backend(monkeypatch):
+    monkeypatch.setitem(BACKENDS, "stub", StubBackend)
+
+def labels(prediction):
+    '''
+    Reduces a prediction of a single input to labels (0 bg / 255 fg) as the former per-patch implementation did.
+    '''
+
+    bg = prediction[:, :, 0]
+    fg = prediction[:, :, 1]
+
+    if prediction.shape[2] > 2:
+        bg = np.add(bg, np.sum(prediction[:, :, 2:], axis=2))
+
+    return np.argmax(np.stack((bg, fg), axis=2), axis=2).astype(np.uint8) * 255
+
+def predict_patch(backend, patch):
+    '''
+    Predicts a single (normalized) model input in a forward pass of its own.
+    '''
+
+    return labels(backend.predict(patch.reshape((1,) + backend.input_shape[1:]), 1)[0])
+
+def baseline_split(backend, image):
+    '''
+    Predicts an image patch by patch, as the former split algorithm did.
+    '''
+
+    patch_shape = backend.input_shape[1:3]
+
+    # Pad image with black (as the former cv2.copyMakeBorder call effectively did):
+    padding = (patch_shape[0] - image.shape[0] % patch_shape[0], patch_shape[1] - image.shape[1] % patch_shape[1])
+    padding_top = math.floor(padding[0] / 2)
+    padding_left = math.floor(padding[1] / 2)
+
+    padded = np.zeros((image.shape[0] + padding[0], image.shape[1] + padding[1]) + image.shape[2:], dtype=np.uint8)
+    padded[padding_top:padding_top + image.shape[0], padding_left:padding_left + image.shape[1]] = image
+
+    padded = padded / 255.0
+
+    canvas = np.zeros(padded.shape[:2], dtype=np.uint8)
+
+    for y in range(0, padded.shape[0], patch_shape[0]):
+        for x in range(0, padded.shape[1], patch_shape[1]):
+            canvas[y:y+patch_shape[0], x:x+patch_shape[1]] = predict_patch(
+                backend,
+                padded[y:y+patch_shape[0], x:x+patch_shape[1]]
+            )
+
+    # Remove padding (offset by one pixel):
+    return canvas[padding_top+1:padding_top+1+image.shape[0], padding_left+1:padding_left+1+image.shape[1]]
+
+def baseline_resize(backend, image):
+    '''
+    Predicts an image resized to the model input, as the former resize algorithm did.
+    '''
+
+    resized = cv2.resize(image / 255.0, (backend.input_shape[2], backend.input_shape[1]), interpolation=cv2.INTER_NEAREST)
+
+    prediction = predict_patch(backend, resized)
+
+    return cv2.resize(prediction, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST)
+
+def random_image(shape, channels, seed=0):
+    rng = np.random.RandomState(seed)
+
+    return rng.randint(0, 256, shape if channels == 1 else shape + (channels,)).astype(np.uint8)
+
+# Models (see StubBackend) and page sizes, including sizes that are not multiples of the patch size:
+MODELS = ["8x6x3x3", "8x6x1x2"]
+PAGE_SIZES = [(16, 12), (37, 53), (5, 3), (61, 7)]
+
+@pytest.mark.parametrize("model_path", MODELS)
+@pytest.mark.parametrize("page_size", PAGE_SIZES)
+@pytest.mark.parametrize("batch_size", [1, 4, 16])
+def test_predict_split_matches_per_patch_baseline(model_path, page_size, batch_size):
+    model = Model(model_path, "split", batch_size=batch_size, backend="stub")
+
+    image = random_image(page_size, model.input_shape[3])
+
+    prediction = model.predict(image)
+
+    assert prediction.img.dtype == np.uint8
+    assert np.array_equal(prediction.img, baseline_split(model.backend, image))
+
+    # No forward pass exceeds the batch size:
+    assert max(model.backend.calls) <= batch_size
+
+@pytest.mark.parametrize("model_path", MODELS)
+@pytest.mark.parametrize("page_size", PAGE_SIZES)
+@pytest.mark.parametrize("batch_size", [1, 4, 16])
+def test_predict_resize_matches_baseline(model_path, page_size, batch_size):
+    model = Model(model_path, "resize", batch_size=batch_size, backend="stub")
+
+    image = random_image(page_size, model.input_shape[3])
+
+    assert np.array_equal(model.predict(image).img, baseline_resize(model.backend, image))
+
+@pytest.mark.parametrize("model_path", ["64x48x3x3", "64x48x1x2"])
+def test_predict_resize_allocates_less_than_legacy(model_path):
+    model = Model(model_path, "resize", backend="stub")
+
+    # Predictions are compared with the former implementation by resize_allocations itself:
+    legacy_allocated, allocated, _, _ = resize_allocations(model, [(600, 400), (1000, 700)])
+
+    assert allocated < legacy_allocated / 4
+
+@pytest.mark.parametrize("shaping", ["split", "resize"])
+@pytest.mark.parametrize("batch_size", [1, 4, 16])
+def test_predict_many_matches_predict(shaping, batch_size):
+    model = Model(MODELS[0], shaping, batch_size=batch_size, backend="stub")
+
+    images = [random_image(page_size, 3, seed) for seed, page_size in enumerate(PAGE_SIZES)]
+
+    for prediction, image in zip(model.predict_many(images), images):
+        assert np.array_equal(prediction.img, model.predict(image).img)
+
+def test_predict_many_batches_forward_passes():
+    model = Model(MODELS[0], "resize", batch_size=4, backend="stub")
+
+    images = [random_image(PAGE_SIZES[seed % len(PAGE_SIZES)], 3, seed) for seed in range(6)]
+
+    model.predict_many(images)
+
+    # Resized images of all segments go through forward passes of batch size, instead of one pass per segment:
+    assert model.backend.calls == [4, 2]
+
+    assert model.predict_many([]) == []
+
+@pytest.mark.parametrize("shaping", ["split", "resize"])
+def test_predict_many_honours_cache(tmp_path, shaping):
+    (tmp_path / MODELS[0]).touch()
+
+    model = Model(str(tmp_path / MODELS[0]), shaping, batch_size=16, backend="stub")
+    model.cache = PredictionCache(str(tmp_path / "cache"))
+
+    images = [random_image(page_size, 3, seed) for seed, page_size in enumerate(PAGE_SIZES)]
+
+    expected = [prediction.img for prediction in model.predict_many(images[:2])]
+
+    calls = len(model.backend.calls)
+
+    # Only segments not predicted yet are fed to the model, and predictions are returned in the order of the segments:
+    predictions = model.predict_many(images[1:] + images[:1])
+
+    assert model.cache.hits == 2
+    assert model.cache.misses == 2 + 2
+
+    assert np.array_equal(predictions[0].img, expected[1])
+    assert np.array_equal(predictions[-1].img, expected[0])
+
+    uncached = Model(MODELS[0], shaping, batch_size=16, backend="stub")
+
+    for prediction, image in zip(predictions, images[1:] + images[:1]):
+        assert np.array_equal(prediction.img, uncached.predict(image).img)
+
+    # As many model inputs as for the new segments alone:
+    uncached.backend.calls.clear()
+    uncached.predict_many(images[2:])
+
+    assert model.backend.calls[calls:] == uncached.backend.calls
+
+@pytest.mark.parametrize("memory_budget", [4000, 12000, 64000])
+def test_predict_split_within_memory_budget(memory_budget):
+    model = Model(MODELS[0], "split", batch_size=16, memory_budget=memory_budget, backend="stub")
+
+    # Page much wider than the patches fed per forward pass:
+    image = random_image((20, 300), 3)
+
+    patches_per_batch, _ = model.plan_split(image.shape[0] * image.shape[1])
+
+    assert np.array_equal(model.predict(image).img, baseline_split(model.backend, image))
+
+    # Forward passes (and the buffers they are fed from) are bounded by the budget, not by the page width:
+    assert max(model.backend.calls) <= patches_per_batch < 300 // model.input_shape[2]
+    assert model.input_buffer.shape[0] <= patches_per_batch
+
+@pytest.mark.parametrize("memory_budget", [4000, 64000])
+def test_predict_many_within_memory_budget(memory_budget):
+    model = Model(MODELS[0], "split", batch_size=16, memory_budget=memory_budget, backend="stub")
+
+    images = [random_image(page_size, 3, seed) for seed, page_size in enumerate(PAGE_SIZES)]
+
+    patches_per_batch, _ = model.plan_split(sum(image.shape[0] * image.shape[1] for image in images))
+
+    for prediction, image in zip(model.predict_many(images), images):
+        assert np.array_equal(prediction.img, baseline_split(model.backend, image))
+
+    assert max(model.backend.calls) <= patches_per_batch
+
+def test_registry_shares_loaded_models(tmp_path):
+    registry = ModelRegistry(max_models=1)
+
+    for name in MODELS:
+        (tmp_path / name).touch()
+
+    first = registry.get(str(tmp_path / MODELS[0]), "split", backend="stub", batch_size=4)
+    second = registry.get(str(tmp_path / MODELS[0]), "resize", backend="stub", batch_size=16, memory_budget=64000)
+
+    # Models differing only in their shaping, batch size or memory budget run the same loaded model:
+    assert first is not second
+    assert first.backend is second.backend
+    assert (second.shaping, second.batch_size, second.memory_budget) == ("resize", 16, 64000)
+    assert (registry.hits, registry.misses, registry.evictions) == (1, 1, 0)
+
+    # Loading another model evicts the least recently used one:
+    third = registry.get(str(tmp_path / MODELS[1]), "split", backend="stub")
+
+    assert third.backend is not first.backend
+    assert (len(registry.backends), registry.evictions) == (1, 1)
+
+def test_registry_keys_session_configuration(tmp_path):
+    registry = ModelRegistry()
+
+    (tmp_path / MODELS[0]).touch()
+
+    def get(intra_op_threads):
+        return registry.get(
+            str(tmp_path / MODELS[0]),
+            "split",
+            backend="stub",
+            profile=ExecutionProfile(intra_op_threads=intra_op_threads, inter_op_threads=1)
+        )
+
+    # Models loaded with other thread settings are not handed out:
+    assert get(1).backend is get(1).backend
+    assert get(1).backend is not get(2).backend
+    assert registry.misses == 2
+
+def test_registry_limits_from_environment(monkeypatch):
+    monkeypatch.setenv("GBN_MODEL_CACHE_SIZE", "2")
+    monkeypatch.setenv("GBN_MODEL_CACHE_MEMORY", "64")
+
+    registry = ModelRegistry.from_environment()
+
+    assert (registry.max_models, registry.max_memory) == (2, 64 * 1024 * 1024)
+
+    monkeypatch.setenv("GBN_MODEL_CACHE_SIZE", "0")
+    monkeypatch.delenv("GBN_MODEL_CACHE_MEMORY")
+
+    registry = ModelRegistry.from_environment()
+
+    assert (registry.max_models, registry.max_memory) == (None, None)
+
+def test_batch_predictor_honours_latency_while_loading():
+    model = Model(MODELS[0], "resize", backend="stub")
+    predictor = BatchPredictor(model, max_size=4, max_latency=0.05)
+
+    # Times pages were loaded and predicted:
+    loaded = {}
+    predicted = {}
+
+    def load(item):
+        # Slow loading of the second page:
+        if item == 1:
+            time.sleep(0.5)
+
+        loaded[item] = time.monotonic()
+
+        return item
+
+    def process(item, emit):
+        predictor.submit(random_image((16, 12), 3, item), lambda prediction: emit(item))
+
+    def write(item):
+        predicted[item] = time.monotonic()
+
+    Pipeline(load, process, write, depth=2).run(range(2), finish=predictor.flush, poll=predictor.poll)
+
+    # First page is predicted once its latency bound passed, without waiting for the second page to be loaded:
+    assert sorted(predicted) == [0, 1]
+    assert predicted[0] < loaded[1]
+
+def test_batch_predictor_keeps_submission_order_of_cached_predictions(tmp_path):
+    (tmp_path / MODELS[0]).touch()
+
+    model = Model(str(tmp_path / MODELS[0]), "resize", backend="stub")
+    model.cache = PredictionCache(str(tmp_path / "cache"))
+
+    images = [random_image((16, 12), 3, seed) for seed in range(4)]
+
+    # Cache predictions of the second and last images:
+    for idx in (1, 3):
+        model.predict(images[idx])
+
+    predictor = BatchPredictor(model, max_size=4)
+
+    # Callbacks called (index and prediction):
+    called = []
+
+    for idx, image in enumerate(images):
+        predictor.submit(image, lambda prediction, idx=idx: called.append((idx, prediction)))
+
+    # Cached predictions wait for the images submitted before them:
+    assert [idx for idx, _ in called] == []
+
+    predictor.flush()
+
+    assert [idx for idx, _ in called] == [0, 1, 2, 3]
+    assert model.backend.calls[-1] == 2
+
+    for idx, prediction in called:
+        assert np.array_equal(prediction.img, baseline_resize(model.backend, images[idx]))
+
+    # Cached prediction with no pending images is routed back right away:
+    predictor.submit(images[1], lambda prediction: called.append((1, prediction)))
+
+    assert len(called) == 5
+
+def test_registry_defers_loading(tmp_path):
+    registry = ModelRegistry()
+
+    (tmp_path / MODELS[0]).touch()
+
+    loads = StubBackend.loads
+
+    model = registry.get(str(tmp_path / MODELS[0]), "split", backend="stub", defer=True)
+
+    # Model is not loaded by the process deferring it (e.g. before forking workers):
+    assert StubBackend.loads == loads
+    assert registry.memory == 0
+
+    # Model is loaded by the workers on start:
+    registry.load_deferred(intra_op_threads=1, inter_op_threads=1)
+
+    assert StubBackend.loads == loads + 1
+    assert model.input_shape == (1, 8, 6, 3)
+
+    image = random_image((37, 53), 3)
+
+    assert np.array_equal(model.predict(image).img, baseline_split(model.backend.loaded, image))
+
+def test_deferred_backend_loads_on_first_use(tmp_path):
+    (tmp_path / MODELS[0]).write_bytes(b"weights")
+
+    loads = StubBackend.loads
+
+    backend = DeferredBackend("stub", str(tmp_path / MODELS[0]), cfg="default")
+
+    # Size of the model file until loaded:
+    assert not backend.is_loaded
+    assert backend.weights_size == len(b"weights")
+
+    batch = random_image((2, 8, 6), 3).astype(np.float32)
+
+    prediction = backend.predict(batch, 2)
+
+    # Loaded once, with the configuration given on construction:
+    assert backend.is_loaded
+    assert StubBackend.loads == loads + 1
+    assert backend.loaded.cfg == "default"
+    assert np.array_equal(prediction, StubBackend(str(tmp_path / MODELS[0])).predict(batch, 2))
+
+    assert backend.load("other") is backend.loaded
+    assert backend.loaded.cfg == "default"
+    assert backend.weights_size == backend.loaded.weights_size
+    assert backend.input_shape == (None, 8, 6, 3)
+
+def test_invalid_backend(tmp_path):
+    (tmp_path / MODELS[0]).touch()
+
+    with pytest.raises(ValueError):
+        Model(str(tmp_path / MODELS[0]), "split", backend="onnx")
+
+def test_registry_never_defers_loaded_models(tmp_path):
+    registry = ModelRegistry()
+
+    (tmp_path / MODELS[0]).touch()
+
+    # Model loaded by this process (e.g. by a previous run without workers):
+    loaded = registry.get(str(tmp_path / MODELS[0]), "split", backend="stub")
+
+    assert registry.has_loaded_models
+
+    # Processes about to fork workers get a model to be loaded by the workers instead of the loaded one:
+    deferred = registry.get(str(tmp_path / MODELS[0]), "split", backend="stub", defer=True)
+
+    assert deferred.backend is not loaded.backend
+    assert not deferred.backend.is_loaded
+
+    # No model loaded by this process is left once the loaded one is evicted:
+    registry.max_models = 1
+    registry.evict()
+
+    assert not registry.has_loaded_models
+
+def test_split_oversized_only_cuts_oversized_shapes():
+    image = np.zeros((300, 260), dtype=np.uint8)
+
+    # Two lines merged through a thin stroke:
+    image[100:110, 10:103] = 255
+    image[110:130, 100:103] = 255
+    image[130:140, 100:201] = 255
+
+    # Other shapes within the bounding box of the merged lines, next to its cuts:
+    neighbours = [(slice(100, 128), slice(150, 161)), (slice(112, 140), slice(20, 31))]
+    for neighbour in neighbours:
+        image[neighbour] = 255
+
+    # Lines of median height:
+    for y in range(200, 275, 15):
+        image[y:y+10, 10:200] = 255
+
+    split = Prediction(image).split_oversized().img
+
+    # Merged lines are cut into parts (the lines and the stroke between them), leaving other shapes as they were:
+    assert cv2.connectedComponents(split)[0] == cv2.connectedComponents(image)[0] + 2
+    assert np.count_nonzero(split != image) == 6
+
+    for neighbour in neighbours:
+        assert np.array_equal(split[neighbour], image[neighbour])
+
+def triangle_polygon(x0, y0, x1, y1):
+    return Polygon(np.array([[x0, y0], [x1, y0], [x0, y1]], dtype=np.int32))
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_crop_leaves_prediction_unmodified(packed):
+    image = (np.random.RandomState(0).rand(60, 90) < 0.5).astype(np.uint8) * 255
+
+    prediction = Prediction(image.copy())
+    if packed:
+        prediction.pack()
+
+    polygons = [triangle_polygon(10, 5, 70, 50), triangle_polygon(30, 20, 89, 59)]
+
+    for polygon in polygons:
+        cropped = prediction.crop(polygon)
+
+        # Pixels inside of polygon are kept, the other ones are background:
+        expected = image[polygon.bbox.y0:polygon.bbox.y1, polygon.bbox.x0:polygon.bbox.x1].copy()
+        expected[~polygon.to_mask()] = 0
+
+        assert np.array_equal(cropped.img, expected)
+        assert np.array_equal(cropped.to_binary_image(), 255 - expected)
+
+    # Overlapping crops do not affect the prediction (nor each other):
+    assert np.array_equal(prediction.img, image)
+
+def test_crop_of_crop_combines_masks():
+    image = np.full((60, 90), 255, dtype=np.uint8)
+
+    outer = triangle_polygon(0, 0, 80, 50)
+    inner = Polygon(np.array([[0, 0], [60, 0], [60, 40], [0, 40]], dtype=np.int32))
+
+    cropped = Prediction(image).crop(outer).crop(inner)
+
+    # Only pixels inside of both polygons are foreground:
+    expected = np.zeros((inner.bbox.height, inner.bbox.width), dtype=np.uint8)
+    expected[outer.to_mask()[:inner.bbox.height, :inner.bbox.width] & inner.to_mask()] = 255
+
+    assert np.array_equal(cropped.img, expected)
+    assert np.array_equal(cropped.packed_bits(), np.packbits(expected, axis=1))
+
+def test_polygon_mask_drawn_once_and_read_only():
+    polygon = triangle_polygon(10, 5, 70, 50)
+
+    mask = polygon.to_mask()
+
+    assert polygon.to_mask() is mask
+    assert mask.shape == (polygon.bbox.height, polygon.bbox.width)
+
+    with pytest.raises(ValueError):
+        mask[0, 0] = False
+
+def test_quantized_path():
+    assert quantized_path("/models/region.h5", "int8") == "/models/region.int8.tflite"
+    assert quantized_path("model", "float16") == "model.float16.tflite"
+
+@pytest.mark.parametrize("model_path", MODELS)
+def test_calibration_inputs_fed_as_model_inputs(model_path):
+    images = [random_image((37, 53), 3, seed) for seed in range(3)]
+
+    # Inputs of resized images:
+    model = Model(model_path, "resize", backend="stub")
+
+    inputs = calibration_inputs(model, images)
+
+    assert len(inputs) == len(images)
+    for tensor, image in zip(inputs, images):
+        assert tensor.dtype == np.float32
+        assert tensor.shape == model.input_shape
+        assert np.allclose(tensor[0], model.fit_channels(model.resize_input(image)) / 255.0)
+
+    # Inputs of non-overlapping patches (4 * 8 patches of 8x6 pixels per image), up to the given number of inputs:
+    model = Model(model_path, "split", backend="stub")
+
+    inputs = calibration_inputs(model, images, max_inputs=40)
+
+    assert len(inputs) == 40
+    assert np.allclose(inputs[33][0], model.fit_channels(images[1])[0:8, 6:12] / 255.0)
+
+def test_quantize_invalid_precision():
+    with pytest.raises(ValueError):
+        quantize(Model(MODELS[0], "split", backend="stub"), "int4")
@@ -0,0 +1,92 @@
+import os
+import pytest
+
+from gbn.lib.manifest import Manifest
+
+@pytest.fixture
+def workspace(tmp_path):
+    # Output file of a page and the manifest of its file group:
+    (tmp_path / "OUT").mkdir()
+    (tmp_path / "OUT" / "page1.xml").write_text("<PcGts/>")
+
+    return tmp_path
+
+def page_files():
+    return [{
+        'ID': "OUT_0001",
+        'file_grp': "OUT",
+        'mimetype': "application/vnd.prima.page+xml",
+        'local_filename': "OUT/page1.xml",
+        'size': 8
+    }]
+
+def test_key_depends_on_values_and_file_contents(tmp_path):
+    image = tmp_path / "page1.png"
+    image.write_bytes(b"pixels")
+
+    key = Manifest.key(["model", "{}"], [str(image)])
+
+    assert Manifest.key(["model", "{}"], [str(image)]) == key
+
+    # Parameters, models and boundaries between values:
+    assert Manifest.key(["model", "{\"jobs\": 2}"], [str(image)]) != key
+    assert Manifest.key(["mode", "l{}"], [str(image)]) != key
+
+    # Input file contents:
+    image.write_bytes(b"other pixels")
+
+    assert Manifest.key(["model", "{}"], [str(image)]) != key
+
+    # Missing input files are hashed by their paths:
+    missing = Manifest.key(["model"], ["missing.png"])
+
+    assert Manifest.key(["model"], ["missing.png"]) == missing
+    assert Manifest.key(["model"], ["other.png"]) != missing
+
+def test_resume_skips_recorded_pages(workspace):
+    path = str(workspace / "OUT" / ".gbn-manifest.json")
+
+    manifest = Manifest(path)
+    manifest.record("PHYS_0001", "key1", page_files())
+
+    # Manifest is saved right away (e.g. for an interrupted run), without leftover temporary file:
+    assert not os.path.exists(path + ".tmp")
+
+    resumed = Manifest(path)
+
+    assert len(resumed) == 1
+    assert resumed.get("PHYS_0001", "key1", str(workspace)) == page_files()
+
+    # Pages not recorded yet are processed:
+    assert resumed.get("PHYS_0002", "key2", str(workspace)) is None
+
+def test_outdated_pages_not_skipped(workspace):
+    manifest = Manifest(str(workspace / "OUT" / ".gbn-manifest.json"))
+    manifest.record("PHYS_0001", "key1", page_files())
+
+    # Inputs changed:
+    assert manifest.get("PHYS_0001", "key2", str(workspace)) is None
+
+    # Output file modified:
+    (workspace / "OUT" / "page1.xml").write_text("<PcGts></PcGts>")
+
+    assert manifest.get("PHYS_0001", "key1", str(workspace)) is None
+
+    # Output file removed:
+    os.remove(str(workspace / "OUT" / "page1.xml"))
+
+    assert manifest.get("PHYS_0001", "key1", str(workspace)) is None
+
+def test_unreadable_manifest_is_empty(workspace):
+    path = workspace / "OUT" / ".gbn-manifest.json"
+    path.write_text("{\"PHYS_0001\": {\"key\"")
+
+    manifest = Manifest(str(path))
+
+    assert len(manifest) == 0
+    assert manifest.get("PHYS_0001", "key1", str(workspace)) is None
+
+    # Overwritten by the next page recorded:
+    manifest.record("PHYS_0001", "key1", page_files())
+
+    assert Manifest(str(path)).get("PHYS_0001", "key1", str(workspace)) == page_files()
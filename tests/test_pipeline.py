@@ -0,0 +1,107 @@
+import threading
+import time
+import pytest
+
+from gbn.lib.pipeline import Pipeline
+
+def slow_load(item):
+    # Load items in reverse order of completion (later items load faster):
+    time.sleep(0.002 * (10 - item % 10))
+
+    return item
+
+@pytest.mark.parametrize("workers, depth", [(1, 0), (1, 2), (4, 4)])
+def test_results_written_in_input_order(workers, depth):
+    written = []
+
+    def process(item, emit):
+        emit(item * 2)
+
+    Pipeline(slow_load, process, written.append, workers=workers, depth=depth).run(range(20))
+
+    assert written == [item * 2 for item in range(20)]
+
+@pytest.mark.parametrize("depth", [0, 3])
+def test_finish_emits_held_back_results_in_order(depth):
+    written = []
+
+    # Items held back (as by a batching layer) and the function emitting their results:
+    held = []
+    emitter = {}
+
+    def process(item, emit):
+        emitter['emit'] = emit
+
+        held.append(item)
+
+        # Emit held back results with every other item:
+        if item % 2:
+            for held_item in held:
+                emit(held_item)
+
+            held.clear()
+
+    # Threads the finish function is called in:
+    finish_threads = []
+
+    def finish():
+        finish_threads.append(threading.current_thread())
+
+        for held_item in held:
+            emitter['emit'](held_item)
+
+        held.clear()
+
+    Pipeline(slow_load, process, written.append, depth=depth).run(range(7), finish=finish)
+
+    # Result of the last item is only emitted by the finish function, in the calling thread:
+    assert written == list(range(7))
+    assert finish_threads == [threading.current_thread()]
+
+def test_poll_called_while_loading():
+    polls = []
+
+    def load(item):
+        # Slow loading of the second item:
+        if item == 1:
+            time.sleep(0.2)
+
+        return item
+
+    def poll():
+        polls.append(time.monotonic())
+
+        return 0.01
+
+    start = time.monotonic()
+
+    Pipeline(load, lambda item, emit: emit(item), lambda result: None, depth=2).run(range(3), poll=poll)
+
+    # Polls are due every 10 ms while the second item is being loaded:
+    assert len([poll for poll in polls if poll - start < 0.2]) > 5
+
+def test_poll_called_before_each_item_when_sequential():
+    events = []
+
+    def load(item):
+        events.append(("load", item))
+
+        return item
+
+    def poll():
+        events.append(("poll", None))
+
+        # Not due again until the next item:
+        return None
+
+    Pipeline(load, lambda item, emit: emit(item), lambda result: None).run(range(2), poll=poll)
+
+    assert events == [("poll", None), ("load", 0), ("poll", None), ("load", 1)]
+
+def test_write_error_raised():
+    def write(result):
+        if result == 3:
+            raise RuntimeError("write failed")
+
+    with pytest.raises(RuntimeError, match="write failed"):
+        Pipeline(lambda item: item, lambda item, emit: emit(item), write, depth=2).run(range(10))
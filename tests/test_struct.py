@@ -0,0 +1,270 @@
+import numpy as np
+import cv2
+import pytest
+
+from gbn.lib.struct import BoundingBox, BoxIndex, Contour, ContourSet, Polygon, RegionLabelMap
+
+def blob_image(shape=(120, 160), count=25, seed=0):
+    '''
+    Draws random filled and hollow rectangles and ellipses (nested and overlapping shapes) on a blank image.
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    image = np.zeros(shape, dtype=np.uint8)
+
+    for _ in range(count):
+        x, y = rng.randint(0, shape[1]), rng.randint(0, shape[0])
+        w, h = rng.randint(2, 40), rng.randint(2, 30)
+        thickness = -1 if rng.rand() < 0.5 else int(rng.randint(1, 4))
+
+        if rng.rand() < 0.5:
+            cv2.rectangle(image, (x, y), (x + w, y + h), 255, thickness)
+        else:
+            cv2.ellipse(image, (x, y), (w // 2 + 1, h // 2 + 1), 0, 0, 360, 255, thickness)
+
+    return image
+
+@pytest.mark.parametrize("seed", range(5))
+def test_contour_set_matches_contours(seed):
+    image = blob_image(seed=seed)
+
+    contours = Contour.from_image(image)
+    contour_set = ContourSet.from_image(image)
+
+    assert len(contour_set) == len(contours)
+
+    for idx, contour in enumerate(contours):
+        assert contour_set.areas[idx] == pytest.approx(contour.area)
+        assert np.array_equal(contour_set.polygon(idx).points, contour.polygon.points)
+        assert contour_set.polygon(idx).bbox.__dict__ == contour.polygon.bbox.__dict__
+        assert tuple(contour_set.hierarchy[idx]) == (contour.next, contour.previous, contour.first_child, contour.parent)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_contour_set_filters_match_contours(seed):
+    image = blob_image(seed=seed)
+
+    contours = Contour.from_image(image)
+    contour_set = ContourSet.from_image(image)
+
+    # Top-level contours:
+    top_level = [contour for contour in contours if not contour.is_child()]
+
+    assert [polygon.points.tolist() for polygon in contour_set.top_level()] == [
+        contour.polygon.points.tolist() for contour in top_level
+    ]
+
+    # Top-level contours retrieved directly (without hierarchy):
+    assert sorted(polygon.points.tolist() for polygon in ContourSet.from_image(image, hierarchy=False)) == sorted(
+        contour.polygon.points.tolist() for contour in top_level
+    )
+
+    # Valid polygons:
+    assert [polygon.points.tolist() for polygon in contour_set.min_points(3)] == [
+        contour.polygon.points.tolist() for contour in contours if contour.polygon.is_valid()
+    ]
+
+    # Largest contour (as the last one after a stable ascending sort by area):
+    largest = sorted(contours, key=lambda contour: contour.area)[-1]
+
+    assert np.array_equal(contour_set.top_k(1).polygon(0).points, largest.polygon.points)
+
+def test_contour_set_from_masked_image():
+    image = blob_image()
+
+    mask = np.zeros(image.shape, dtype=np.bool_)
+    mask[20:90, 30:130] = True
+
+    masked = image.copy()
+    masked[~mask] = 0
+
+    contour_set = ContourSet.from_image(image, mask=mask)
+
+    # Shapes outside of the mask are ignored, without modifying the image:
+    assert [polygon.points.tolist() for polygon in contour_set] == [
+        contour.polygon.points.tolist() for contour in Contour.from_image(masked)
+    ]
+    assert np.array_equal(image, blob_image())
+
+def test_contour_set_translate_and_concatenate():
+    contour_set = ContourSet.from_image(blob_image(), hierarchy=False)
+
+    translated = contour_set.translate(5, -3)
+
+    assert np.array_equal(translated.points(), contour_set.points() + [5, -3])
+    assert np.array_equal(translated.bboxes[:, :2], contour_set.bboxes[:, :2] + [5, -3])
+
+    concatenated = ContourSet.concatenate([contour_set, translated])
+
+    assert len(concatenated) == 2 * len(contour_set)
+    assert np.array_equal(concatenated.points(), np.concatenate([contour_set.points(), translated.points()]))
+
+def test_empty_contour_set():
+    contour_set = ContourSet.from_image(np.zeros((10, 10), dtype=np.uint8))
+
+    assert len(contour_set) == 0
+    assert len(contour_set.min_points(3).top_k(1)) == 0
+    assert contour_set.points().shape == (0, 2)
+
+def rectangle_polygon(x0, y0, x1, y1):
+    return Polygon(np.array([[x0, y0], [x0, y1], [x1, y1], [x1, y0]], dtype=np.int32))
+
+def line_image(shape=(200, 300), count=40, seed=0):
+    '''
+    Draws random filled line-like rectangles (possibly touching each other) on a blank image.
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    image = np.zeros(shape, dtype=np.uint8)
+
+    for _ in range(count):
+        x, y = rng.randint(0, shape[1] - 20), rng.randint(0, shape[0] - 5)
+        cv2.rectangle(image, (x, y), (x + rng.randint(10, 120), y + rng.randint(2, 8)), 255, -1)
+
+    return image
+
+# Regions (not overlapping each other) of the line images, leaving some lines outside of all of them:
+REGIONS = [(10, 10, 140, 90), (150, 5, 290, 100), (20, 110, 200, 190)]
+
+@pytest.mark.parametrize("seed", range(5))
+def test_region_label_map_assigns_lines_of_most_overlap(seed):
+    image = line_image(seed=seed)
+
+    polygons = [rectangle_polygon(*region) for region in REGIONS]
+
+    assigned = RegionLabelMap(polygons, image.shape).assign(image, relative=False)
+
+    # Masks of regions:
+    region_masks = []
+    for polygon in polygons:
+        mask = np.zeros(image.shape, dtype=np.uint8)
+        cv2.fillPoly(mask, np.int32([polygon.points]), 1)
+        region_masks.append(mask.view(np.bool_))
+
+    # Assign each top-level contour (line) by counting its pixels inside each region:
+    expected = [[] for _ in polygons]
+    for polygon in ContourSet.from_image(image, hierarchy=False):
+        mask = np.zeros(image.shape, dtype=np.uint8)
+        cv2.fillPoly(mask, np.int32([polygon.points]), 1)
+
+        counts = [np.count_nonzero(mask.view(np.bool_) & region_mask & (image > 0)) for region_mask in region_masks]
+
+        if max(counts):
+            expected[int(np.argmax(counts))].append(sorted(polygon.points.tolist()))
+
+    assert [sorted(sorted(polygon.points.tolist()) for polygon in contours) for contours in assigned] == [
+        sorted(lines) for lines in expected
+    ]
+
+    # Some lines are outside of all regions:
+    assert sum(len(contours) for contours in assigned) < len(ContourSet.from_image(image, hierarchy=False))
+
+def test_region_label_map_relative_to_regions():
+    image = line_image()
+
+    polygons = [rectangle_polygon(*region) for region in REGIONS]
+    region_labels = RegionLabelMap(polygons, image.shape)
+
+    for polygon, absolute, relative in zip(
+        polygons,
+        region_labels.assign(image, relative=False),
+        region_labels.assign(image, relative=True)
+    ):
+        assert np.array_equal(relative.points(), absolute.points() - [polygon.bbox.x0, polygon.bbox.y0])
+
+def test_region_label_map_without_regions_or_lines():
+    image = line_image()
+
+    assert RegionLabelMap([], image.shape).assign(image) == []
+
+    assigned = RegionLabelMap([rectangle_polygon(*REGIONS[0])], image.shape).assign(np.zeros_like(image))
+
+    assert [len(contours) for contours in assigned] == [0]
+
+def random_boxes(rng, count, min_size, max_size, page_size=(700, 500)):
+    '''
+    Draws random boxes (x, y, width, height) of given range of sizes inside a page of given size (height, width).
+    '''
+
+    sizes = rng.randint(min_size, max_size, (count, 2))
+    origins = rng.randint(0, [page_size[1], page_size[0]], (count, 2)) % ([page_size[1], page_size[0]] - sizes)
+
+    return np.concatenate([origins, sizes], axis=1)
+
+def box_queries(seed):
+    rng = np.random.RandomState(seed)
+
+    return random_boxes(rng, 300, 1, 40), random_boxes(rng, 30, 1, 300)
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("cell_size", [None, 1, 7, 1000])
+def test_box_index_intersecting_within_outside(seed, cell_size):
+    bboxes, targets = box_queries(seed)
+
+    index = BoxIndex(bboxes, cell_size)
+
+    x0, y0 = bboxes[:, 0], bboxes[:, 1]
+    x1, y1 = x0 + bboxes[:, 2], y0 + bboxes[:, 3]
+
+    for target in targets:
+        bbox = BoundingBox(target.tolist())
+
+        intersecting = (x0 < bbox.x1) & (bbox.x0 < x1) & (y0 < bbox.y1) & (bbox.y0 < y1)
+        within = (x0 >= bbox.x0) & (x1 <= bbox.x1) & (y0 >= bbox.y0) & (y1 <= bbox.y1)
+
+        assert np.array_equal(index.intersecting(bbox), np.flatnonzero(intersecting))
+        assert np.array_equal(index.within(bbox), np.flatnonzero(within))
+        assert np.array_equal(index.outside(bbox), np.flatnonzero(~intersecting))
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("cell_size", [None, 7])
+def test_box_index_pairs(seed, cell_size):
+    bboxes, targets = box_queries(seed)
+
+    index = BoxIndex(bboxes, cell_size)
+
+    queries, boxes = index.pairs(targets)
+
+    # Pairs are grouped by given box, each pair once:
+    assert np.all(np.diff(queries) >= 0)
+    assert sorted(zip(queries.tolist(), boxes.tolist())) == [
+        (query, box)
+        for query, target in enumerate(targets)
+        for box in index.intersecting(BoundingBox(target.tolist())).tolist()
+    ]
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("k", [1, 5, 300, 400])
+def test_box_index_nearest(seed, k):
+    bboxes, _ = box_queries(seed)
+
+    index = BoxIndex(bboxes)
+
+    x0, y0 = bboxes[:, 0], bboxes[:, 1]
+    x1, y1 = x0 + bboxes[:, 2] - 1, y0 + bboxes[:, 3] - 1
+
+    rng = np.random.RandomState(seed)
+
+    for x, y in rng.randint(-50, 750, (20, 2)).tolist():
+        distances = np.hypot(
+            np.maximum(np.maximum(x0 - x, x - x1), 0),
+            np.maximum(np.maximum(y0 - y, y - y1), 0)
+        )
+
+        nearest = index.nearest(x, y, k)
+
+        # As many boxes as available, from nearest to farthest, none farther than any box left out:
+        assert len(nearest) == min(k, len(bboxes))
+        assert np.all(np.diff(distances[nearest]) >= 0)
+        assert np.allclose(distances[nearest], np.sort(distances)[:len(nearest)])
+
+def test_empty_box_index():
+    index = BoxIndex(np.zeros((0, 4)))
+
+    bbox = BoundingBox([0, 0, 10, 10])
+
+    assert len(index) == 0
+    assert len(index.intersecting(bbox)) == len(index.within(bbox)) == len(index.outside(bbox)) == 0
+    assert len(index.nearest(5, 5)) == 0
+    assert [len(indices) for indices in index.pairs([[0, 0, 10, 10]])] == [0, 0]
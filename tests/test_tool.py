@@ -0,0 +1,46 @@
+import json
+import os
+import re
+import pytest
+
+from gbn.tool import OCRD_TOOL
+
+TOOLS = OCRD_TOOL['tools']
+
+def definition(parameter):
+    # Parameter definition, apart from its description:
+    return {key: value for key, value in parameter.items() if key != 'description'}
+
+# Stages of the fused processor, the prefix of their model parameters and their parameters it does not support (it only
+# crops whole pages, binarizes them to 8-bit images and segments them as a whole):
+STAGES = [
+    ("ocrd-gbn-sbb-crop", "crop_", {"reduced_decoding"}),
+    ("ocrd-gbn-sbb-binarize", "binarize_", {"operation_level", "output_format", "batch_segments"}),
+    ("ocrd-gbn-sbb-segment", "", set())
+]
+
+@pytest.mark.parametrize("stage, prefix, unsupported", STAGES)
+def test_fused_tool_declares_stage_parameters(stage, prefix, unsupported):
+    fused = TOOLS["ocrd-gbn-sbb-crop-binarize-segment"]['parameters']
+
+    for name, parameter in TOOLS[stage]['parameters'].items():
+        if name in unsupported:
+            assert name not in fused
+            continue
+
+        # Models of the stage are given by prefixed parameters:
+        if name in ("model", "shaping"):
+            name = prefix + name
+
+        assert definition(fused[name]) == definition(parameter), name
+
+def test_readme_documents_tools():
+    with open(os.path.join(os.path.dirname(__file__), "..", "README.md")) as fp:
+        readme = fp.read()
+
+    blocks = {}
+    for block in re.findall(r"```json\n(\{\n \"executable\".*?)\n```", readme, re.S):
+        tool = json.loads(block)
+        blocks[tool['executable']] = tool
+
+    assert blocks == TOOLS
@@ -0,0 +1,128 @@
+import io
+import numpy as np
+import PIL.Image
+import pytest
+
+from gbn.lib.dl import Prediction
+from gbn.lib.struct import Polygon
+from gbn.lib.util import bits_to_pil_bilevel, pil_to_cv2, points_strings
+
+from ocrd_utils import points_from_polygon
+
+def random_polygons(seed, count=50):
+    rng = np.random.RandomState(seed)
+
+    # Polygons with points of any number of digits (including 0 and negative coordinates):
+    return [
+        rng.randint(-10 ** rng.randint(1, 6), 10 ** rng.randint(1, 6), (rng.randint(1, 20), 2)) for _ in range(count)
+    ]
+
+@pytest.mark.parametrize("seed", range(5))
+def test_points_strings_match_points_from_polygon(seed):
+    polygons = random_polygons(seed)
+
+    strings = points_strings(np.concatenate(polygons), [len(polygon) for polygon in polygons])
+
+    assert strings == [points_from_polygon(polygon.tolist()) for polygon in polygons]
+
+def test_points_strings_of_powers_of_ten():
+    # Coordinates at the boundaries of numbers of digits:
+    polygon = np.array([[0, 1], [9, 10], [99, 100], [-1, -9], [-10, -99], [-100, 999], [1000, 0]])
+
+    assert points_strings(polygon, [len(polygon)]) == [points_from_polygon(polygon.tolist())]
+
+def test_points_strings_without_polygons():
+    assert points_strings(np.zeros((0, 2)), []) == []
+
+def random_pil_image(mode, size=(37, 23), seed=0):
+    rng = np.random.RandomState(seed)
+
+    # Random colors with random (partial) transparency, converted to given mode:
+    image = PIL.Image.fromarray(rng.randint(0, 256, (size[1], size[0], 4)).astype(np.uint8), 'RGBA')
+
+    return image.convert(mode)
+
+def composite_cv2(image, channels):
+    '''
+    Reference conversion of PIL image to cv2 image: composites transparent pixels on white, then converts to grayscale
+    (for single-channel models and grayscale images) or BGR.
+    '''
+
+    gray = channels == 1 or image.mode in ('1', 'L', 'LA')
+
+    if 'A' in image.getbands():
+        image = PIL.Image.alpha_composite(PIL.Image.new('RGBA', image.size, (255,) * 4), image.convert('RGBA'))
+
+    if gray:
+        return np.array(image.convert('L'))
+
+    return np.array(image.convert('RGB'))[:, :, ::-1]
+
+@pytest.mark.parametrize("mode", ['1', 'L', 'LA', 'P', 'PA', 'RGB', 'RGBA', 'I;16', 'I', 'F', 'CMYK', 'YCbCr'])
+@pytest.mark.parametrize("channels", [1, 3])
+def test_pil_to_cv2_matches_composite(mode, channels):
+    image = random_pil_image(mode)
+
+    converted, alpha = pil_to_cv2(image, channels)
+
+    expected = composite_cv2(image, channels)
+
+    # Grayscale images stay single-channel, others have as many channels as the model:
+    assert converted.dtype == np.uint8
+    assert converted.shape == expected.shape
+
+    # Up to rounding of compositing:
+    assert np.abs(converted.astype(np.int16) - expected).max() <= 1
+
+    # Alpha channel (if any) is returned to be restored on the output:
+    if 'A' in image.getbands():
+        assert np.array_equal(np.array(alpha), np.array(image.getchannel('A')))
+    else:
+        assert alpha is None
+
+def test_pil_to_cv2_on_background_color():
+    image = PIL.Image.new('RGBA', (4, 3), (10, 20, 30, 0))
+
+    converted, _ = pil_to_cv2(image, 3, bg_color=128)
+
+    # Fully transparent pixels are the background color:
+    assert np.all(converted == 128)
+
+def bilevel_predictions(seed=0):
+    rng = np.random.RandomState(seed)
+
+    # Widths not a multiple of 8, so that rows end with padding bits:
+    image = (rng.rand(45, 61) < 0.3).astype(np.uint8) * 255
+
+    polygon = Polygon(np.array([[3, 2], [50, 9], [20, 40]], dtype=np.int32))
+
+    return {
+        'unpacked': Prediction(image.copy()),
+        'packed': Prediction(image.copy()).pack(),
+        'cropped': Prediction(image.copy()).crop(polygon),
+        'cropped packed': Prediction(image.copy()).pack().crop(polygon)
+    }
+
+@pytest.mark.parametrize("name", ['unpacked', 'packed', 'cropped', 'cropped packed'])
+@pytest.mark.parametrize("options", [{'format': 'PNG'}, {'format': 'TIFF', 'compression': 'group4'}])
+def test_bilevel_image_round_trip(name, options):
+    prediction = bilevel_predictions()[name]
+
+    image = bits_to_pil_bilevel(prediction.packed_bits(), prediction.shape)
+
+    assert image.mode == '1'
+    assert image.size == (prediction.shape[1], prediction.shape[0])
+
+    # Encode as 1-bit image, then decode it:
+    content = io.BytesIO()
+    image.save(content, **options)
+
+    content.seek(0)
+    decoded = PIL.Image.open(content)
+
+    assert decoded.mode == '1'
+    if options['format'] == 'TIFF':
+        assert decoded.info['compression'] == 'group4'
+
+    # Same pixels as the document binary image (black foreground on white background):
+    assert np.array_equal(np.array(decoded.convert('L')), prediction.to_binary_image())